@@ -5,33 +5,22 @@ from database.models import (
     DefaultModelPermission, CharacterPermission, DefaultCharacterPermission
 )
 from auth.utils import admin_required
+from auth.permissions import permission_cache
+from gallery import storage
 from sqlalchemy import func
 import os
 from config.config_utils import config
 import json
 import glob
 import yaml
+from config.character_registry import character_registry
 import sys
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
 
-def calculate_storage_usage():
-    """Calculate total storage used by generated images."""
-    total_size = 0
-    image_dirs = [
-        os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static', 'images'),
-        os.path.join(os.path.dirname(os.path.dirname(__file__)), 'images')
-    ]
-
-    for directory in image_dirs:
-        if os.path.exists(directory):
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                        file_path = os.path.join(root, file)
-                        total_size += os.path.getsize(file_path)
-
+def format_size(total_size):
+    """Format a byte count for display."""
     # Convert to appropriate unit
     if total_size > 1024 * 1024 * 1024:  # GB
         return f"{total_size / (1024 * 1024 * 1024):.2f} GB"
@@ -43,24 +32,23 @@ def calculate_storage_usage():
         return f"{total_size} B"
 
 
-def get_total_images():
-    """Count total generated images."""
-    total_images = 0
-    image_dirs = [
-        os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static', 'images'),
-        os.path.join(os.path.dirname(os.path.dirname(__file__)), 'images')
-    ]
-
-    for directory in image_dirs:
-        if os.path.exists(directory):
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                        total_images += 1
+def calculate_storage_usage():
+    """Total storage used by generated images, from the running storage counters."""
+    _, total_size = storage.totals()
+    return format_size(total_size)
 
+
+def get_total_images():
+    """Count total generated images, from the running storage counters."""
+    total_images, _ = storage.totals()
     return total_images
 
 
+def get_storage_breakdown(scope):
+    """Largest characters or users by storage, with sizes formatted for display."""
+    return [dict(entry, used=format_size(entry['bytes'])) for entry in storage.breakdown(scope)]
+
+
 @admin_bp.route('/')
 @admin_bp.route('/dashboard')
 @admin_required
@@ -86,6 +74,7 @@ def dashboard():
     activity_list = [{
         'username': activity.username,
         'action': 'Successful login' if activity.success else 'Failed login attempt',
+        'reason': activity.reason,
         'ip_address': activity.ip_address,
         'timestamp': activity.timestamp.strftime('%Y-%m-%d %H:%M:%S')
     } for activity in recent_activity]
@@ -94,7 +83,11 @@ def dashboard():
                         total_users=total_users,
                         active_users=active_users,
                         recent_logins=recent_logins,
-                        recent_activity=activity_list)
+                        recent_activity=activity_list,
+                        total_images=get_total_images(),
+                        storage_used=calculate_storage_usage(),
+                        character_storage=get_storage_breakdown(storage.CHARACTER),
+                        user_storage=get_storage_breakdown(storage.USER))
 
 
 @admin_bp.route('/users')
@@ -152,10 +145,7 @@ def approve_user(user_id):
 
             # Grant character permissions
             try:
-                # Load characters configuration
-                config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'characters.yaml')
-                with open(config_path, 'r') as f:
-                    characters = yaml.safe_load(f)
+                characters = character_registry.all()
 
                 # Get default permissions
                 default_permissions = DefaultCharacterPermission.query.all()
@@ -181,6 +171,7 @@ def approve_user(user_id):
                 print(f"Error granting character permissions: {e}", file=sys.stderr)
                 raise
 
+            permission_cache.bump_version()
             db.session.commit()
             return jsonify({'message': f'User {user.username} has been approved'})
 
@@ -220,6 +211,8 @@ def manage_user(user_id):
         user = User.query.get_or_404(user_id)
         try:
             db.session.delete(user)
+            # Their character permissions are deleted with them
+            permission_cache.bump_version()
             db.session.commit()
             return jsonify({'message': f'User {user.username} deleted successfully'})
         except Exception as e:
@@ -236,6 +229,8 @@ def manage_user(user_id):
         elif action == 'toggle_admin':
             if user_id != current_user_id:  # Prevent self-demotion
                 user.role = 'admin' if user.role == 'user' else 'user'
+                # Cached ACLs carry the role
+                permission_cache.bump_version()
                 message = f"User {user.username} role changed to {user.role}"
             else:
                 return jsonify({'error': 'Cannot modify your own admin status'}), 403
@@ -268,16 +263,8 @@ def get_user_characters(user_id):
         user = User.query.get_or_404(user_id)
 
         # Load all available characters from config
-        config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'characters.yaml')
-        print(f"Loading characters from: {config_path}")
-        
-        try:
-            with open(config_path, 'r') as f:
-                characters = yaml.safe_load(f)
-            print(f"Found characters: {list(characters.keys())}")
-        except Exception as e:
-            print(f"Error loading characters config: {e}")
-            return jsonify({'error': 'Failed to load characters'}), 500
+        characters = character_registry.all()
+        print(f"Found characters: {list(characters.keys())}")
 
         # Get user's character permissions
         user_permissions = CharacterPermission.query.filter_by(user_id=user_id).all()
@@ -333,6 +320,7 @@ def update_user_characters(user_id):
                 )
                 db.session.add(permission)
 
+        permission_cache.bump_version()
         db.session.commit()
         return jsonify({'message': 'Character permissions updated successfully'})
 
@@ -394,7 +382,9 @@ def get_stats():
         },
         'storage_stats': {
             'used': storage_used,
-            'total_images': total_images
+            'total_images': total_images,
+            'by_character': get_storage_breakdown(storage.CHARACTER),
+            'by_user': get_storage_breakdown(storage.USER)
         },
         'hourly_activity': hourly_data
     })
@@ -631,13 +621,7 @@ def update_default_models():
 def get_default_characters():
     """Get default character permissions for new users."""
     # Load all available characters
-    config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'characters.yaml')
-    try:
-        with open(config_path, 'r') as f:
-            characters = yaml.safe_load(f)
-    except Exception as e:
-        print(f"Error loading characters config: {e}", file=sys.stderr)
-        return jsonify({'error': 'Failed to load characters'}), 500
+    characters = character_registry.all()
 
     # Get default permissions
     default_permissions = DefaultCharacterPermission.query.all()
@@ -683,6 +667,7 @@ def update_default_characters():
                 )
                 db.session.add(permission)
 
+        permission_cache.bump_version()
         db.session.commit()
         return jsonify({'message': 'Default character permissions updated successfully'})
 
@@ -694,10 +679,7 @@ def update_default_characters():
 def grant_default_character_permissions(user_id, admin_id):
     """Grant default character permissions to a new user."""
     try:
-        # Load characters configuration
-        config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'characters.yaml')
-        with open(config_path, 'r') as f:
-            characters = yaml.safe_load(f)
+        characters = character_registry.all()
 
         # Get default permissions
         default_permissions = DefaultCharacterPermission.query.all()
@@ -719,6 +701,7 @@ def grant_default_character_permissions(user_id, admin_id):
                 )
                 db.session.add(permission)
 
+        permission_cache.bump_version()
         db.session.commit()
         return True
 
@@ -1,14 +1,15 @@
 # app.py
-import subprocess
 import os
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory
-from main import load_characters
+from flask import (
+    Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, send_file,
+    has_request_context, Response, stream_with_context
+)
 import glob
 import json
 from PIL import Image
 import sys
 from datetime import timedelta, datetime
-from database.models import db, User, init_db, ModelPermission, UserLatestContent
+from database.models import db, User, init_db, ModelPermission, UserLatestContent, UserPreference
 from auth.routes import auth_bp
 from auth.utils import login_required, admin_required
 
@@ -19,18 +20,30 @@ if project_root not in sys.path:
 
 from config.config_utils import config
 from database.models import db, init_db
+from database import profile as db_profile
 from auth.routes import auth_bp
 from admin.routes import admin_bp
 from auth.utils import login_required, admin_required
+from auth.permissions import permission_cache
+from auth.audit import audit_log
+from generate import engine
+from config.character_registry import character_registry
+from generate.jobs import jobs, JobQueueFull, JOB_STATES
+from generate.previews import PreviewRelay
+from generate.workflows import get_template, clean_workflow_options
+from gallery.derivatives import derivatives
+from gallery.index import image_index
 
 # Use configuration for paths
-CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'characters.yaml')
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 COMFYUI_DIR = config.get('paths', 'comfyui_dir')
 GENERATED_IMAGE_FOLDER = os.path.join(BASE_DIR, 'static', 'images')
 LATEST_IMAGE_NAME = 'latest_image.png'
 LATEST_PROMPT_FILE = os.path.join(BASE_DIR, 'static', 'latest_prompt.txt')
 PREVIOUS_SEED_FILE = os.path.join(BASE_DIR, 'static', 'previous_seed.txt')
+SSE_KEEPALIVE_INTERVAL = 15  # seconds between keep-alive comments on idle event streams
+FILES_PAGE_SIZE = config.get('gallery', 'page_size', default=100)
+MAX_FILES_PAGE_SIZE = 500
 
 IMAGES_FOLDER = os.path.join(BASE_DIR, 'images')  # Main images directory
 STATIC_IMAGES_FOLDER = os.path.join(BASE_DIR, 'static', 'images')  # For latest generated image
@@ -49,7 +62,7 @@ def create_app():
 
     # Set the absolute path for the SQLite database
     db_path = os.path.join(db_dir, 'app.db')
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    db_profile.configure(app, db_path)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = config.get('database', 'track_modifications', default=False)
 
     # Security and Session configuration
@@ -64,6 +77,7 @@ def create_app():
 
     # Initialize extensions
     db.init_app(app)
+    db_profile.install(app)
 
     with app.app_context():
         # Initialize database
@@ -72,7 +86,16 @@ def create_app():
     # Register blueprints
     app.register_blueprint(auth_bp)
     app.register_blueprint(admin_bp)
-    
+
+    # Generation jobs run in the background with access to the app context
+    jobs.init_app(app)
+
+    # Index images added while the app wasn't running
+    image_index.init_app(app)
+
+    # Login attempts are written in batches by a background thread
+    audit_log.init_app(app)
+
     return app
 
 app = create_app()
@@ -144,8 +167,9 @@ def save_prompt(prompt, user_id=None):
             db.session.rollback()
             raise
 
-        session['prompt'] = prompt
-        print("Successfully saved prompt to session")
+        if has_request_context():
+            session['prompt'] = prompt
+            print("Successfully saved prompt to session")
         return True
 
     except Exception as e:
@@ -273,15 +297,15 @@ def desanitize_character_name(folder_name):
 @login_required
 def index():
     """Main page route with character permission filtering."""
-    characters = load_characters(CONFIG_PATH)
+    characters = character_registry.all()
     user = User.query.get(session['user_id'])
     
     if not user.is_admin:
         # Filter characters based on generate permission
-        permissions = user.get_character_permissions()
+        acl = permission_cache.acl(user.id)
         characters = {
             name: data for name, data in characters.items() 
-            if name in permissions and permissions[name]['can_generate']
+            if acl.can_generate(name)
         }
     
     character_names = list(characters.keys())
@@ -315,13 +339,41 @@ def browse_images():
     return render_template('browse.html')
 
 
+def parse_listing_filters(args):
+    """Read the sort, page size and filters of an /api/files request; raises ValueError if one is invalid."""
+    def parse_date(value):
+        return datetime.fromisoformat(value) if value else None
+
+    seed = args.get('seed')
+    return {
+        'sort': args.get('sort', 'name'),
+        'descending': args.get('order', 'desc' if args.get('sort') == 'date' else 'asc') == 'desc',
+        'limit': min(max(int(args.get('limit', FILES_PAGE_SIZE)), 1), MAX_FILES_PAGE_SIZE),
+        'cursor': args.get('cursor') or None,
+        'date_from': parse_date(args.get('from')),
+        'date_to': parse_date(args.get('to')),
+        'seed': int(seed) if seed else None,
+        'checkpoint': args.get('checkpoint') or None
+    }
+
+
 @app.route('/api/files')
 @login_required
 def list_files():
-    """API endpoint to list files and folders."""
+    """
+    API endpoint to list files and folders, one page at a time.
+    Query parameters: path, limit, cursor (next_cursor of the previous page),
+    sort (name, date or size), order (asc or desc), and the filters from/to
+    (ISO dates), seed and checkpoint. Folders are only included on the first page.
+    """
     requested_path = request.args.get('path', '/')
     user = User.query.get(session['user_id'])
 
+    try:
+        listing = parse_listing_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid listing parameters: {e}'}), 400
+
     # Use IMAGES_FOLDER as the base path
     base_path = IMAGES_FOLDER
 
@@ -335,38 +387,43 @@ def list_files():
         # Check if this is a character directory
         rel_path = os.path.relpath(full_path, base_path)
         current_character = rel_path.split(os.sep)[0] if rel_path != '.' else None
+        folder = rel_path if rel_path != '.' else ''
 
         # If we're in a character directory, check permission using desanitized name
-        if current_character and not user.is_admin:
-            character_display_name = desanitize_character_name(current_character)
-            permissions = user.get_character_permissions()
-            if character_display_name not in permissions or not permissions[character_display_name]['can_browse']:
-                return jsonify({'error': 'Access denied'}), 403
+        acl = permission_cache.acl(user.id)
+        if current_character and not acl.can_browse(desanitize_character_name(current_character)):
+            return jsonify({'error': 'Access denied'}), 403
 
-        for item in os.listdir(full_path):
-            item_path = os.path.join(full_path, item)
-            is_dir = os.path.isdir(item_path)
+        try:
+            images, next_cursor = image_index.page(folder, **listing)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
+        # Folders and files come from the image index rather than the file system
+        folders = image_index.subfolders(folder) if not listing['cursor'] else []
+        for name in folders:
             # For root directory, only show characters user has browse permission for
-            if requested_path == '/' and is_dir and not user.is_admin:
-                character_display_name = desanitize_character_name(item)
-                permissions = user.get_character_permissions()
-                if character_display_name not in permissions or not permissions[character_display_name]['can_browse']:
-                    continue
-
-            if is_dir:
-                items.append({
-                    'name': item,
-                    'type': 'folder'
-                })
-            elif item.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-                items.append({
-                    'name': item,
-                    'type': 'file',
-                    'url': url_for('serve_image_file', path=os.path.relpath(item_path, IMAGES_FOLDER))
-                })
-
-        return jsonify(sorted(items, key=lambda x: (x['type'] != 'folder', x['name'])))
+            if not folder and not acl.can_browse(desanitize_character_name(name)):
+                continue
+            items.append({
+                'name': name,
+                'type': 'folder'
+            })
+
+        for image in images:
+            items.append({
+                'name': os.path.basename(image.path),
+                'type': 'file',
+                'url': url_for('serve_image_file', path=image.path),
+                'thumbnail_url': url_for('serve_image_derivative', kind='thumb', path=image.path, v=image.modified_ns),
+                'preview_url': url_for('serve_image_derivative', kind='preview', path=image.path, v=image.modified_ns),
+                'size': image.size,
+                'created_at': image.created_at.isoformat(),
+                'seed': image.seed,
+                'checkpoint': image.checkpoint
+            })
+
+        return jsonify({'items': items, 'next_cursor': next_cursor})
 
     except Exception as e:
         print(f"Error in list_files: {str(e)}", file=sys.stderr)
@@ -416,22 +473,47 @@ def serve_js(filename):
         return str(e), 500
 
 
+def can_browse_image(user_id, path):
+    """Check the user's browse permission for the character folder an image path is in."""
+    return permission_cache.acl(user_id).can_browse(desanitize_character_name(path.split(os.sep)[0]))
+
+
 @app.route('/images/<path:path>')
 @login_required
 def serve_image_file(path):
     """Serve images from the main images directory."""
-    user = User.query.get(session['user_id'])
+    # Check character permission for the requested image; the cached ACL needs no queries
+    if not can_browse_image(session['user_id'], path):
+        return "Access denied", 403
 
-    # Check character permission for the requested image
-    folder_name = path.split(os.sep)[0]
-    character_name = desanitize_character_name(folder_name)
+    return send_from_directory(IMAGES_FOLDER, path)
 
-    if not user.is_admin:
-        permissions = user.get_character_permissions()
-        if character_name not in permissions or not permissions[character_name]['can_browse']:
-            return "Access denied", 403
 
-    return send_from_directory(IMAGES_FOLDER, path)
+@app.route('/derivatives/<kind>/<path:path>')
+@login_required
+def serve_image_derivative(kind, path):
+    """Serve a thumbnail or preview of an image, queueing its render if it doesn't exist yet."""
+    if not can_browse_image(session['user_id'], path):
+        return "Access denied", 403
+
+    try:
+        derivative_path = derivatives.get(path, kind)
+    except KeyError:
+        return "Unknown derivative", 404
+    except ValueError:
+        return "Invalid path", 403
+    except OSError:
+        return "File not found", 404
+
+    if derivative_path is None:
+        # Not rendered yet; the full image is always a valid fallback and the next request gets the derivative
+        return redirect(url_for('serve_image_file', path=path))
+
+    response = send_file(derivative_path, mimetype='image/jpeg')
+    if request.args.get('v'):
+        # Listing URLs carry the source mtime, so a cached copy can't go stale
+        response.headers['Cache-Control'] = 'private, max-age=2592000, immutable'
+    return response
 
 
 @app.route('/api/user/latest-content')
@@ -486,15 +568,20 @@ def delete_files():
     if not full_path.startswith(base_path):
         return jsonify({'error': 'Invalid path'}), 403
 
+    deleted = []
     try:
         for filename in files_to_delete:
             file_path = os.path.join(full_path, filename)
             # Additional security check
             if os.path.normpath(file_path).startswith(base_path) and os.path.isfile(file_path):
                 os.remove(file_path)
+                deleted.append(os.path.relpath(os.path.normpath(file_path), base_path))
+                derivatives.remove(deleted[-1])
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        image_index.remove(deleted)
 
 
 @app.route('/api/available-models')
@@ -541,10 +628,61 @@ def get_available_models():
         return jsonify({'error': str(e)}), 500
 
 
+def validate_workflow_options(user, options, workflow_path):
+    """
+    Check Advanced Options before a job uses them.
+    Returns the options limited to the known keys; raises ValueError if they
+    don't apply to the workflow and PermissionError if a model is off limits.
+    """
+    if not isinstance(options, dict):
+        raise ValueError("Options must be an object")
+
+    options = clean_workflow_options(options, workflow_path)
+    permission_error = check_model_permissions(user, options)
+    if permission_error:
+        raise PermissionError(permission_error)
+    return options
+
+
+def request_workflow_options(user, character):
+    """
+    Return the Advanced Options sent with a generate request (its
+    advancedOptions form field), validated for the character's workflow,
+    or None if none were sent. Raises like validate_workflow_options.
+    """
+    advanced_options = request.form.get('advancedOptions')
+    if not advanced_options:
+        return None
+    workflow_file = character_registry.get(character, {}).get('workflow_file') or ''
+    return validate_workflow_options(user, json.loads(advanced_options), os.path.join(BASE_DIR, workflow_file))
+
+
+def check_model_permissions(user, options):
+    """Return an error message if options select a model the user may not use."""
+    if not options or user.is_admin:
+        return None
+
+    permitted_models = user.get_available_models()
+    checkpoint = options.get('checkpointModel')
+    if checkpoint and checkpoint != 'default':
+        if permitted_models['checkpoints'] and checkpoint not in permitted_models['checkpoints']:
+            return 'Access denied to selected checkpoint model'
+
+    if permitted_models['loras']:
+        for lora in options.get('loras') or []:
+            if lora.get('name') and lora['name'] not in permitted_models['loras']:
+                return f"Access denied to LoRA '{lora['name']}'"
+
+    return None
+
+
 @app.route('/api/workflow-options', methods=['POST'])
 @login_required
 def update_workflow_options():
-    """Update workflow options while preserving default model when selected."""
+    """
+    Check Advanced Options for a character's workflow and return them cleaned.
+    Nothing is stored; the browser sends its options with each generate request.
+    """
     try:
         data = request.json
         if not data:
@@ -557,7 +695,7 @@ def update_workflow_options():
             raise ValueError("Missing character or options")
 
         # Load character data and original workflow
-        characters = load_characters(CONFIG_PATH)
+        characters = character_registry.all()
         if character not in characters:
             raise ValueError(f"Character '{character}' not found")
 
@@ -569,112 +707,17 @@ def update_workflow_options():
         if not os.path.exists(workflow_path):
             raise ValueError(f"Workflow file not found: {workflow_path}")
 
-        # Load original workflow to get default values
-        with open(workflow_path, 'r') as f:
-            workflow = json.load(f)
-
-        # Handle model selection
-        model_node = next((node for node in workflow.values() if 'ckpt_name' in node.get('inputs', {})), None)
-        if model_node:
-            if options['checkpointModel'] == 'default':
-                # Keep the default model from the original workflow
-                pass
-            else:
-                # Verify user has permission for the selected model
-                user = User.query.get(session.get('user_id'))
-                if not user.is_admin:
-                    permitted_models = user.get_available_models()
-                    if permitted_models['checkpoints'] and options['checkpointModel'] not in permitted_models['checkpoints']:
-                        return jsonify({'error': 'Access denied to selected checkpoint model'}), 403
-                # Update to the selected model
-                model_node['inputs']['ckpt_name'] = options['checkpointModel']
-
-        # Store original LoRA configuration
-        original_loras = {}
-        lora_node = next((node for node in workflow.values() if node.get('class_type') == 'Power Lora Loader (rgthree)'), None)
-        if lora_node:
-            original_loras = {k: v for k, v in lora_node.get('inputs', {}).items() if k.startswith('lora_')}
-
-        # Update basic workflow options
-        model_node = next((node for node in workflow.values() if 'ckpt_name' in node.get('inputs', {})), None)
-        if model_node:
-            model_node['inputs']['ckpt_name'] = options['checkpointModel']
-
-        latent_node = next((node for node in workflow.values() if all(k in node.get('inputs', {}) for k in ['width', 'height'])), None)
-        if latent_node:
-            latent_node['inputs']['width'] = options['width']
-            latent_node['inputs']['height'] = options['height']
-
-        guidance_node = next((node for node in workflow.values() if 'guidance' in node.get('inputs', {})), None)
-        if guidance_node:
-            guidance_node['inputs']['guidance'] = options['guidance']
-
-        seed_node = next((node for node in workflow.values() if 'seed' in node.get('inputs', {})), None)
-        if seed_node:
-            seed_value = -1  # Default value
-            if options.get('useLastSeed', False):
-                try:
-                    seed_file_path = os.path.join(BASE_DIR, 'static', 'previous_seed.txt')
-                    if os.path.exists(seed_file_path):
-                        with open(seed_file_path, 'r') as f:
-                            saved_seed = f.read().strip()
-                            if saved_seed and saved_seed.isdigit():
-                                seed_value = int(saved_seed)
-                except Exception as e:
-                    print(f"Error reading previous seed: {e}")
-            else:
-                seed_value = options.get('seed', -1)
-            seed_node['inputs']['seed'] = seed_value
-
-        # Handle LoRAs while preserving character-specific ones
-        lora_node = next((node for node in workflow.values() if node.get('class_type') == 'Power Lora Loader (rgthree)'), None)
-        if lora_node:
-            # Store the existing model and clip connections
-            model_connection = lora_node['inputs'].get('model')
-            clip_connection = lora_node['inputs'].get('clip')
-
-            # Initialize the node with its basic structure
-            lora_node['inputs'] = {
-                "PowerLoraLoaderHeaderWidget": {"type": "PowerLoraLoaderHeaderWidget"},
-                "model": model_connection,
-                "clip": clip_connection,
-                "➕ Add Lora": ""
-            }
-
-            # First, add back the original character-specific LoRAs
-            next_lora_index = 1
-            for lora_key, lora_value in original_loras.items():
-                if isinstance(lora_value, dict) and lora_value.get('lora'):
-                    lora_node['inputs'][f'lora_{next_lora_index}'] = lora_value
-                    next_lora_index += 1
-
-            # Then add the user-selected LoRAs if they're not already present
-            for lora in options.get('loras', []):
-                if lora['name'] and not any(v.get('lora') == lora['name'] for v in lora_node['inputs'].values() if isinstance(v, dict)):
-                    lora_key = f'lora_{next_lora_index}'
-                    lora_node['inputs'][lora_key] = {
-                        "on": True,
-                        "lora": lora['name'],
-                        "strength": lora['strength']
-                    }
-                    next_lora_index += 1
-
-        # Create temp directory if it doesn't exist
-        temp_dir = os.path.join(BASE_DIR, 'temp_workflows')
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Create a temporary workflow file for this generation
-        temp_workflow_name = os.path.basename(workflow_file)
-        temp_workflow_path = os.path.join(temp_dir, temp_workflow_name)
-
-        # Save the temporary workflow
-        with open(temp_workflow_path, 'w') as f:
-            json.dump(workflow, f, indent=2)
-
-        # Store the temporary workflow path in the session
-        session['temp_workflow_path'] = os.path.join('temp_workflows', temp_workflow_name)
+        # Verify user has permission for the selected models
+        user = User.query.get(session.get('user_id'))
+        options = validate_workflow_options(user, options, workflow_path)
 
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'options': options})
+
+    except PermissionError as e:
+        return jsonify({'error': str(e)}), 403
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     except Exception as e:
         error_msg = f"Error updating workflow options: {str(e)}"
@@ -691,7 +734,7 @@ def get_default_workflow():
         if not character:
             raise ValueError("No character specified")
 
-        characters = load_characters(CONFIG_PATH)
+        characters = character_registry.all()
         if character not in characters:
             raise ValueError(f"Character '{character}' not found")
 
@@ -703,16 +746,14 @@ def get_default_workflow():
         if not os.path.exists(workflow_path):
             raise ValueError(f"Workflow file not found: {workflow_path}")
 
-        with open(workflow_path, 'r') as f:
-            workflow = json.load(f)
+        workflow = get_template(workflow_path).instance()
 
         # Print workflow information for debugging
         print(f"Loading workflow for character: {character}")
         print(f"Workflow file: {workflow_file}")
 
         # Print LoRA information
-        lora_node = next(
-            (node for node in workflow.values() if node.get('class_type') == 'Power Lora Loader (rgthree)'), None)
+        lora_node = workflow.node(workflow.roles.get('lora_loader'))
         if lora_node:
             print("Default LoRAs found in workflow:")
             for key, value in lora_node.get('inputs', {}).items():
@@ -727,17 +768,13 @@ def get_default_workflow():
             permitted_models = user.get_available_models()
 
             # If user has specific permissions, enforce them
-            if permitted_models['checkpoints'] or permitted_models['loras']:
-                # Find the checkpoint node and verify access
-                for node in workflow.values():
-                    if node.get('inputs', {}).get('ckpt_name'):
-                        if permitted_models['checkpoints'] and node['inputs']['ckpt_name'] not in permitted_models[
-                            'checkpoints']:
-                            # Set to first permitted model or empty if none available
-                            node['inputs']['ckpt_name'] = permitted_models['checkpoints'][0] if permitted_models[
-                                'checkpoints'] else ''
-
-        return jsonify(workflow)
+            if permitted_models['checkpoints']:
+                checkpoint = workflow.get_input('checkpoint')
+                if checkpoint and checkpoint not in permitted_models['checkpoints']:
+                    # Set to the first permitted model
+                    workflow.set_input('checkpoint', permitted_models['checkpoints'][0])
+
+        return jsonify(workflow.to_dict())
 
     except Exception as e:
         error_msg = f"Error getting default workflow: {str(e)}"
@@ -757,6 +794,26 @@ def get_user_permissions():
         'can_delete_files': user.can_delete_files or user.is_admin
     })
 
+@app.route('/api/user/preferences', methods=['GET', 'POST'])
+@login_required
+def user_preferences():
+    """Get or update the current user's preferences."""
+    user_id = session.get('user_id')
+    preferences = UserPreference.for_user(user_id)
+
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        if 'live_previews' in data:
+            preferences.live_previews = bool(data['live_previews'])
+        try:
+            db.session.add(preferences)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 500
+
+    return jsonify({'live_previews': preferences.live_previews})
+
 @app.route('/api/last-seed')
 @login_required
 def get_last_seed():
@@ -773,39 +830,226 @@ def get_last_seed():
         return jsonify({'seed': -1})
 
 
-# Modify the existing generate_images function to save the seed
-def generate_images(prompt, character_name=None):
-    """Handle image generation with user-specific paths."""
-    if not prompt or not character_name:
-        return False
+def run_generation_job(job, user_prompt=None, save_to_latest=True):
+    """Worker body shared by the generation routes; runs on the job pool."""
+    def on_prompt(prompt):
+        job.update(prompt=prompt)
+        if save_to_latest and not save_prompt(prompt, job.user_id):
+            raise engine.GenerationError("Failed to save prompt")
+
+    _, saved_paths = engine.run(
+        job.character, job.mode,
+        user_prompt=user_prompt,
+        user_id=job.user_id,
+        options=job.options,
+        use_pool=True,
+        on_stage=job.set_stage,
+        on_prompt=on_prompt,
+        on_token=lambda text: job.publish('token', {'text': text}),
+        on_progress=lambda value, maximum: job.publish(
+            'progress', {'value': value, 'max': maximum}, latest_only=True
+        ),
+        on_preview=PreviewRelay(job.publish) if job.previews else None
+    )
+    job.update(images=[os.path.relpath(path, IMAGES_FOLDER) for path in saved_paths])
 
-    queue_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate", "queue_and_retrieve_images.py")
-    if not os.path.exists(queue_script):
-        print(f"Queue script not found at: {queue_script}", file=sys.stderr)
-        return False
+
+def submit_generation_job(character, mode, user_prompt=None, save_to_latest=True):
+    """
+    Queue a generation job for the current user and return a 202 response.
+    Advanced Options sent with the request are kept on the job and apply
+    to it only.
+    """
+    user_id = session['user_id']
+    try:
+        options = request_workflow_options(db.session.get(User, user_id), character)
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 403
+    except ValueError as e:
+        print(f"Error reading workflow options: {e}", file=sys.stderr)
+        return jsonify({"error": f"Error reading workflow options: {str(e)}"}), 400
 
     try:
-        # Pass user_id to the script through environment variable
-        env = os.environ.copy()
-        env['user_id'] = str(session.get('user_id'))
-
-        result = subprocess.run(
-            ["python3", queue_script, prompt, character_name],
-            capture_output=True,
-            text=True,
-            check=True,
-            env=env  # Pass the environment with user_id
+        job = jobs.submit(
+            run_generation_job,
+            user_id,
+            character,
+            mode,
+            previews=UserPreference.for_user(user_id).live_previews,
+            options=options,
+            user_prompt=user_prompt,
+            save_to_latest=save_to_latest
         )
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error generating images: {e.stderr.strip()}", file=sys.stderr)
-        return False
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 429
+
+    print(f"Queued {mode} generation job {job.id} for character {character}")
+    return jsonify({
+        "success": True,
+        "job_id": job.id,
+        "status_url": url_for('get_job_status', job_id=job.id),
+        "events_url": url_for('stream_job_events', job_id=job.id)
+    }), 202
+
+
+def get_user_job(job_id):
+    """Look up a job the current user is allowed to see."""
+    job = jobs.get(job_id)
+    if not job or (job.user_id != session.get('user_id') and not session.get('is_admin')):
+        return None
+    return job
+
+
+def job_status_payload(job, data):
+    """Turn a job snapshot into the JSON sent to the browser."""
+    data = dict(data)
+    data['image_urls'] = [url_for('serve_image_file', path=path) for path in data.pop('images')]
+    data['latest_image_url'] = (get_image_url(job.user_id)
+                                if data['state'] == 'completed' and not job.batch_id else None)
+    return data
+
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def get_job_status(job_id):
+    """Get the state of a generation job."""
+    job = get_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job_status_payload(job, job.to_dict()))
+
+
+@app.route('/api/jobs/<job_id>/events')
+@login_required
+def stream_job_events(job_id):
+    """Stream a job's LLM tokens, render progress and status changes as Server-Sent Events."""
+    job = get_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        cursor = 0
+        while True:
+            events, cursor, finished = job.events_since(cursor, timeout=SSE_KEEPALIVE_INTERVAL)
+            if not events:
+                if finished:
+                    break
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+
+            for event, data in events:
+                if event == 'status':
+                    data = job_status_payload(job, data)
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def run_batch_job(job, user_prompt=None):
+    """Worker body for batch items; leaves the user's latest prompt and image alone."""
+    _, saved_paths = engine.run(
+        job.character, job.mode,
+        user_prompt=user_prompt,
+        user_id=job.user_id,
+        options=job.options,
+        save_seed=False,
+        save_latest=False,
+        on_stage=job.set_stage,
+        on_prompt=lambda prompt: job.update(prompt=prompt)
+    )
+    job.update(images=[os.path.relpath(path, IMAGES_FOLDER) for path in saved_paths])
+
+
+def expand_batch_items(items, user, characters):
+    """
+    Validate the items of a batch request and expand each one's count into
+    (character, mode, options, kwargs) entries for jobs.submit_batch.
+    Raises ValueError (or PermissionError) describing the first bad item.
+    """
+    if not isinstance(items, list) or not items:
+        raise ValueError("items must be a non-empty list")
+
+    acl = permission_cache.acl(user.id)
+    expanded = []
+    for index, item in enumerate(items):
+        try:
+            entries = engine.expand_batch_item(item, characters, engine.MAX_BATCH_ITEMS - len(expanded))
+        except ValueError as e:
+            raise ValueError(f"Item {index}: {e}")
+
+        character = item['character']
+        if not acl.can_generate(character):
+            raise PermissionError(f"Item {index}: access denied for character '{character}'")
+        permission_error = check_model_permissions(user, item.get('overrides'))
+        if permission_error:
+            raise PermissionError(f"Item {index}: {permission_error}")
+
+        expanded.extend((character, mode, options, {'user_prompt': prompt})
+                        for character, mode, prompt, options in entries)
+
+    return expanded
+
+
+@app.route('/api/batches', methods=['POST'])
+@login_required
+def create_batch():
+    """Queue many generation jobs in one request and return a batch id."""
+    data = request.get_json(silent=True) or {}
+    user = User.query.get(session['user_id'])
+
+    try:
+        expanded = expand_batch_items(data.get('items'), user, character_registry.all())
+    except PermissionError as e:
+        return jsonify({'error': str(e)}), 403
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        batch = jobs.submit_batch(run_batch_job, user.id, expanded)
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 429
+
+    print(f"Queued batch {batch.id} with {len(batch.job_ids)} jobs for user {user.id}")
+    return jsonify({
+        'success': True,
+        'batch_id': batch.id,
+        'job_ids': batch.job_ids,
+        'status_url': url_for('get_batch_status', batch_id=batch.id)
+    }), 202
+
+
+@app.route('/api/batches/<batch_id>')
+@login_required
+def get_batch_status(batch_id):
+    """Get the per-item status of a batch."""
+    batch, batch_jobs = jobs.get_batch(batch_id)
+    if not batch or (batch.user_id != session.get('user_id') and not session.get('is_admin')):
+        return jsonify({'error': 'Batch not found'}), 404
+
+    items = [job_status_payload(job, job.to_dict()) for job in batch_jobs]
+    counts = {state: 0 for state in JOB_STATES}
+    for item in items:
+        counts[item['state']] += 1
+
+    return jsonify({
+        'id': batch.id,
+        'created_at': batch.created_at,
+        'total': len(batch.job_ids),
+        'counts': counts,
+        'finished': counts['completed'] + counts['failed'] == len(batch.job_ids),
+        'items': items
+    })
 
 
 @app.route('/generate_new_image', methods=['POST'])
 @login_required
 def generate_new_image():
-    """Handle new image generation with detailed logging."""
+    """Queue a new random image generation job."""
     try:
         print("\nStarting generate_new_image")
         user_id = session.get('user_id')
@@ -818,55 +1062,13 @@ def generate_new_image():
             return jsonify({"error": "No character selected."}), 400
 
         user = db.session.get(User, user_id)
-        if not user.is_admin:
-            permissions = user.get_character_permissions()
-            if selected_character not in permissions or not permissions[selected_character]['can_generate']:
-                return jsonify({"error": "Access denied for this character."}), 403
+        if not permission_cache.acl(user.id).can_generate(selected_character):
+            return jsonify({"error": "Access denied for this character."}), 403
 
         session['selected_character'] = selected_character
-        main_py_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
-        print(f"Using main.py path: {main_py_path}")
-
-        # Set environment with user_id
-        env = os.environ.copy()
-        env['user_id'] = str(user_id)
-        print(f"Set user_id in environment: {env['user_id']}")
-
-        print("Running main.py...")
-        result = subprocess.run(
-            ["python3", main_py_path, "auto", "--character", selected_character],
-            capture_output=True,
-            text=True,
-            check=True,
-            env=env
-        )
 
-        print("main.py output:")
-        print(result.stdout)
-        if result.stderr:
-            print("main.py stderr:")
-            print(result.stderr)
-
-        # Get the last non-empty line as the prompt
-        output_lines = [line.strip() for line in result.stdout.split('\n') if line.strip()]
-        if output_lines:
-            prompt = output_lines[-1]
-            print(f"Generated prompt: {prompt}")
-            
-            if save_prompt(prompt, user_id):
-                print("Successfully saved prompt")
-                return jsonify({"success": True})
-            else:
-                print("Failed to save prompt")
-                return jsonify({"error": "Failed to save prompt"}), 500
-        else:
-            print("No prompt in output")
-            return jsonify({"error": "No prompt generated"}), 500
+        return submit_generation_job(selected_character, "auto")
 
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Error running main.py: {e.stderr.strip()}"
-        print(error_msg)
-        return jsonify({"error": error_msg}), 400
     except Exception as e:
         error_msg = f"Unexpected error in generate_new_image: {str(e)}"
         print(error_msg)
@@ -879,7 +1081,7 @@ def generate_new_image():
 @app.route('/regenerate_image', methods=['POST'])
 @login_required
 def regenerate_image():
-    """Handle image regeneration with permission checks."""
+    """Queue a regeneration job with permission checks."""
     try:
         selected_character = request.form.get('character')
         user_id = session['user_id']
@@ -889,10 +1091,8 @@ def regenerate_image():
 
         # Permission check
         user = User.query.get(user_id)
-        if not user.is_admin:
-            permissions = user.get_character_permissions()
-            if selected_character not in permissions or not permissions[selected_character]['can_generate']:
-                return jsonify({"error": "Access denied for this character"}), 403
+        if not permission_cache.acl(user.id).can_generate(selected_character):
+            return jsonify({"error": "Access denied for this character"}), 403
 
         session['selected_character'] = selected_character
 
@@ -901,32 +1101,8 @@ def regenerate_image():
         if not prompt:
             return jsonify({"error": "No previously saved prompt to regenerate"}), 400
 
-        # Get workflow options from the session
-        temp_workflow_path = session.get('temp_workflow_path')
-        if temp_workflow_path:
-            print(f"Using temporary workflow: {temp_workflow_path}")
-
-        # Set environment with user_id
-        env = os.environ.copy()
-        env['user_id'] = str(user_id)
-
-        # Run generation
-        main_py_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
-        result = subprocess.run(
-            ["python3", main_py_path, "manual", "--character", selected_character],
-            input=prompt,
-            text=True,
-            capture_output=True,
-            check=True,
-            env=env
-        )
-
-        return jsonify({"success": True})
+        return submit_generation_job(selected_character, "manual", user_prompt=prompt, save_to_latest=False)
 
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Process error: {e.stderr}"
-        print(f"Error in subprocess: {error_msg}")
-        return jsonify({"error": error_msg}), 400
     except Exception as e:
         error_msg = f"Unexpected error: {str(e)}"
         print(f"Error in regenerate_image: {error_msg}")
@@ -938,7 +1114,7 @@ def regenerate_image():
 @app.route('/manual_generation', methods=['POST'])
 @login_required
 def manual_generation():
-    """Handle manual prompt generation with permission checks."""
+    """Queue a manual prompt generation job with permission checks."""
     try:
         manual_prompt = request.form.get('manual_prompt')
         selected_character = request.form.get('character')
@@ -949,38 +1125,13 @@ def manual_generation():
 
         # Permission check
         user = User.query.get(user_id)
-        if not user.is_admin:
-            permissions = user.get_character_permissions()
-            if selected_character not in permissions or not permissions[selected_character]['can_generate']:
-                return jsonify({"error": "Access denied for this character"}), 403
+        if not permission_cache.acl(user.id).can_generate(selected_character):
+            return jsonify({"error": "Access denied for this character"}), 403
 
         session['selected_character'] = selected_character
 
-        # Save the prompt
-        if not save_prompt(manual_prompt, user_id):
-            return jsonify({"error": "Failed to save prompt"}), 500
-
-        # Set environment with user_id
-        env = os.environ.copy()
-        env['user_id'] = str(user_id)
-
-        # Run generation
-        main_py_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
-        result = subprocess.run(
-            ["python3", main_py_path, "manual", "--character", selected_character],
-            input=manual_prompt,
-            text=True,
-            capture_output=True,
-            check=True,
-            env=env
-        )
-
-        return jsonify({"success": True})
+        return submit_generation_job(selected_character, "manual", user_prompt=manual_prompt)
 
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Process error: {e.stderr}"
-        print(f"Error in subprocess: {error_msg}")
-        return jsonify({"error": error_msg}), 400
     except Exception as e:
         error_msg = f"Unexpected error: {str(e)}"
         print(f"Error in manual_generation: {error_msg}")
@@ -992,7 +1143,7 @@ def manual_generation():
 @app.route('/enhanced_generation', methods=['POST'])
 @login_required
 def enhanced_generation():
-    """Handle enhanced prompt generation with permission checks."""
+    """Queue an enhanced prompt generation job with permission checks."""
     try:
         manual_prompt = request.form.get('manual_prompt')
         selected_character = request.form.get('character')
@@ -1003,51 +1154,13 @@ def enhanced_generation():
 
         # Permission check
         user = User.query.get(user_id)
-        if not user.is_admin:
-            permissions = user.get_character_permissions()
-            if selected_character not in permissions or not permissions[selected_character]['can_generate']:
-                return jsonify({"error": "Access denied for this character"}), 403
+        if not permission_cache.acl(user.id).can_generate(selected_character):
+            return jsonify({"error": "Access denied for this character"}), 403
 
         session['selected_character'] = selected_character
 
-        # Update workflow options before generating
-        try:
-            advanced_options = request.form.get('advancedOptions')
-            if advanced_options:
-                advanced_options = json.loads(advanced_options)
-                update_workflow_options_sync(selected_character, advanced_options)
-        except Exception as e:
-            print(f"Error updating workflow options: {e}", file=sys.stderr)
-            return jsonify({"error": f"Error updating workflow options: {str(e)}"}), 400
-
-        # Set environment with user_id
-        env = os.environ.copy()
-        env['user_id'] = str(user_id)
-
-        # Run generation
-        main_py_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
-        result = subprocess.run(
-            ["python3", main_py_path, "enhanced", "--character", selected_character],
-            input=manual_prompt,
-            text=True,
-            capture_output=True,
-            check=True,
-            env=env
-        )
+        return submit_generation_job(selected_character, "enhanced", user_prompt=manual_prompt)
 
-        # Extract prompt from the output (last non-empty line)
-        output_lines = [line.strip() for line in result.stdout.split('\n') if line.strip()]
-        if output_lines:
-            prompt = output_lines[-1]
-            if not save_prompt(prompt, user_id):
-                return jsonify({"error": "Failed to save prompt"}), 500
-
-        return jsonify({"success": True})
-
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Process error: {e.stderr}"
-        print(f"Error in subprocess: {error_msg}")
-        return jsonify({"error": error_msg}), 400
     except Exception as e:
         error_msg = f"Unexpected error: {str(e)}"
         print(f"Error in enhanced_generation: {error_msg}")
@@ -0,0 +1,148 @@
+"""
+Write-behind audit log for login attempts.
+
+Logging an attempt used to be its own commit, and so its own fsync, on the
+request thread. Attempts are now queued in memory and written by a
+background thread in batched transactions, every flush_interval seconds or
+as soon as batch_size of them are waiting, and once more at shutdown. A
+full queue is flushed by the caller, so bursts slow down instead of losing
+events.
+
+The same thread rolls attempts older than retention_days into per-hour
+success/failure counts in login_attempts_hourly and deletes them.
+"""
+import sys
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from config.config_utils import config
+from database.models import db, LoginAttempt, LoginAttemptHourly
+
+HOUR_FORMAT = '%Y-%m-%d %H:00:00'
+
+
+class AuditLog:
+    """Queues LoginAttempt rows and writes them in batches."""
+
+    def __init__(self, flush_interval=None, batch_size=None, max_queued=None, retention_days=None,
+                 rollup_interval=None):
+        self.flush_interval = flush_interval or config.get('audit', 'flush_interval', default=2)
+        self.batch_size = batch_size or config.get('audit', 'batch_size', default=100)
+        self.retention_days = retention_days or config.get('audit', 'retention_days', default=30)
+        self.rollup_interval = rollup_interval or config.get('audit', 'rollup_interval', default=3600)
+        self._queue = queue.Queue(maxsize=max_queued or config.get('audit', 'max_queued', default=10000))
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.app = None
+
+    def init_app(self, app):
+        """Start the background writer; pending attempts are written at interpreter exit."""
+        self.app = app
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+            self._thread.start()
+            atexit.register(self.shutdown)
+
+    def record(self, username, success, ip_address, reason=None):
+        """Queue a login attempt; without a running writer it is written straight away."""
+        row = {'username': username, 'success': success, 'ip_address': ip_address, 'reason': reason,
+               'timestamp': datetime.utcnow()}
+        if self._thread is None:
+            self._write([row])
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(row)
+                break
+            except queue.Full:
+                self.flush()
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """Write every queued attempt in one transaction; returns how many were written."""
+        with self._flush_lock:
+            rows = []
+            while True:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if rows:
+                with self.app.app_context():
+                    self._write(rows)
+            return len(rows)
+
+    @staticmethod
+    def _write(rows):
+        try:
+            db.session.execute(LoginAttempt.__table__.insert(), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error writing {len(rows)} login attempts: {e}", file=sys.stderr)
+
+    def _run(self):
+        last_rollup = None
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+            if last_rollup is None or time.monotonic() - last_rollup >= self.rollup_interval:
+                last_rollup = time.monotonic()
+                try:
+                    with self.app.app_context():
+                        self.rollup()
+                except Exception as e:
+                    print(f"Error rolling up login attempts: {e}", file=sys.stderr)
+
+    def rollup(self):
+        """Fold attempts older than retention_days into hourly counts and delete them; needs an app context."""
+        # Whole hours only, so an hour's attempts are never split across two rollups
+        cutoff = (datetime.utcnow() - timedelta(days=self.retention_days)).replace(minute=0, second=0,
+                                                                                   microsecond=0)
+        hour = func.strftime(HOUR_FORMAT, LoginAttempt.timestamp)
+        grouped = db.session.query(hour, LoginAttempt.success, func.count(LoginAttempt.id)) \
+            .filter(LoginAttempt.timestamp < cutoff) \
+            .group_by(hour, LoginAttempt.success) \
+            .all()
+        if not grouped:
+            return
+
+        rows = [{'hour': datetime.strptime(hour_value, '%Y-%m-%d %H:%M:%S'), 'success': success, 'attempts': count}
+                for hour_value, success, count in grouped]
+        try:
+            statement = insert(LoginAttemptHourly)
+            statement = statement.on_conflict_do_update(
+                index_elements=['hour', 'success'],
+                set_={'attempts': LoginAttemptHourly.attempts + statement.excluded.attempts}
+            )
+            db.session.execute(statement, rows)
+            LoginAttempt.query.filter(LoginAttempt.timestamp < cutoff).delete(synchronize_session=False)
+            db.session.commit()
+            print(f"Audit log: rolled {sum(row['attempts'] for row in rows)} login attempts into hourly counts")
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def shutdown(self):
+        """Stop the writer and write whatever is still queued."""
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+
+# Global audit log instance
+audit_log = AuditLog()
@@ -0,0 +1,94 @@
+"""
+Password hashing off the request thread.
+
+A bcrypt hash takes a few hundred milliseconds of CPU. Hashing and
+checking run on a small dedicated pool of OS threads, at most
+security.bcrypt_workers at a time, while the request waits on the result.
+bcrypt releases the GIL, so other requests keep being served meanwhile.
+Under gevent the pool is a gevent ThreadPool, so only the logging-in
+greenlet waits and the hub keeps running everyone else's.
+
+The work factor comes from security.bcrypt_rounds; needs_rehash tells
+whether a stored hash was made with a different one.
+"""
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from config.config_utils import config
+
+ROUNDS = config.get('security', 'bcrypt_rounds', default=12)
+WORKERS = config.get('security', 'bcrypt_workers', default=2)
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class HashingPool:
+    """Runs bcrypt calls on at most `workers` OS threads."""
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        # Created on first use, so it belongs to the worker process (and hub) that uses it
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    if _gevent_patched():
+                        from gevent.threadpool import ThreadPool
+                        self._pool = ThreadPool(self.workers)
+                    else:
+                        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+        return self._pool
+
+    def run(self, func, *args):
+        pool = self._get_pool()
+        if isinstance(pool, ThreadPoolExecutor):
+            return pool.submit(func, *args).result()
+        return pool.spawn(func, *args).get()
+
+
+# Global password hashing pool instance
+hashing_pool = HashingPool()
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+def hash_password(password, rounds=None):
+    """Return the bcrypt hash of password at the configured work factor."""
+    salt = bcrypt.gensalt(rounds or ROUNDS)
+    return hashing_pool.run(bcrypt.hashpw, password.encode('utf-8'), salt)
+
+
+def verify_password(password, stored_hash):
+    """Check password against a stored bcrypt hash; False if the hash is unusable."""
+    try:
+        return hashing_pool.run(bcrypt.checkpw, password.encode('utf-8'), _to_bytes(stored_hash))
+    except Exception as e:
+        print(f"Error checking password: {str(e)}", file=sys.stderr)
+        return False
+
+
+def hash_rounds(stored_hash):
+    """The work factor a bcrypt hash ($2b$<rounds>$...) was made with, or None."""
+    try:
+        return int(_to_bytes(stored_hash).split(b'$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def needs_rehash(stored_hash):
+    """Whether stored_hash was made with a work factor other than security.bcrypt_rounds."""
+    return hash_rounds(stored_hash) != ROUNDS
@@ -0,0 +1,127 @@
+"""
+Character permission cache.
+
+Each user's role and character permissions are compiled once into a
+CharacterACL, memoized on flask.g for the rest of the request and cached
+for the whole process. Cached ACLs are tagged with the permission version
+stored in the database, which the admin endpoints bump in the same
+transaction as any permission or role change. Each process re-reads the
+version at most once every version_ttl seconds and drops its ACLs when it
+has moved, so a gallery page full of thumbnails costs no queries at all.
+"""
+import time
+import threading
+from datetime import datetime
+
+from flask import g
+from sqlalchemy.dialects.sqlite import insert
+
+from config.config_utils import config
+from database.models import db, CharacterPermission, PermissionVersion, User
+
+# ACLs kept per process before the cache is emptied and refilled
+MAX_ENTRIES = 1024
+# Seconds a process trusts the permission version it last read
+VERSION_TTL = config.get('security', 'permission_version_ttl', default=1)
+
+
+class CharacterACL:
+    """The characters one user may browse and generate."""
+
+    __slots__ = ('is_admin', 'browse', 'generate')
+
+    def __init__(self, is_admin=False, browse=(), generate=()):
+        self.is_admin = is_admin
+        self.browse = frozenset(browse)
+        self.generate = frozenset(generate)
+
+    @classmethod
+    def load(cls, user_id):
+        role = db.session.query(User.role).filter_by(id=user_id).scalar()
+        if role == 'admin':
+            return ADMIN_ACL
+        rows = db.session.query(CharacterPermission.character_name,
+                                CharacterPermission.can_browse,
+                                CharacterPermission.can_generate) \
+            .filter_by(user_id=user_id) \
+            .all()
+        return cls(browse=[name for name, can_browse, _ in rows if can_browse],
+                   generate=[name for name, _, can_generate in rows if can_generate])
+
+    def can_browse(self, character_name):
+        return self.is_admin or character_name in self.browse
+
+    def can_generate(self, character_name):
+        return self.is_admin or character_name in self.generate
+
+
+ADMIN_ACL = CharacterACL(is_admin=True)
+
+
+class PermissionCache:
+    """Process-wide CharacterACLs, invalidated by the permission version in the database."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, version_ttl=VERSION_TTL):
+        self.max_entries = max_entries
+        self.version_ttl = version_ttl
+        self._acls = {}
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _refresh_version(self):
+        """Re-read the permission version if it is older than version_ttl, dropping ACLs if it moved."""
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.version_ttl:
+                return self._version
+        version = db.session.query(PermissionVersion.version).filter_by(id=1).scalar() or 0
+        with self._lock:
+            if version != self._version:
+                self._acls.clear()
+                self._version = version
+            self._checked_at = now
+            return version
+
+    def acl(self, user_id):
+        """Return the CharacterACL of a user id; needs an app context."""
+        acls = g.setdefault('character_acls', {})
+        acl = acls.get(user_id)
+        if acl is None:
+            acl = acls[user_id] = self._shared(user_id)
+        return acl
+
+    def _shared(self, user_id):
+        version = self._refresh_version()
+        with self._lock:
+            acl = self._acls.get(user_id)
+        if acl is not None:
+            return acl
+
+        acl = CharacterACL.load(user_id)
+        with self._lock:
+            if version == self._version:
+                if len(self._acls) >= self.max_entries:
+                    self._acls.clear()
+                self._acls[user_id] = acl
+        return acl
+
+    def bump_version(self):
+        """Invalidate the cached permissions of every process; the caller commits."""
+        statement = insert(PermissionVersion).values(id=1, version=1, updated_at=datetime.utcnow())
+        statement = statement.on_conflict_do_update(
+            index_elements=['id'],
+            set_={
+                'version': PermissionVersion.version + 1,
+                'updated_at': statement.excluded.updated_at
+            }
+        )
+        db.session.execute(statement)
+        # This process sees the change at once; others within version_ttl
+        with self._lock:
+            self._checked_at = None
+        g.pop('character_acls', None)
+
+
+# Global permission cache instance
+permission_cache = PermissionCache()
@@ -0,0 +1,119 @@
+"""
+Login rate limiting.
+
+Failed logins are tracked per (username, IP) in a sliding window of
+security.lockout_time seconds; security.max_login_attempts failures inside
+the window lock that pair out until the oldest of them falls out of it.
+Only the newest max_attempts failures of each pair are ever kept, so a
+check costs the same however much login history there is.
+
+The default memory backend is private to the process. With several
+workers, set security.rate_limit_backend to 'database' to share failures
+through the login_failures table instead.
+"""
+import sys
+import time
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from config.config_utils import config
+from database.models import db, LoginFailure
+
+
+def _max_attempts():
+    return config.get('security', 'max_login_attempts', default=5)
+
+
+def _window():
+    return config.get('security', 'lockout_time', default=300)
+
+
+class MemoryBackend:
+    """Failure timestamps of each (username, ip) in this process."""
+
+    def __init__(self):
+        self._failures = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def locked(self, key, max_attempts, window):
+        with self._lock:
+            failures = self._failures.get(key)
+            return (failures is not None and len(failures) >= max_attempts
+                    and failures[-max_attempts] > time.monotonic() - window)
+
+    def record_failure(self, key, max_attempts, window):
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.get(key)
+            if failures is None or failures.maxlen != max_attempts:
+                failures = self._failures[key] = deque(failures or (), maxlen=max_attempts)
+            failures.append(now)
+
+            # Forget pairs whose failures have all expired, at most once per window
+            if now - self._last_sweep > window:
+                self._failures = {k: v for k, v in self._failures.items() if v[-1] > now - window}
+                self._last_sweep = now
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+
+class DatabaseBackend:
+    """Failures shared by every worker through the login_failures table; needs an app context."""
+
+    def locked(self, key, max_attempts, window):
+        username, ip_address = key
+        # The max_attempts-th newest failure, found by an index seek
+        nth_newest = db.session.query(LoginFailure.timestamp) \
+            .filter_by(username=username, ip_address=ip_address) \
+            .order_by(LoginFailure.timestamp.desc()) \
+            .offset(max_attempts - 1) \
+            .limit(1) \
+            .scalar()
+        return nth_newest is not None and nth_newest > datetime.utcnow() - timedelta(seconds=window)
+
+    def record_failure(self, key, max_attempts, window):
+        username, ip_address = key
+        db.session.add(LoginFailure(username=username, ip_address=ip_address))
+        # Older failures can't affect a lockout any more
+        cutoff = datetime.utcnow() - timedelta(seconds=window)
+        LoginFailure.query.filter(LoginFailure.timestamp <= cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+    def reset(self, key):
+        username, ip_address = key
+        LoginFailure.query.filter_by(username=username, ip_address=ip_address).delete(synchronize_session=False)
+        db.session.commit()
+
+
+BACKENDS = {'memory': MemoryBackend, 'database': DatabaseBackend}
+
+
+class LoginRateLimiter:
+    """Sliding-window lockout of (username, ip) pairs after repeated failed logins."""
+
+    def __init__(self, backend=None):
+        backend = backend or config.get('security', 'rate_limit_backend', default='memory')
+        if backend not in BACKENDS:
+            print(f"Unknown rate_limit_backend '{backend}', using memory", file=sys.stderr)
+            backend = 'memory'
+        self.backend = BACKENDS[backend]()
+
+    def is_locked(self, username, ip_address, max_attempts=None, lockout_time=None):
+        """Check if username/ip_address has too many recent failed logins."""
+        return self.backend.locked((username, ip_address), max_attempts or _max_attempts(),
+                                   lockout_time or _window())
+
+    def record(self, username, ip_address, success):
+        """Count a login attempt; a successful one clears the pair's failures."""
+        if success:
+            self.backend.reset((username, ip_address))
+        else:
+            self.backend.record_failure((username, ip_address), _max_attempts(), _window())
+
+
+# Global login rate limiter instance
+login_limiter = LoginRateLimiter()
@@ -2,7 +2,7 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from database.models import User, db, PasswordResetRequest
 from .utils import (
     login_required, admin_required, is_safe_url, validate_password,
-    log_login_attempt, check_login_attempts, send_reset_email
+    log_login_attempt, check_login_attempts, send_reset_email, LOCKED
 )
 from config.config_utils import config
 from datetime import datetime, timedelta
@@ -21,6 +21,11 @@ def login():
         password = request.form['password']
         ip_address = request.remote_addr
 
+        if check_login_attempts(username, ip_address):
+            log_login_attempt(username, False, ip_address, reason=LOCKED)
+            flash('Too many failed login attempts. Please try again later.', 'error')
+            return render_template('auth/login.html'), 429
+
         user = User.query.filter_by(username=username).first()
 
         if user and user.check_password(password):
@@ -48,6 +53,9 @@ def login():
             session.modified = True
 
             user.last_login = db.func.now()
+            # Upgrade the hash to the configured work factor while we have the password
+            if user.password_needs_rehash():
+                user.set_password(password)
             db.session.commit()
 
             log_login_attempt(username, True, ip_address)
@@ -1,18 +1,24 @@
 import functools
+import logging
 from flask import session, redirect, url_for, request, current_app
-from datetime import datetime, timedelta
-from database.models import User, LoginAttempt, db
+from database.models import User
+from auth.rate_limit import login_limiter
+from auth.audit import audit_log
 import re
 
+logger = logging.getLogger(__name__)
+
+# Reason recorded for attempts refused because the username/IP pair is locked out
+LOCKED = 'locked'
+
 def login_required(view):
     """Decorator to require login for views."""
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        print(f"Checking login requirement. Session: {session}")  # Debug log
         if 'user_id' not in session:
-            print("No user_id in session, redirecting to login")  # Debug log
+            logger.debug(f"No user_id in session for {request.path}, redirecting to login")
             return redirect(url_for('auth.login', next=request.url))
-        print(f"User {session['user_id']} is logged in")  # Debug log
+        logger.debug(f"User {session['user_id']} is logged in")
         return view(**kwargs)
     return wrapped_view
 
@@ -60,27 +66,21 @@ def validate_password(password):
     
     return True, ""
 
-def log_login_attempt(username, success, ip_address):
-    """Log login attempts for security monitoring."""
-    attempt = LoginAttempt(
-        username=username,
-        success=success,
-        ip_address=ip_address
-    )
-    db.session.add(attempt)
-    db.session.commit()
+def log_login_attempt(username, success, ip_address, reason=None):
+    """
+    Log login attempts for security monitoring; they reach the database in batches.
+    Attempts refused during a lockout (reason LOCKED) are logged without extending it.
+    """
+    audit_log.record(username, success, ip_address, reason)
+    if reason != LOCKED:
+        login_limiter.record(username, ip_address, success)
 
-def check_login_attempts(username, ip_address, max_attempts=5, lockout_time=300):
-    """Check if user/IP is temporarily locked out due to failed attempts."""
-    cutoff_time = datetime.utcnow() - timedelta(seconds=lockout_time)
-    recent_attempts = LoginAttempt.query.filter(
-        LoginAttempt.username == username,
-        LoginAttempt.ip_address == ip_address,
-        LoginAttempt.success == False,
-        LoginAttempt.timestamp > cutoff_time
-    ).count()
-    
-    return recent_attempts >= max_attempts
+def check_login_attempts(username, ip_address, max_attempts=None, lockout_time=None):
+    """
+    Check if user/IP is temporarily locked out due to failed attempts.
+    Limits default to security.max_login_attempts and lockout_time.
+    """
+    return login_limiter.is_locked(username, ip_address, max_attempts, lockout_time)
 
 def send_reset_email(email, reset_url):
     """
@@ -0,0 +1,110 @@
+"""
+Character registry.
+
+characters.yaml is parsed and validated once into a read-only mapping that
+the routes, the generation pipeline and the CLI all share, instead of each
+loading the file itself. Every access stats the file and re-parses it only
+after it changed on disk, so edits apply without a restart.
+"""
+import os
+import sys
+import threading
+from types import MappingProxyType
+from collections.abc import Mapping
+
+import yaml
+
+CHARACTERS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'characters.yaml')
+
+
+def _freeze(value):
+    """Return a read-only copy of a parsed YAML value."""
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class CharacterRegistry:
+    """
+    Parsed characters.yaml, shared by the whole process.
+
+    The file is validated once and kept as an immutable mapping. Each access
+    stats the file and re-parses it only when its inode, mtime or size has
+    changed; a reload that fails keeps serving the previous characters.
+    """
+
+    def __init__(self, path=CHARACTERS_PATH):
+        self.path = path
+        self._characters = MappingProxyType({})
+        self._signature = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _stat_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def reload(self, force=False):
+        """Re-read the file if it changed since the last load (or always, with force)."""
+        signature = self._stat_signature()
+        if not force and signature == self._signature:
+            return self._characters
+
+        with self._lock:
+            if not force and signature == self._signature:
+                return self._characters
+
+            if signature is None:
+                print(f"Characters file not found at {self.path}", file=sys.stderr)
+                self._characters, self._signature = MappingProxyType({}), None
+                return self._characters
+
+            try:
+                with open(self.path, 'r') as file:
+                    data = yaml.safe_load(file) or {}
+                characters = self._validate(data)
+            except (OSError, yaml.YAMLError, ValueError) as e:
+                print(f"Error loading characters file, keeping previous characters: {e}", file=sys.stderr)
+                self._signature = signature
+                return self._characters
+
+            # Swap in the new mapping in one step so readers never see a partial load
+            self._characters, self._signature = characters, signature
+            print(f"Loaded {len(characters)} characters from {self.path}")
+            return self._characters
+
+    def _validate(self, data):
+        if not isinstance(data, Mapping):
+            raise ValueError("characters.yaml must map character names to their settings")
+
+        characters = {}
+        for name, character in data.items():
+            if not isinstance(character, Mapping):
+                print(f"Skipping character '{name}': settings must be a mapping", file=sys.stderr)
+                continue
+            if not character.get('workflow_file'):
+                print(f"Warning: character '{name}' has no workflow_file", file=sys.stderr)
+            characters[str(name)] = _freeze(character)
+        return MappingProxyType(characters)
+
+    def all(self):
+        """Return the read-only mapping of character name to settings."""
+        return self.reload()
+
+    def get(self, name, default=None):
+        return self.all().get(name, default)
+
+    def names(self):
+        return list(self.all().keys())
+
+    def __contains__(self, name):
+        return name in self.all()
+
+
+# Global character registry instance
+character_registry = CharacterRegistry()
@@ -1,12 +1,12 @@
 from datetime import datetime, timedelta
 import sqlite3
 import os
-import bcrypt
+from auth.passwords import hash_password, verify_password, needs_rehash
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import SQLAlchemyError
 import secrets
 import sys  
-import yaml
+from config.character_registry import character_registry
 import json
 
 db = SQLAlchemy()
@@ -37,6 +37,73 @@ class UserLatestContent(db.Model):
 
     user = db.relationship('User', backref=db.backref('latest_content', lazy=True))
 
+class UserPreference(db.Model):
+    __tablename__ = 'user_preferences'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    live_previews = db.Column(db.Boolean, nullable=False, default=True)
+
+    user = db.relationship('User', backref=db.backref('preferences', uselist=False, cascade='all, delete-orphan'))
+
+    @classmethod
+    def for_user(cls, user_id):
+        """Get a user's preferences, falling back to defaults if none are saved."""
+        return cls.query.get(user_id) or cls(user_id=user_id, live_previews=True)
+
+class GeneratedImage(db.Model):
+    __tablename__ = 'images'
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(512), unique=True, nullable=False)  # Relative to images/
+    folder = db.Column(db.String(512), nullable=False, default='')
+    character = db.Column(db.String(255), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    modified_ns = db.Column(db.BigInteger, nullable=False, default=0)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    seed = db.Column(db.BigInteger, nullable=True)
+    checkpoint = db.Column(db.String(255), nullable=True)
+    prompt = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_images_folder', 'folder', 'path'),
+        # Keyset pagination of a folder by date or size
+        db.Index('idx_images_folder_created', 'folder', 'created_at', 'path'),
+        db.Index('idx_images_folder_size', 'folder', 'size', 'path'),
+        db.Index('idx_images_seed', 'seed'),
+        db.Index('idx_images_character', 'character', 'created_at'),
+        db.Index('idx_images_user', 'user_id', 'created_at'),
+    )
+
+
+class StorageCounter(db.Model):
+    __tablename__ = 'storage_counters'
+
+    scope = db.Column(db.String(20), primary_key=True)  # 'total', 'character' or 'user'
+    key = db.Column(db.String(255), primary_key=True)   # Character name or user id; '' for the total
+    files = db.Column(db.Integer, nullable=False, default=0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class TaskLease(db.Model):
+    __tablename__ = 'task_leases'
+
+    name = db.Column(db.String(50), primary_key=True)    # Task the lease is for, e.g. 'image-index'
+    holder = db.Column(db.String(255), nullable=False)   # host:pid of the process holding it
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class PermissionVersion(db.Model):
+    __tablename__ = 'permission_versions'
+
+    id = db.Column(db.Integer, primary_key=True)  # Single row, id 1
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
 class DefaultModelPermission(db.Model):
     __tablename__ = 'default_model_permissions'
 
@@ -116,22 +183,15 @@ class User(db.Model):
 
     def set_password(self, password):
         """Hash the password before storing."""
-        salt = bcrypt.gensalt()
-        self.password_hash = bcrypt.hashpw(password.encode('utf-8'), salt)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
         """Verify the password."""
-        try:
-            stored_hash = self.password_hash
-            if isinstance(stored_hash, str):
-                stored_hash = stored_hash.encode('utf-8')
-
-            password_bytes = password.encode('utf-8')
-            result = bcrypt.checkpw(password_bytes, stored_hash)
-            return result
-        except Exception as e:
-            print(f"Error checking password: {str(e)}")
-            return False
+        return verify_password(password, self.password_hash)
+
+    def password_needs_rehash(self):
+        """Check if the stored hash uses a different bcrypt work factor than configured."""
+        return needs_rehash(self.password_hash)
 
     def generate_reset_token(self):
         """Generate a password reset token."""
@@ -207,8 +267,35 @@ class LoginAttempt(db.Model):
     username = db.Column(db.String(80), nullable=False)
     ip_address = db.Column(db.String(45), nullable=False)
     success = db.Column(db.Boolean, nullable=False)
+    reason = db.Column(db.String(20))  # Why a failed attempt was refused, e.g. 'locked'; None if unspecified
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('idx_login_attempts_timestamp', 'timestamp'),
+    )
+
+
+class LoginAttemptHourly(db.Model):
+    __tablename__ = 'login_attempts_hourly'
+
+    hour = db.Column(db.DateTime, primary_key=True)  # Start of the hour, UTC
+    success = db.Column(db.Boolean, primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+
+class LoginFailure(db.Model):
+    __tablename__ = 'login_failures'
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), nullable=False)
+    ip_address = db.Column(db.String(45), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_login_failures_key', 'username', 'ip_address', 'timestamp'),
+        db.Index('idx_login_failures_timestamp', 'timestamp'),
+    )
+
 
 class PasswordResetRequest(db.Model):
     __tablename__ = 'password_reset_requests'
@@ -258,10 +345,7 @@ def extract_models_from_workflow(workflow_data):
 def grant_default_model_permissions(user_id, admin_id):
     """Grant permissions for all models used in default character workflows."""
     try:
-        # Load characters configuration
-        config_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'characters.yaml')
-        with open(config_path, 'r') as f:
-            characters = yaml.safe_load(f)
+        characters = character_registry.all()
 
         required_models = {
             'checkpoints': set(),
@@ -350,7 +434,10 @@ def init_db(app):
 
             # Check for new tables
             required_tables = ['model_permissions', 'default_model_permissions', 
-                             'character_permissions', 'default_character_permissions']
+                             'character_permissions', 'default_character_permissions',
+                             'user_preferences', 'images', 'storage_counters',
+                             'permission_versions', 'login_failures', 'login_attempts_hourly',
+                             'task_leases']
             for table in required_tables:
                 if table not in tables:
                     print(f"Creating new table: {table}")
@@ -362,6 +449,30 @@ def init_db(app):
                         CharacterPermission.__table__.create(db.engine)
                     elif table == 'default_character_permissions':
                         DefaultCharacterPermission.__table__.create(db.engine)
+                    elif table == 'user_preferences':
+                        UserPreference.__table__.create(db.engine)
+                    elif table == 'images':
+                        GeneratedImage.__table__.create(db.engine)
+                    elif table == 'storage_counters':
+                        StorageCounter.__table__.create(db.engine)
+                    elif table == 'permission_versions':
+                        PermissionVersion.__table__.create(db.engine)
+                    elif table == 'login_failures':
+                        LoginFailure.__table__.create(db.engine)
+                    elif table == 'login_attempts_hourly':
+                        LoginAttemptHourly.__table__.create(db.engine)
+                    elif table == 'task_leases':
+                        TaskLease.__table__.create(db.engine)
+
+            # create_all doesn't add columns to tables that already exist either
+            if 'reason' not in {column['name'] for column in inspector.get_columns('login_attempts')}:
+                print("Adding column login_attempts.reason")
+                with db.engine.begin() as connection:
+                    connection.execute(db.text("ALTER TABLE login_attempts ADD COLUMN reason VARCHAR(20)"))
+
+            # create_all doesn't add indexes to tables that already exist
+            for index in GeneratedImage.__table__.indexes | LoginAttempt.__table__.indexes:
+                index.create(db.engine, checkfirst=True)
 
             db.session.commit()
             print("Database schema updated successfully")
\ No newline at end of file
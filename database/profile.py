@@ -0,0 +1,108 @@
+"""
+SQLite connection profile.
+
+With SQLite's defaults every write locks readers out of the database, and a
+second writer fails with "database is locked" straight away. Each connection
+is set up with the pragmas from the database: section of app_config.yaml:
+WAL journaling so readers never wait for a writer, a busy timeout so writers
+queue instead of failing, and memory-mapped I/O and a larger page cache for
+the browse queries. Listings and stats read through a separate query-only
+engine with its own connection pool, so they never wait for a connection
+held by a generation's write.
+"""
+import os
+from contextlib import contextmanager
+
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from config.config_utils import config
+from database.models import db
+
+READONLY_BIND = 'readonly'
+DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.db')
+
+# PRAGMA name and the config key (with its default) it is set from
+PRAGMAS = (
+    ('journal_mode', 'journal_mode', 'wal'),
+    ('synchronous', 'synchronous', 'normal'),
+    ('busy_timeout', 'busy_timeout', 5000),   # milliseconds
+    ('mmap_size', 'mmap_size', 268435456),    # bytes
+    ('cache_size', 'cache_size', -65536),     # negative values are KiB
+)
+
+
+def _setting(key, default):
+    return config.get('database', key, default=default)
+
+
+def engine_options(readonly=False):
+    """SQLAlchemy engine options for the read-write engine, or the query-only one."""
+    prefix = 'readonly_' if readonly else ''
+    return {
+        'pool_size': _setting(prefix + 'pool_size', 10),
+        'max_overflow': _setting(prefix + 'max_overflow', 10),
+        'pool_timeout': _setting('pool_timeout', 30),
+        'connect_args': {
+            # sqlite3's own lock wait, in seconds; matches busy_timeout
+            'timeout': _setting('busy_timeout', 5000) / 1000,
+            'check_same_thread': False,
+        },
+    }
+
+
+def configure(app, db_path):
+    """Point app at db_path with the configured pools and a query-only bind; call before db.init_app."""
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+    app.config['SQLALCHEMY_BINDS'] = {
+        READONLY_BIND: dict(engine_options(readonly=True), url=f'sqlite:///{db_path}'),
+    }
+
+
+def _apply_pragmas(readonly):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, key, default in PRAGMAS:
+                value = _setting(key, default)
+                if value is not None:
+                    cursor.execute(f"PRAGMA {pragma}={value}")
+            if readonly:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+    return on_connect
+
+
+def install(app):
+    """Set the pragmas on every new connection of app's engines; call right after db.init_app."""
+    with app.app_context():
+        for bind_key, engine in db.engines.items():
+            event.listen(engine, 'connect', _apply_pragmas(bind_key == READONLY_BIND))
+
+
+def standalone_app(db_path=DATABASE_PATH):
+    """A bare Flask app on the database, for scripts (such as main.py) that run outside the web app."""
+    app = Flask(__name__)
+    configure(app, db_path)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    install(app)
+    return app
+
+
+@contextmanager
+def read_session():
+    """
+    Yield a session on the query-only engine for listing and stats queries.
+    Objects it loads stay readable after the block but are detached.
+    Needs an app context.
+    """
+    engine = db.engines.get(READONLY_BIND, db.engine)
+    session = Session(engine)
+    try:
+        yield session
+    finally:
+        session.close()
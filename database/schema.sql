@@ -20,6 +20,23 @@ CREATE TABLE IF NOT EXISTS login_attempts (
     username VARCHAR(80) NOT NULL,
     ip_address VARCHAR(45) NOT NULL,
     success BOOLEAN NOT NULL,
+    reason VARCHAR(20),  -- why a failed attempt was refused, e.g. 'locked'
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Login attempts older than the audit retention, counted per hour
+CREATE TABLE IF NOT EXISTS login_attempts_hourly (
+    hour TIMESTAMP NOT NULL,  -- start of the hour, UTC
+    success BOOLEAN NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, success)
+);
+
+-- Recent failed logins, when the login rate limiter shares them between workers
+CREATE TABLE IF NOT EXISTS login_failures (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR(80) NOT NULL,
+    ip_address VARCHAR(45) NOT NULL,
     timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -77,12 +94,69 @@ CREATE TABLE IF NOT EXISTS user_latest_content (
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+CREATE TABLE IF NOT EXISTS user_preferences (
+    user_id INTEGER PRIMARY KEY,
+    live_previews BOOLEAN NOT NULL DEFAULT 1,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- Index of generated images under images/
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path VARCHAR(512) UNIQUE NOT NULL,  -- relative to images/
+    folder VARCHAR(512) NOT NULL DEFAULT '',
+    character VARCHAR(255),
+    user_id INTEGER,
+    size BIGINT NOT NULL DEFAULT 0,
+    modified_ns BIGINT NOT NULL DEFAULT 0,
+    width INTEGER,
+    height INTEGER,
+    seed BIGINT,
+    checkpoint VARCHAR(255),
+    prompt TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+);
+
+-- Running file and byte counts of the images table, per character and per user
+CREATE TABLE IF NOT EXISTS storage_counters (
+    scope VARCHAR(20) NOT NULL,  -- 'total', 'character' or 'user'
+    key VARCHAR(255) NOT NULL,   -- character name or user id; '' for the total
+    files INTEGER NOT NULL DEFAULT 0,
+    bytes BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (scope, key)
+);
+
+-- Which process runs a background task (such as the image index scan) until expires_at
+CREATE TABLE IF NOT EXISTS task_leases (
+    name VARCHAR(50) PRIMARY KEY,
+    holder VARCHAR(255) NOT NULL,  -- host:pid
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- Bumped whenever character permissions change, to invalidate cached permissions
+CREATE TABLE IF NOT EXISTS permission_versions (
+    id INTEGER PRIMARY KEY,  -- single row, id 1
+    version INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Create indexes
 CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
 CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
 CREATE INDEX IF NOT EXISTS idx_login_attempts_username ON login_attempts(username);
 CREATE INDEX IF NOT EXISTS idx_login_attempts_ip ON login_attempts(ip_address);
+CREATE INDEX IF NOT EXISTS idx_login_attempts_timestamp ON login_attempts(timestamp);
+CREATE INDEX IF NOT EXISTS idx_login_failures_key ON login_failures(username, ip_address, timestamp);
+CREATE INDEX IF NOT EXISTS idx_login_failures_timestamp ON login_failures(timestamp);
 CREATE INDEX IF NOT EXISTS idx_model_permissions_user ON model_permissions(user_id);
 CREATE INDEX IF NOT EXISTS idx_model_permissions_model ON model_permissions(model_type, model_name);
 CREATE INDEX IF NOT EXISTS idx_character_permissions_user ON character_permissions(user_id);
-CREATE INDEX IF NOT EXISTS idx_user_latest_content ON user_latest_content(user_id);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_user_latest_content ON user_latest_content(user_id);
+CREATE INDEX IF NOT EXISTS idx_images_folder ON images(folder, path);
+CREATE INDEX IF NOT EXISTS idx_images_character ON images(character, created_at);
+CREATE INDEX IF NOT EXISTS idx_images_user ON images(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_images_folder_created ON images(folder, created_at, path);
+CREATE INDEX IF NOT EXISTS idx_images_folder_size ON images(folder, size, path);
+CREATE INDEX IF NOT EXISTS idx_images_seed ON images(seed);
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""
+Thumbnails and previews for the image browser.
+
+Full-size renders are several MB each, so the browser shows small JPEG
+derivatives instead. They are rendered on a small worker pool when an image
+is saved, or the first time one is asked for, and cached on disk keyed by
+the source's full path and mtime, so a changed image gets fresh derivatives
+and old ones are never served. Requests never wait for a render.
+"""
+import os
+import re
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from config.config_utils import config
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES_FOLDER = os.path.join(BASE_DIR, 'images')
+CACHE_DIR = os.path.join(BASE_DIR, config.get('gallery', 'cache_dir', default='cache/derivatives'))
+
+# Longest side in pixels of each derivative kind
+SIZES = {
+    'thumb': config.get('gallery', 'thumbnail_size', default=320),
+    'preview': config.get('gallery', 'preview_size', default=1280),
+}
+QUALITY = config.get('gallery', 'quality', default=80)
+WORKERS = config.get('gallery', 'workers', default=2)
+
+
+class DerivativeCache:
+    """Renders and caches resized JPEG copies of the images under source_root."""
+
+    def __init__(self, source_root=IMAGES_FOLDER, cache_root=CACHE_DIR, sizes=None, quality=QUALITY,
+                 workers=WORKERS):
+        self.source_root = os.path.realpath(source_root)
+        self.cache_root = cache_root
+        self.sizes = dict(sizes or SIZES)
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='derivatives')
+        # Renders in flight, so concurrent requests for one image share a single render
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def source_path(self, rel_path):
+        """Resolve rel_path inside source_root; raises ValueError if it points outside it."""
+        path = os.path.realpath(os.path.join(self.source_root, rel_path))
+        if os.path.commonpath([self.source_root, path]) != self.source_root:
+            raise ValueError(f"Invalid image path: {rel_path}")
+        return path
+
+    def cache_path(self, rel_path, kind, mtime_ns):
+        # The source's extension stays in the name, so foo.png and foo.jpg don't share a derivative
+        return os.path.join(self.cache_root, kind, f"{os.path.normpath(rel_path)}.{mtime_ns}.jpg")
+
+    def lookup(self, rel_path, kind):
+        """
+        Return (cache_path, version) for a derivative; the file at cache_path
+        may not exist yet. Raises KeyError for an unknown kind, ValueError for
+        a bad path and OSError if the source image is missing.
+        """
+        if kind not in self.sizes:
+            raise KeyError(kind)
+        mtime_ns = os.stat(self.source_path(rel_path)).st_mtime_ns
+        return self.cache_path(rel_path, kind, mtime_ns), mtime_ns
+
+    def schedule(self, rel_path, kinds=None):
+        """Queue any missing derivatives of an image for rendering; returns their futures."""
+        futures = []
+        for kind in kinds or self.sizes:
+            try:
+                path, _ = self.lookup(rel_path, kind)
+            except (KeyError, ValueError, OSError) as e:
+                print(f"Cannot render {kind} for {rel_path}: {e}", file=sys.stderr)
+                continue
+            if os.path.exists(path):
+                continue
+
+            with self._lock:
+                future = self._pending.get(path)
+                if future is None:
+                    future = self._pending[path] = self._executor.submit(self._render, rel_path, kind, path)
+            futures.append(future)
+        return futures
+
+    def get(self, rel_path, kind):
+        """
+        Return the path of an up-to-date derivative, or None after queueing
+        its render if it isn't on disk yet; raises like lookup.
+        """
+        path, _ = self.lookup(rel_path, kind)
+        if os.path.exists(path):
+            return path
+        self.schedule(rel_path, (kind,))
+        return None
+
+    def _render(self, rel_path, kind, path):
+        try:
+            size = self.sizes[kind]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with Image.open(self.source_path(rel_path)) as image:
+                # Lets JPEG sources decode at a reduced scale
+                image.draft('RGB', (size, size))
+                image.thumbnail((size, size))
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-', suffix='.jpg')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        image.save(f, 'JPEG', quality=self.quality, optimize=True)
+                    os.chmod(temp_path, 0o644)
+                    os.replace(temp_path, path)
+                except BaseException:
+                    os.unlink(temp_path)
+                    raise
+
+            # The source changed since older versions were rendered
+            for old_path in self._versions(rel_path, kind):
+                if old_path != path:
+                    self._unlink(old_path)
+            return path
+        except Exception as e:
+            print(f"Error rendering {kind} for {rel_path}: {e}", file=sys.stderr)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(path, None)
+
+    def _versions(self, rel_path, kind):
+        """Yield the cached derivatives of rel_path for every mtime seen so far."""
+        rel_path = os.path.normpath(rel_path)
+        directory = os.path.join(self.cache_root, kind, os.path.dirname(rel_path))
+        pattern = re.compile(re.escape(os.path.basename(rel_path)) + r'\.\d+\.jpg')
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if pattern.fullmatch(name):
+                yield os.path.join(directory, name)
+
+    def remove(self, rel_path):
+        """Delete every cached derivative of an image, e.g. after the image itself is deleted."""
+        for kind in self.sizes:
+            for path in self._versions(rel_path, kind):
+                self._unlink(path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing derivative {path}: {e}", file=sys.stderr)
+
+
+# Global derivative cache instance
+derivatives = DerivativeCache()
@@ -0,0 +1,399 @@
+"""
+Database index of the images under images/.
+
+Every image gets a row in the images table, so the browser and the admin
+stats run indexed queries instead of walking the folders. Rows are written
+by save_images as images are saved, from the web app and the CLI alike, and
+removed when files are deleted. A background scan at startup, and every
+rescan_interval seconds, indexes images added some other way and drops rows
+for files that are gone. Only one process scans at a time: the scan takes
+the 'image-index' row of task_leases first, and keeps it until the next
+scan is due. Scanned files are parsed in parallel and only their PNG text
+chunks are read.
+"""
+import os
+import sys
+import json
+import base64
+import binascii
+import socket
+import time
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import has_app_context
+from PIL import Image
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Query
+
+from config.config_utils import config
+from database.models import db, GeneratedImage, TaskLease
+from database.profile import read_session
+from generate.png_metadata import read_png_info
+from gallery.derivatives import derivatives
+from gallery import storage
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES_FOLDER = os.path.join(BASE_DIR, 'images')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+SCAN_WORKERS = config.get('gallery', 'index_workers', default=4)
+RESCAN_INTERVAL = config.get('gallery', 'index_rescan_interval', default=3600)
+INSERT_BATCH_SIZE = 500  # Rows per statement when writing or deleting index rows
+SCAN_LEASE = 'image-index'
+SCAN_LEASE_TIMEOUT = 3600  # Seconds before a scan lease left by a crashed process is taken over
+PAGE_SIZE = 100
+# Listing sort orders and the column each one sorts on
+SORT_COLUMNS = {'name': 'path', 'date': 'created_at', 'size': 'size'}
+
+# Nodes whose widgets hold the seed in a saved UI workflow, and at which position
+SEED_WIDGETS = {'RandomNoise': 0, 'KSampler': 0, 'KSamplerAdvanced': 1}
+CHECKPOINT_NODES = ('CheckpointLoaderSimple', 'CheckpointLoader')
+
+
+def _workflow_settings(workflow_json):
+    """Pull the seed and checkpoint out of a UI workflow, for images saved without a charactergen chunk."""
+    seed = checkpoint = None
+    try:
+        nodes = json.loads(workflow_json).get('nodes', [])
+    except (ValueError, AttributeError):
+        return seed, checkpoint
+
+    for node in nodes:
+        widgets = node.get('widgets_values') or []
+        node_type = node.get('type')
+        if seed is None and node_type in SEED_WIDGETS and len(widgets) > SEED_WIDGETS[node_type]:
+            value = widgets[SEED_WIDGETS[node_type]]
+            seed = value if isinstance(value, int) else None
+        elif checkpoint is None and node_type in CHECKPOINT_NODES and widgets:
+            checkpoint = widgets[0] if isinstance(widgets[0], str) else None
+    return seed, checkpoint
+
+
+def encode_cursor(image, sort):
+    """Opaque cursor pointing just past image in a listing sorted by sort."""
+    value = getattr(image, SORT_COLUMNS[sort])
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    data = json.dumps([value, image.path]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """Return the (sort value, path) a cursor points past; raises ValueError if it's malformed."""
+    try:
+        value, path = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if sort == 'date':
+            value = datetime.fromisoformat(value)
+        elif sort == 'size' and not isinstance(value, int):
+            raise ValueError
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if not isinstance(path, str):
+        raise ValueError("Invalid cursor")
+    return value, path
+
+
+def image_row(rel_path, user_id=None, root=IMAGES_FOLDER):
+    """Build the images table row for a file; raises OSError if it can't be read."""
+    path = os.path.join(root, rel_path)
+    stat = os.stat(path)
+    folder = os.path.dirname(rel_path)
+    row = {
+        'path': rel_path,
+        'folder': folder,
+        # Character folders are named with underscores for spaces
+        'character': folder.split(os.sep)[0].replace('_', ' ') if folder else None,
+        'user_id': user_id,
+        'size': stat.st_size,
+        'modified_ns': stat.st_mtime_ns,
+        'width': None,
+        'height': None,
+        'seed': None,
+        'checkpoint': None,
+        'prompt': None,
+        'created_at': datetime.utcfromtimestamp(stat.st_mtime)
+    }
+
+    if not rel_path.lower().endswith('.png'):
+        try:
+            with Image.open(path) as image:
+                row['width'], row['height'] = image.size
+        except Exception:
+            pass
+        return row
+
+    try:
+        row['width'], row['height'], text = read_png_info(path)
+    except ValueError:
+        return row
+
+    prompt = text.get('prompt')
+    # ComfyUI's own images store the API workflow under 'prompt'; ours store the prompt text
+    if prompt and not prompt.lstrip().startswith('{'):
+        row['prompt'] = prompt
+
+    try:
+        info = json.loads(text['charactergen'])
+    except (KeyError, ValueError):
+        info = None
+    if isinstance(info, dict):
+        row['character'] = info.get('character') or row['character']
+        row['user_id'] = user_id if user_id is not None else info.get('user_id')
+        row['seed'] = info.get('seed')
+        row['checkpoint'] = info.get('checkpoint')
+        try:
+            row['created_at'] = datetime.fromisoformat(info['created_at'])
+        except (KeyError, TypeError, ValueError):
+            pass
+    elif 'workflow' in text:
+        row['seed'], row['checkpoint'] = _workflow_settings(text['workflow'])
+    return row
+
+
+class ImageIndex:
+    """Keeps the images table in step with the files under root."""
+
+    def __init__(self, root=IMAGES_FOLDER, workers=SCAN_WORKERS, rescan_interval=RESCAN_INTERVAL):
+        self.root = root
+        self.workers = workers
+        self.rescan_interval = rescan_interval
+        self.app = None
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._scan_lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app, scan=True):
+        """Use app's database for the index; with scan, also start the background scanner."""
+        self.app = app
+        if scan and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='image-index', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.scan()
+            except Exception as e:
+                print(f"Error scanning images: {e}", file=sys.stderr)
+            if not self.rescan_interval:
+                return
+            time.sleep(self.rescan_interval)
+
+    def rel_path(self, path):
+        return os.path.relpath(path, self.root)
+
+    def _existing(self, rel_paths):
+        images = []
+        for start in range(0, len(rel_paths), INSERT_BATCH_SIZE):
+            batch = rel_paths[start:start + INSERT_BATCH_SIZE]
+            images.extend(GeneratedImage.query.filter(GeneratedImage.path.in_(batch)))
+        return images
+
+    def _upsert(self, rows):
+        """Insert or refresh rows and move the storage counters to match; commits."""
+        if not rows:
+            return
+        existing = {image.path: image for image in self._existing([row['path'] for row in rows])}
+        deltas = storage.count_rows(existing.values(), sign=-1)
+        for row in rows:
+            previous = existing.get(row['path'])
+            user_id = row['user_id'] if row['user_id'] is not None or previous is None else previous.user_id
+            storage.count_rows([dict(row, user_id=user_id)], deltas=deltas)
+
+        statement = insert(GeneratedImage)
+        columns = {key: statement.excluded[key] for key in rows[0] if key != 'path'}
+        # A rescan can't tell who generated an image without a charactergen chunk; keep what was recorded
+        columns['user_id'] = func.coalesce(statement.excluded.user_id, GeneratedImage.user_id)
+        statement = statement.on_conflict_do_update(index_elements=['path'], set_=columns)
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            db.session.execute(statement, rows[start:start + INSERT_BATCH_SIZE])
+        storage.apply(deltas)
+        db.session.commit()
+
+    def add(self, paths, user_id=None):
+        """Index newly saved images (absolute paths); needs an app context."""
+        rows = []
+        for path in paths:
+            try:
+                rows.append(image_row(self.rel_path(path), user_id, self.root))
+            except OSError as e:
+                print(f"Error indexing image {path}: {e}", file=sys.stderr)
+        try:
+            self._upsert(rows)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error saving image index rows: {e}", file=sys.stderr)
+
+    def saved(self, paths, user_id=None, latest=False):
+        """
+        Index images a job just saved; latest means the first one also became
+        user_id's latest image under static/images. Runs in the current app
+        context, or in the app given to init_app outside one.
+        """
+        if not has_app_context():
+            if self.app is None:
+                print("Image index not set up; new images will be indexed by the next scan", file=sys.stderr)
+                return
+            with self.app.app_context():
+                return self.saved(paths, user_id, latest)
+
+        self.add(paths, user_id=user_id)
+        if latest:
+            storage.refresh_static(user_id)
+
+    def remove(self, rel_paths):
+        """Drop the rows of deleted images; needs an app context."""
+        rel_paths = list(rel_paths)
+        if not rel_paths:
+            return
+        try:
+            storage.apply(storage.count_rows(self._existing(rel_paths), sign=-1))
+            for start in range(0, len(rel_paths), INSERT_BATCH_SIZE):
+                batch = rel_paths[start:start + INSERT_BATCH_SIZE]
+                GeneratedImage.query.filter(GeneratedImage.path.in_(batch)).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error removing image index rows: {e}", file=sys.stderr)
+
+    def _walk(self):
+        found = {}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(directory, name)
+                    try:
+                        found[self.rel_path(path)] = os.stat(path).st_mtime_ns
+                    except OSError:
+                        continue
+        return found
+
+    def _take_lease(self, seconds):
+        """Hold the scan lease for seconds if it is free, expired or already ours; commits."""
+        now = datetime.utcnow()
+        statement = insert(TaskLease).values(name=SCAN_LEASE, holder=self.holder,
+                                             expires_at=now + timedelta(seconds=seconds))
+        statement = statement.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'holder': statement.excluded.holder, 'expires_at': statement.excluded.expires_at},
+            where=db.or_(TaskLease.expires_at <= now, TaskLease.holder == self.holder)
+        )
+        try:
+            taken = db.session.execute(statement).rowcount > 0
+            db.session.commit()
+            return taken
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def scan(self):
+        """
+        Reconcile the table with the files on disk, unless another process
+        holds the scan lease; needs an app context.
+        """
+        if not self._scan_lock.acquire(blocking=False):
+            return
+        try:
+            if not self._take_lease(SCAN_LEASE_TIMEOUT):
+                return
+            self._scan()
+            # Other processes skip their scans until this process's next one is due
+            self._take_lease(self.rescan_interval)
+        finally:
+            self._scan_lock.release()
+
+    def _scan(self):
+        found = self._walk()
+        indexed = dict(db.session.query(GeneratedImage.path, GeneratedImage.modified_ns))
+
+        missing = [path for path in indexed if path not in found]
+        changed = [path for path, mtime_ns in found.items() if indexed.get(path) != mtime_ns]
+
+        def parse(rel_path):
+            try:
+                return image_row(rel_path, root=self.root)
+            except OSError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-index-scan') as pool:
+            rows = [row for row in pool.map(parse, changed) if row]
+
+        self.remove(missing)
+        try:
+            self._upsert(rows)
+        except Exception:
+            db.session.rollback()
+            raise
+
+        for row in rows:
+            derivatives.schedule(row['path'], kinds=('thumb',))
+        if missing or rows:
+            print(f"Image index: {len(rows)} added or updated, {len(missing)} removed")
+        # Correct any drift in the running storage counters
+        storage.reconcile()
+
+    def subfolders(self, folder):
+        """Names of the folders directly inside folder ('' for the root) that contain images."""
+        query = Query(GeneratedImage.folder).distinct()
+        if folder:
+            prefix = folder + os.sep
+            query = query.filter(GeneratedImage.folder.startswith(prefix, autoescape=True))
+        else:
+            prefix = ''
+            query = query.filter(GeneratedImage.folder != '')
+        with read_session() as session:
+            return sorted({name[len(prefix):].split(os.sep)[0] for name, in query.with_session(session)})
+
+    def page(self, folder, sort='name', descending=False, limit=PAGE_SIZE, cursor=None,
+             date_from=None, date_to=None, seed=None, checkpoint=None):
+        """
+        Return (images, next_cursor) for one page of a folder's images, ordered
+        by sort (name, date or size) with the path as tie-breaker. Pages are
+        found by seeking past the cursor's key rather than with OFFSET, so
+        later pages cost the same as the first. next_cursor is None on the
+        last page. Raises ValueError for an unknown sort or a bad cursor.
+        """
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Unknown sort: {sort}")
+        column = getattr(GeneratedImage, SORT_COLUMNS[sort])
+        path = GeneratedImage.path
+
+        # Built unbound and run on the query-only engine
+        query = Query(GeneratedImage).filter(GeneratedImage.folder == folder)
+        if date_from is not None:
+            query = query.filter(GeneratedImage.created_at >= date_from)
+        if date_to is not None:
+            query = query.filter(GeneratedImage.created_at < date_to)
+        if seed is not None:
+            query = query.filter(GeneratedImage.seed == seed)
+        if checkpoint:
+            query = query.filter(GeneratedImage.checkpoint == checkpoint)
+
+        if cursor:
+            value, last_path = decode_cursor(cursor, sort)
+            if column is path:
+                query = query.filter(path < last_path if descending else path > last_path)
+            else:
+                key = tuple_(column, path)
+                query = query.filter(key < (value, last_path) if descending else key > (value, last_path))
+
+        order = [column.desc(), path.desc()] if descending else [column, path]
+        if column is path:
+            order = order[:1]
+        with read_session() as session:
+            images = query.order_by(*order).limit(limit + 1).with_session(session).all()
+
+        next_cursor = None
+        if len(images) > limit:
+            images = images[:limit]
+            next_cursor = encode_cursor(images[-1], sort)
+        return images, next_cursor
+
+
+
+# Global image index instance
+image_index = ImageIndex()
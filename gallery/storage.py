@@ -0,0 +1,186 @@
+"""
+Running storage counters for the admin dashboard.
+
+The storage_counters table keeps a file and byte count for all images, each
+character and each user. The image index adjusts them as it adds and
+removes rows, so the dashboard reads a handful of rows instead of summing
+every image. reconcile() rebuilds them from the images table after each
+index scan, which corrects any drift from concurrent updates.
+
+Each user's copy of their latest image under static/images is counted too,
+in a 'static' counter per user, recounted whenever a job saves one.
+"""
+import os
+import sys
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from database.models import db, GeneratedImage, StorageCounter, User
+from database.profile import read_session
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_IMAGES_FOLDER = os.path.join(BASE_DIR, 'static', 'images')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+TOTAL = 'total'
+CHARACTER = 'character'
+USER = 'user'
+# Files under static/images, keyed by the user id folder they are in ('' for the top level)
+STATIC = 'static'
+
+
+def _scopes(character, user_id):
+    yield TOTAL, ''
+    if character:
+        yield CHARACTER, character
+    if user_id is not None:
+        yield USER, str(user_id)
+
+
+def count_rows(rows, sign=1, deltas=None):
+    """
+    Add the files and bytes of index rows (dicts or GeneratedImage objects)
+    to a {(scope, key): [files, bytes]} map; sign=-1 subtracts them.
+    """
+    deltas = {} if deltas is None else deltas
+    for row in rows:
+        if isinstance(row, dict):
+            character, user_id, size = row.get('character'), row.get('user_id'), row.get('size') or 0
+        else:
+            character, user_id, size = row.character, row.user_id, row.size or 0
+        for scope in _scopes(character, user_id):
+            delta = deltas.setdefault(scope, [0, 0])
+            delta[0] += sign
+            delta[1] += sign * size
+    return deltas
+
+
+def apply(deltas):
+    """Add deltas from count_rows to the counters; the caller commits."""
+    rows = [{'scope': scope, 'key': key, 'files': files, 'bytes': size, 'updated_at': datetime.utcnow()}
+            for (scope, key), (files, size) in deltas.items() if files or size]
+    if not rows:
+        return
+    statement = insert(StorageCounter)
+    statement = statement.on_conflict_do_update(
+        index_elements=['scope', 'key'],
+        set_={
+            'files': StorageCounter.files + statement.excluded.files,
+            'bytes': StorageCounter.bytes + statement.excluded.bytes,
+            'updated_at': statement.excluded.updated_at
+        }
+    )
+    db.session.execute(statement, rows)
+
+
+def _count_files(directory, recursive=True):
+    files = size = 0
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                    files += 1
+                except OSError:
+                    pass
+        if not recursive:
+            break
+    return [files, size]
+
+
+def _static_counts():
+    """Count the images under static/images per top-level folder."""
+    counts = {'': _count_files(STATIC_IMAGES_FOLDER, recursive=False)}
+    try:
+        entries = list(os.scandir(STATIC_IMAGES_FOLDER))
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        if entry.is_dir():
+            counts[entry.name] = _count_files(entry.path)
+    return {key: count for key, count in counts.items() if count[0]}
+
+
+def refresh_static(user_id):
+    """Recount a user's folder under static/images after their latest image changed, and commit."""
+    files, size = _count_files(os.path.join(STATIC_IMAGES_FOLDER, str(user_id)))
+    try:
+        counter = StorageCounter.query.get((STATIC, str(user_id)))
+        if counter is None:
+            counter = StorageCounter(scope=STATIC, key=str(user_id))
+            db.session.add(counter)
+        counter.files, counter.bytes, counter.updated_at = files, size, datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error counting static images for user {user_id}: {e}", file=sys.stderr)
+
+
+def reconcile():
+    """Recompute every counter from the images table; needs an app context."""
+    deltas = {}
+    total = db.session.query(func.count(GeneratedImage.id), func.sum(GeneratedImage.size)).one()
+    deltas[(TOTAL, '')] = [total[0], total[1] or 0]
+    for scope, column in ((CHARACTER, GeneratedImage.character), (USER, GeneratedImage.user_id)):
+        grouped = db.session.query(column, func.count(GeneratedImage.id), func.sum(GeneratedImage.size)) \
+            .filter(column.isnot(None)) \
+            .group_by(column)
+        for key, files, size in grouped:
+            deltas[(scope, str(key))] = [files, size or 0]
+    for key, count in _static_counts().items():
+        deltas[(STATIC, key)] = count
+
+    try:
+        now = datetime.utcnow()
+        current = {(counter.scope, counter.key): counter for counter in StorageCounter.query.all()}
+        corrected = 0
+        for scope_key, (files, size) in deltas.items():
+            counter = current.pop(scope_key, None)
+            if counter is None:
+                db.session.add(StorageCounter(scope=scope_key[0], key=scope_key[1], files=files, bytes=size,
+                                              updated_at=now))
+                corrected += 1
+            elif (counter.files, counter.bytes) != (files, size):
+                counter.files, counter.bytes, counter.updated_at = files, size, now
+                corrected += 1
+        for counter in current.values():
+            db.session.delete(counter)
+            corrected += 1
+        db.session.commit()
+        if corrected:
+            print(f"Storage counters: corrected {corrected} counters")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error reconciling storage counters: {e}", file=sys.stderr)
+
+
+def totals():
+    """Return (image count, total bytes) from the counters, including static/images."""
+    with read_session() as session:
+        files, size = session.query(func.sum(StorageCounter.files), func.sum(StorageCounter.bytes)) \
+            .filter(db.or_(StorageCounter.scope == STATIC,
+                           db.and_(StorageCounter.scope == TOTAL, StorageCounter.key == ''))) \
+            .one()
+        return files or 0, size or 0
+
+
+def breakdown(scope, limit=20):
+    """Return the largest counters of a scope as [{'name', 'files', 'bytes'}], biggest first."""
+    with read_session() as session:
+        counters = session.query(StorageCounter).filter_by(scope=scope) \
+            .filter(StorageCounter.files > 0) \
+            .order_by(StorageCounter.bytes.desc()) \
+            .limit(limit) \
+            .all()
+        names = {}
+        if scope == USER:
+            user_ids = [int(counter.key) for counter in counters]
+            names = {str(user_id): username for user_id, username
+                     in session.query(User.id, User.username).filter(User.id.in_(user_ids))}
+    return [{
+        'name': names.get(counter.key, counter.key),
+        'files': counter.files,
+        'bytes': counter.bytes
+    } for counter in counters]
@@ -0,0 +1,86 @@
+"""
+Pooled HTTP client for the ComfyUI API.
+
+Keeps a persistent keep-alive connection pool per ComfyUI backend instead of
+opening a new connection for every /prompt, /history and /view call.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config.config_utils import config
+
+COMFYUI_BASE_URL = config.get('services', 'comfyui', 'base_url')
+POOL_SIZE = config.get('services', 'comfyui', 'pool_size', default=10)
+REQUEST_TIMEOUT = config.get('services', 'comfyui', 'request_timeout', default=30)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+RETRIES = config.get('services', 'comfyui', 'retries', default=3)
+
+
+class ComfyUIClient:
+    """Thin wrapper around a pooled requests.Session for one ComfyUI backend."""
+
+    def __init__(self, base_url=None, pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT, retries=RETRIES):
+        self.base_url = (base_url or COMFYUI_BASE_URL).rstrip('/')
+        self.timeout = timeout
+
+        # Only idempotent GETs are retried; POST /prompt would queue the job twice
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _url(self, path):
+        return f"{self.base_url}{path}"
+
+    def queue_prompt(self, workflow, client_id, timeout=None):
+        """POST a workflow to /prompt and return the response JSON."""
+        response = self.session.post(
+            self._url('/prompt'),
+            json={"prompt": workflow, "client_id": client_id},
+            timeout=timeout or self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def get_history(self, prompt_id, timeout=None):
+        """Return the /history entry for a prompt, or {} if ComfyUI has none yet."""
+        response = self.session.get(self._url(f'/history/{prompt_id}'), timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json().get(prompt_id, {})
+
+    def download_image(self, filename, subfolder, folder_type, file, timeout=None):
+        """Stream an output image from /view into an open binary file, chunk by chunk."""
+        with self.session.get(
+            self._url('/view'),
+            params={"filename": filename, "subfolder": subfolder or '', "type": folder_type},
+            timeout=timeout or self.timeout,
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url=None):
+    """Return the shared client for a ComfyUI backend, creating it on first use."""
+    base_url = base_url or COMFYUI_BASE_URL
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            client = _clients[base_url] = ComfyUIClient(base_url)
+    return client
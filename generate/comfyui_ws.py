@@ -0,0 +1,220 @@
+"""
+Shared ComfyUI websocket connection.
+
+One long-lived websocket per ComfyUI backend receives the events for every
+prompt this process has queued and hands them to per-prompt_id waiters, so
+jobs no longer open (and tear down) a websocket of their own.
+"""
+import sys
+import json
+import uuid
+import struct
+import queue
+import threading
+from collections import OrderedDict
+
+import websocket
+
+from config.config_utils import config
+
+COMFYUI_WS_URL = config.get('services', 'comfyui', 'ws_url')
+RECV_TIMEOUT = config.get('services', 'comfyui', 'ws_recv_timeout', default=5)
+CONNECT_TIMEOUT = config.get('services', 'comfyui', 'ws_connect_timeout', default=10)
+MAX_BACKOFF = config.get('services', 'comfyui', 'ws_max_backoff', default=30)
+
+# Events whose data carries the prompt_id they belong to
+PROMPT_EVENTS = (
+    'execution_start', 'execution_cached', 'executing', 'executed', 'progress',
+    'execution_success', 'execution_error', 'execution_interrupted'
+)
+# How many prompts' events to keep around for waiters that register late
+MAX_UNCLAIMED_PROMPTS = 100
+
+# Binary frames start with a big-endian event type; preview images then carry an image format
+BINARY_PREVIEW_IMAGE = 1
+PREVIEW_FORMATS = {1: 'jpeg', 2: 'png'}
+
+
+class PromptWaiter:
+    """Receives the websocket events of a single prompt_id."""
+
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self._events = queue.Queue()
+
+    def put(self, event_type, data):
+        self._events.put((event_type, data))
+
+    def get(self, timeout):
+        """Return the next (event_type, data) pair or raise queue.Empty."""
+        return self._events.get(timeout=timeout)
+
+
+class ComfyUIWebSocket:
+    """Long-lived websocket to one ComfyUI backend that dispatches events by prompt_id."""
+
+    def __init__(self, ws_url, client_id=None, recv_timeout=RECV_TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, max_backoff=MAX_BACKOFF):
+        self.ws_url = ws_url
+        self.client_id = client_id or str(uuid.uuid4())
+        self.recv_timeout = recv_timeout
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+
+        # Incremented on every (re)connect so waiters can tell when events may have been missed
+        self.epoch = 0
+        self._connected = threading.Event()
+        self._stopped = threading.Event()
+        self._waiters = {}
+        self._unclaimed = OrderedDict()
+        # Binary frames carry no prompt_id; they belong to whatever is executing right now
+        self._executing_prompt = None
+        self._executing_node = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._ws = None
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name=f"comfyui-ws-{self.client_id[:8]}", daemon=True
+                )
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def wait_connected(self, timeout=None):
+        """Block until the socket is connected; returns False on timeout."""
+        return self._connected.wait(self.connect_timeout if timeout is None else timeout)
+
+    def watch(self, prompt_id):
+        """Register a waiter for prompt_id, replaying any events that arrived first."""
+        waiter = PromptWaiter(prompt_id)
+        with self._lock:
+            self._waiters[prompt_id] = waiter
+            for event_type, data in self._unclaimed.pop(prompt_id, []):
+                waiter.put(event_type, data)
+        return waiter
+
+    def unwatch(self, prompt_id):
+        with self._lock:
+            self._waiters.pop(prompt_id, None)
+
+    def _run(self):
+        backoff = 1
+        while not self._stopped.is_set():
+            ws = websocket.WebSocket()
+            try:
+                ws.connect(f"{self.ws_url}/ws?clientId={self.client_id}", timeout=self.connect_timeout)
+                ws.settimeout(self.recv_timeout)
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"WebSocket connection to {self.ws_url} failed: {e}; retrying in {backoff}s",
+                      file=sys.stderr)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            self._ws = ws
+            self.epoch += 1
+            self._connected.set()
+            backoff = 1
+            print(f"WebSocket connected to {self.ws_url} (client {self.client_id})")
+
+            try:
+                while not self._stopped.is_set():
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+                    self._dispatch(message)
+            except (websocket.WebSocketException, OSError) as e:
+                if not self._stopped.is_set():
+                    print(f"WebSocket error: {e}; reconnecting", file=sys.stderr)
+            finally:
+                self._connected.clear()
+                self._ws = None
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+
+    def _dispatch(self, message):
+        if not isinstance(message, str):
+            self._dispatch_binary(message)
+            return
+
+        try:
+            message_json = json.loads(message)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON message: {e}", file=sys.stderr)
+            return
+
+        event_type = message_json.get('type')
+        data = message_json.get('data') or {}
+        prompt_id = data.get('prompt_id') if isinstance(data, dict) else None
+        if event_type not in PROMPT_EVENTS or not prompt_id:
+            return
+
+        with self._lock:
+            if event_type == 'executing':
+                node = data.get('node')
+                self._executing_prompt = prompt_id if node is not None else None
+                self._executing_node = node
+            elif event_type == 'execution_start':
+                self._executing_prompt = prompt_id
+
+            waiter = self._waiters.get(prompt_id)
+            if waiter is None:
+                # The job may not have registered yet; keep the event for it
+                self._unclaimed.setdefault(prompt_id, []).append((event_type, data))
+                self._unclaimed.move_to_end(prompt_id)
+                while len(self._unclaimed) > MAX_UNCLAIMED_PROMPTS:
+                    self._unclaimed.popitem(last=False)
+                return
+        waiter.put(event_type, data)
+
+    def _dispatch_binary(self, message):
+        if len(message) < 8:
+            return
+
+        event_type, image_format = struct.unpack('>II', message[:8])
+        if event_type != BINARY_PREVIEW_IMAGE:
+            return
+
+        with self._lock:
+            waiter = self._waiters.get(self._executing_prompt)
+            node = self._executing_node
+        if waiter is not None:
+            waiter.put('preview', {
+                'node': node,
+                'format': PREVIEW_FORMATS.get(image_format, 'jpeg'),
+                'image': message[8:]
+            })
+
+
+_sockets = {}
+_sockets_lock = threading.Lock()
+
+
+def get_websocket(ws_url=None):
+    """Return the running shared websocket for a ComfyUI backend, creating it on first use."""
+    ws_url = ws_url or COMFYUI_WS_URL
+    with _sockets_lock:
+        socket = _sockets.get(ws_url)
+        if socket is None:
+            socket = _sockets[ws_url] = ComfyUIWebSocket(ws_url)
+    return socket.start()
@@ -0,0 +1,218 @@
+"""
+In-process image generation pipeline.
+
+The Flask routes and the main.py CLI both call these functions directly
+instead of spawning generate_prompt.py and queue_and_retrieve_images.py as
+separate interpreters.
+"""
+import logging
+from collections.abc import Mapping
+
+from generate.generate_prompt import ollama
+from generate import queue_and_retrieve_images as comfyui
+from generate.prompt_pool import prompt_pool
+from generate.workflows import clean_workflow_options
+from config.config_utils import config
+from config.character_registry import character_registry
+
+logger = logging.getLogger(__name__)
+
+PROMPT_MODES = ("auto", "enhanced", "manual")
+# Images one batch (an API request or a batch file) may expand to
+MAX_BATCH_ITEMS = config.get('generation', 'max_batch_items', default=100)
+
+
+class GenerationError(Exception):
+    """Raised when a stage of the generation pipeline fails."""
+
+
+def get_character(characters, character_name):
+    """Return a copy of a character's data with its name filled in."""
+    if not character_name:
+        raise GenerationError("No character name provided.")
+
+    character_data = characters.get(character_name) if characters else None
+    if character_data is None:
+        raise GenerationError(f"Character '{character_name}' not found in the configuration file.")
+    if not isinstance(character_data, Mapping):
+        raise GenerationError(f"Invalid character data format for '{character_name}'")
+
+    return dict(character_data, name=character_name)
+
+
+def generate_prompt(characters, character_name, mode="auto", user_prompt=None, on_token=None,
+                    use_pool=False):
+    """
+    Produce the text prompt for a job.
+    'auto' and 'enhanced' ask Ollama, 'manual' uses the user's prompt as-is.
+    on_token(text) receives Ollama's output as it streams in.
+    With use_pool, auto mode takes a pre-generated prompt when one is ready.
+    """
+    if mode not in PROMPT_MODES:
+        raise GenerationError(f"Invalid generation mode: {mode}")
+
+    character = get_character(characters, character_name)
+
+    if mode == "manual":
+        prompt = (user_prompt or "").strip()
+        if not prompt:
+            raise GenerationError("No prompt was entered.")
+        logger.info(f"Using manual prompt: {prompt}")
+        return prompt
+
+    if mode == "enhanced" and not (user_prompt or "").strip():
+        raise GenerationError("No user prompt provided for enhanced generation.")
+
+    if mode == "auto" and use_pool:
+        prompt = prompt_pool.take(character)
+        if prompt:
+            logger.info(f"Using pooled auto prompt: {prompt}")
+            return prompt
+
+    logger.debug(f"Generating {mode} prompt for character: {character_name}")
+    prompt = ollama(character, mode, user_prompt.strip() if user_prompt else None, on_token=on_token)
+    if not prompt:
+        raise GenerationError("No prompt generated.")
+
+    logger.info(f"Generated {mode} prompt: {prompt}")
+    return prompt
+
+
+def queue(prompt, character_name, characters, options=None):
+    """Queue a prompt on ComfyUI and return its prompt_id and the workflow that was sent."""
+    prompt_id, workflow = comfyui.queue_prompt(prompt, character_name, characters, options=options)
+    if not prompt_id:
+        raise GenerationError("Failed to queue prompt.")
+    return prompt_id, workflow
+
+
+def retrieve(prompt_id, timeout=comfyui.TIMEOUT, on_progress=None, on_preview=None, output_node=None):
+    """
+    Wait for a queued prompt to finish and download its output images to
+    temp files; remove them with comfyui.remove_downloads when done.
+    output_node selects websocket delivery (see comfyui.websocket_output_node).
+    """
+    images, history = comfyui.get_images_via_websocket(
+        prompt_id, timeout=timeout, on_progress=on_progress, on_preview=on_preview, output_node=output_node
+    )
+    if not images:
+        raise GenerationError("No images were generated.")
+    return images, history
+
+
+def generate_images(prompt, character_name, characters, user_id=None, options=None, on_stage=None,
+                    on_progress=None, on_preview=None, save_seed=True, save_latest=True):
+    """
+    Queue a prompt, wait for ComfyUI and save the resulting images.
+    options are workflow overrides (see generate.workflows.apply_workflow_options).
+    The images are indexed as user_id's; without save_latest the first one
+    doesn't become their latest image, and without save_seed the seed isn't
+    kept as the "use last seed" value.
+    Returns the paths of the saved images.
+    """
+    if not prompt:
+        raise GenerationError("Cannot generate images without a prompt.")
+
+    get_character(characters, character_name)
+    on_stage = on_stage or (lambda stage: None)
+
+    logger.debug(f"Generating images for character {character_name} with prompt: {prompt}")
+    try:
+        # Checked before queueing, so a bad output_mode doesn't cost a render
+        output_node = comfyui.character_output_node(character_name, characters)
+    except ValueError as e:
+        raise GenerationError(str(e))
+
+    on_stage('queueing')
+    prompt_id, workflow = queue(prompt, character_name, characters, options=options)
+
+    on_stage('rendering')
+    images, _ = retrieve(prompt_id, on_progress=on_progress, on_preview=on_preview, output_node=output_node)
+
+    on_stage('saving')
+    try:
+        saved_paths = comfyui.save_images(images, prompt_id, character_name, workflow, user_id=user_id,
+                                          save_seed=save_seed, save_latest=save_latest)
+    finally:
+        comfyui.remove_downloads(images)
+    if not saved_paths:
+        raise GenerationError("Failed to save generated images.")
+
+    logger.info("Image generation completed successfully")
+    return saved_paths
+
+
+def run(character_name, mode, user_prompt=None, characters=None, user_id=None, options=None,
+        use_pool=False, on_stage=None, on_prompt=None, on_token=None, on_progress=None, on_preview=None,
+        save_seed=True, save_latest=True):
+    """
+    Run the whole pipeline for one job.
+    on_stage(stage) is called as the job moves through the pipeline,
+    on_token(text) as the LLM streams the prompt and on_prompt(prompt) as
+    soon as the full prompt is known. on_progress and on_preview are
+    passed through to comfyui.wait_for_prompt. Batch jobs pass
+    save_seed=False and save_latest=False so they don't replace the
+    interactive "use last seed" or the user's latest image.
+    Returns the prompt that was used and the paths of the saved images.
+    """
+    if characters is None:
+        characters = character_registry.all()
+
+    if on_stage:
+        on_stage('prompt')
+    prompt = generate_prompt(characters, character_name, mode, user_prompt, on_token=on_token,
+                             use_pool=use_pool)
+    if on_prompt:
+        on_prompt(prompt)
+
+    saved_paths = generate_images(
+        prompt, character_name, characters, user_id=user_id, options=options, on_stage=on_stage,
+        on_progress=on_progress, on_preview=on_preview, save_seed=save_seed, save_latest=save_latest
+    )
+    return prompt, saved_paths
+
+
+def expand_batch_item(item, characters, remaining=MAX_BATCH_ITEMS):
+    """
+    Validate one batch item ({character, mode, prompt, overrides, count}) and
+    expand it into a (character, mode, prompt, options) entry per image.
+    Overrides are checked against the character's workflow, and count
+    against the remaining images the batch may still hold. Raises
+    ValueError describing the problem; callers add the item's position.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("item must be an object")
+
+    character = item.get('character')
+    if character not in characters:
+        raise ValueError(f"character '{character}' not found")
+
+    prompt = (item.get('prompt') or '').strip() or None
+    mode = item.get('mode') or ('manual' if prompt else 'auto')
+    if mode not in PROMPT_MODES:
+        raise ValueError(f"invalid mode '{mode}'")
+    if mode != 'auto' and not prompt:
+        raise ValueError(f"{mode} mode requires a prompt")
+
+    overrides = item.get('overrides') or {}
+    if not isinstance(overrides, dict):
+        raise ValueError("overrides must be an object")
+    overrides = clean_workflow_options(overrides, characters[character].get('workflow_file') or '')
+
+    count = item.get('count', 1)
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        raise ValueError("count must be a positive integer")
+    if count > remaining:
+        raise ValueError(f"a batch may contain at most {MAX_BATCH_ITEMS} images")
+
+    entries = []
+    for n in range(count):
+        options = dict(overrides)
+        if 'seed' not in options:
+            # The template's own seed is usually fixed; let each copy pick a random one
+            options['seed'] = -1
+        elif isinstance(options['seed'], int) and options['seed'] >= 0:
+            # A fixed seed would render the same image count times; step it instead
+            options['seed'] += n
+        entries.append((character, mode, prompt, options))
+    return entries
@@ -1,32 +1,14 @@
 import os
 import json
 import requests
-import yaml
 import argparse
 import sys
 from config.config_utils import config
+from config.character_registry import character_registry
 
 OLLAMA_API_URL = config.get('services', 'llm', 'url')
 
 
-def load_characters(config_path):
-    """
-    Load characters from a YAML configuration file.
-    """
-    try:
-        with open(config_path, 'r') as file:
-            characters = yaml.safe_load(file)
-            if not characters:
-                print("Warning: Characters file is empty", file=sys.stderr)
-            return characters or {}
-    except FileNotFoundError:
-        print(f"Configuration file not found at {config_path}.", file=sys.stderr)
-        return {}
-    except yaml.YAMLError as exc:
-        print(f"Error parsing YAML file: {exc}", file=sys.stderr)
-        return {}
-
-
 def generate_ollama_prompt(character, prompt_type="auto", user_prompt=None):
     """
     Generate a prompt for Ollama based on the character and generation type.
@@ -73,9 +55,10 @@ def generate_ollama_prompt(character, prompt_type="auto", user_prompt=None):
     return prompt
 
 
-def ollama(character, prompt_type="auto", user_prompt=None):
+def ollama(character, prompt_type="auto", user_prompt=None, on_token=None):
     """
     Generate a descriptive text-to-image prompt using Ollama API.
+    If given, on_token is called with each chunk of text as Ollama streams it.
     """
     prompt = generate_ollama_prompt(character, prompt_type, user_prompt)
     if not prompt:
@@ -119,7 +102,10 @@ def ollama(character, prompt_type="auto", user_prompt=None):
         for line in response.iter_lines():
             if line:
                 line_json = json.loads(line.decode('utf-8'))
-                generated_prompt += line_json.get("response", "")
+                token = line_json.get("response", "")
+                generated_prompt += token
+                if token and on_token:
+                    on_token(token)
                 if line_json.get("done", False):
                     break
 
@@ -176,13 +162,7 @@ def main():
     )
     args = parser.parse_args()
 
-    # Define paths
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    config_dir = os.path.join(script_dir, '..', 'config')
-    config_path = os.path.join(config_dir, 'characters.yaml')
-
-    # Load characters
-    characters = load_characters(config_path)
+    characters = character_registry.all()
     if not characters:
         sys.exit(1)
 
@@ -191,13 +171,8 @@ def main():
         print(f"Character '{character_key}' not found in the configuration file.", file=sys.stderr)
         sys.exit(1)
 
-    character_data = characters[character_key]
-    if not isinstance(character_data, dict):
-        print(f"Invalid character data format for '{character_key}'", file=sys.stderr)
-        sys.exit(1)
-
-    # Add the character's name to the character data
-    character_data["name"] = character_key
+    # Add the character's name to a copy of the character data
+    character_data = dict(characters[character_key], name=character_key)
 
     # Handle different generation modes
     if args.mode == "enhanced":
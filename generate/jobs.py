@@ -0,0 +1,242 @@
+"""
+Background generation jobs.
+
+Generation routes hand their work to a bounded worker pool and return a job
+id straight away; clients poll the job's status instead of holding a
+request open for the whole render.
+
+Batch jobs run on a pool of their own so a long batch can't starve the
+interactive generate buttons. A Batch only groups the ids of its jobs.
+"""
+import sys
+import time
+import uuid
+import threading
+import traceback
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config_utils import config
+
+JOB_STATES = ('queued', 'running', 'completed', 'failed')
+# Events each job keeps for SSE replay; older ones are dropped
+MAX_EVENTS = config.get('generation', 'max_job_events', default=1000)
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting for a worker."""
+
+
+class Job:
+    """State of one generation job, shared between the worker and the status endpoint."""
+
+    def __init__(self, user_id, character, mode, previews=False, batch_id=None, options=None):
+        self.id = uuid.uuid4().hex
+        self.batch_id = batch_id
+        self.user_id = user_id
+        self.character = character
+        self.mode = mode
+        self.previews = previews
+        # Workflow overrides (Advanced Options) applied to this job's workflow only
+        self.options = options
+        self.state = 'queued'
+        self.stage = 'queued'
+        self.prompt = None
+        self.images = []
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._events = deque(maxlen=MAX_EVENTS)
+        # Events ever published; cursors count from the first one
+        self._published = 0
+        self._latest = {}
+
+    def update(self, **fields):
+        with self._lock:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.updated_at = time.time()
+            self._publish_locked('status', self._snapshot())
+
+    def publish(self, event, data, latest_only=False):
+        """
+        Append an event to the job's stream and wake up any listeners.
+        With latest_only, earlier events of the same type are dropped so
+        frequent events (progress, previews) don't pile up in memory. Only
+        the newest MAX_EVENTS events are kept at all.
+        """
+        with self._lock:
+            if latest_only and event in self._latest:
+                index = self._latest[event] - self._first_kept()
+                if index >= 0:
+                    self._events[index] = (event, None)
+            self._publish_locked(event, data)
+            if latest_only:
+                self._latest[event] = self._published - 1
+
+    def _publish_locked(self, event, data):
+        self._events.append((event, data))
+        self._published += 1
+        self._changed.notify_all()
+
+    def _first_kept(self):
+        return self._published - len(self._events)
+
+    def events_since(self, cursor, timeout=None):
+        """
+        Return the events published after position cursor, waiting up to
+        timeout seconds for new ones. Also returns the new cursor and whether
+        the job has finished. Superseded latest_only events are skipped, as
+        are events that fell out of the history before the caller read them;
+        the status events carry the full prompt, so a late listener catches up.
+        """
+        with self._changed:
+            if cursor >= self._published and not self.finished:
+                self._changed.wait(timeout)
+            start = max(cursor - self._first_kept(), 0)
+            events = [(event, data) for event, data in islice(self._events, start, None) if data is not None]
+            return events, self._published, self.finished
+
+    def set_stage(self, stage):
+        self.update(stage=stage)
+
+    @property
+    def finished(self):
+        return self.state in ('completed', 'failed')
+
+    def to_dict(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return {
+            'id': self.id,
+            'batch_id': self.batch_id,
+            'character': self.character,
+            'mode': self.mode,
+            'options': self.options,
+            'state': self.state,
+            'stage': self.stage,
+            'prompt': self.prompt,
+            'images': list(self.images),
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+
+class Batch:
+    """A group of jobs submitted together through the batch API."""
+
+    def __init__(self, user_id):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.job_ids = []
+        self.created_at = time.time()
+
+
+class JobManager:
+    """Runs jobs on fixed-size thread pools inside the Flask app context."""
+
+    def __init__(self, max_workers=None, max_queued=None, retention=None,
+                 batch_workers=None, max_batch_queued=None):
+        self.max_workers = max_workers or config.get('generation', 'workers', default=2)
+        self.max_queued = max_queued or config.get('generation', 'max_queued', default=20)
+        self.retention = retention or config.get('generation', 'job_retention', default=3600)
+        # Batch workers only wait on ComfyUI, so enough of them keep its queue from running dry
+        self.batch_workers = batch_workers or config.get('generation', 'batch_workers', default=4)
+        self.max_batch_queued = max_batch_queued or config.get('generation', 'max_batch_queued', default=500)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='generation')
+        self._batch_executor = ThreadPoolExecutor(max_workers=self.batch_workers, thread_name_prefix='batch')
+        self._jobs = {}
+        self._batches = {}
+        self._lock = threading.Lock()
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def submit(self, func, user_id, character, mode, previews=False, options=None, **kwargs):
+        """Queue func(job, **kwargs) and return the new Job."""
+        job = Job(user_id, character, mode, previews=previews, options=options)
+
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if j.state == 'queued' and j.batch_id is None)
+            if pending >= self.max_queued:
+                raise JobQueueFull("Too many generation jobs are queued. Please try again shortly.")
+            self._jobs[job.id] = job
+
+        self._executor.submit(self._run, job, func, kwargs)
+        return job
+
+    def submit_batch(self, func, user_id, items):
+        """
+        Queue func(job, **kwargs) on the batch pool for every
+        (character, mode, options, kwargs) in items and return the new Batch.
+        Either all items are queued or, if they don't fit, none are.
+        """
+        batch = Batch(user_id)
+        batch_jobs = [(Job(user_id, character, mode, batch_id=batch.id, options=options), kwargs)
+                      for character, mode, options, kwargs in items]
+
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if j.state == 'queued' and j.batch_id is not None)
+            if pending + len(batch_jobs) > self.max_batch_queued:
+                raise JobQueueFull(
+                    f"Batch queue is full ({pending} jobs waiting, limit {self.max_batch_queued})."
+                )
+            for job, _ in batch_jobs:
+                self._jobs[job.id] = job
+                batch.job_ids.append(job.id)
+            self._batches[batch.id] = batch
+
+        for job, kwargs in batch_jobs:
+            self._batch_executor.submit(self._run, job, func, kwargs)
+        return batch
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_batch(self, batch_id):
+        """Return (batch, jobs) or (None, []) if the batch is unknown or expired."""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None, []
+            return batch, [self._jobs[job_id] for job_id in batch.job_ids if job_id in self._jobs]
+
+    def _run(self, job, func, kwargs):
+        job.update(state='running')
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    func(job, **kwargs)
+            else:
+                func(job, **kwargs)
+            job.update(state='completed', stage='done')
+        except Exception as e:
+            print(f"Generation job {job.id} failed: {e}", file=sys.stderr)
+            traceback.print_exc()
+            job.update(state='failed', error=str(e))
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.updated_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+        expired_batches = [batch_id for batch_id, batch in self._batches.items()
+                           if not any(job_id in self._jobs for job_id in batch.job_ids)]
+        for batch_id in expired_batches:
+            del self._batches[batch_id]
+
+
+# Global job manager instance
+jobs = JobManager()
@@ -0,0 +1,188 @@
+"""
+PNG text-chunk writer.
+
+Adds tEXt/iTXt metadata to the PNG file ComfyUI returned by splicing new
+chunks in before IEND while streaming the file to its destination, so the
+image data is copied byte for byte instead of being decoded and
+re-compressed, and never has to be held in memory as a whole.
+"""
+import os
+import zlib
+import shutil
+import struct
+import tempfile
+from contextlib import contextmanager
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNK_TYPES = (b'tEXt', b'zTXt', b'iTXt')
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+def _chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def _keyword(key):
+    keyword = key.encode('latin-1')
+    if not 1 <= len(keyword) <= 79 or b'\0' in keyword:
+        raise ValueError(f"Invalid PNG text keyword: {key!r}")
+    return keyword
+
+
+def text_chunk(key, value):
+    """Build a tEXt chunk, or an iTXt chunk if value isn't Latin-1."""
+    try:
+        return _chunk(b'tEXt', _keyword(key) + b'\0' + value.encode('latin-1'))
+    except UnicodeEncodeError:
+        return itxt_chunk(key, value)
+
+
+def itxt_chunk(key, value, compressed=False, lang='', translated_key=''):
+    """Build an iTXt chunk holding UTF-8 text, zlib-compressed if requested."""
+    text = value.encode('utf-8')
+    if compressed:
+        text = zlib.compress(text)
+    data = (_keyword(key) + b'\0' + bytes([1 if compressed else 0, 0]) + lang.encode('ascii') + b'\0'
+            + translated_key.encode('utf-8') + b'\0' + text)
+    return _chunk(b'iTXt', data)
+
+
+def _chunk_keyword(chunk_type, data):
+    if chunk_type in TEXT_CHUNK_TYPES:
+        return data.split(b'\0', 1)[0].decode('latin-1')
+    return None
+
+
+def _read_exact(src, size):
+    data = src.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated PNG chunk")
+    return data
+
+
+def _copy_exact(src, dst, size):
+    while size:
+        block = src.read(min(size, COPY_BUFFER_SIZE))
+        if not block:
+            raise ValueError("Truncated PNG chunk")
+        dst.write(block)
+        size -= len(block)
+
+
+def copy_with_text_chunks(src, dst, chunks):
+    """
+    Stream a PNG from file object src to dst, inserting chunks (built by
+    text_chunk/itxt_chunk) before IEND. Existing text chunks with the same
+    keywords are dropped. Raises ValueError if src isn't a well-formed PNG.
+    """
+    if src.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG image")
+    dst.write(PNG_SIGNATURE)
+
+    new_keys = {_chunk_keyword(chunk[4:8], chunk[8:-4]) for chunk in chunks}
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            raise ValueError("PNG has no IEND chunk")
+        length, chunk_type = struct.unpack('>I4s', header)
+
+        if chunk_type == b'IEND':
+            for chunk in chunks:
+                dst.write(chunk)
+            dst.write(header)
+            dst.write(_read_exact(src, length + 4))
+            return
+
+        if chunk_type in TEXT_CHUNK_TYPES:
+            # Text chunks are small; read them to check the keyword
+            data = _read_exact(src, length + 4)
+            if _chunk_keyword(chunk_type, data[:-4]) not in new_keys:
+                dst.write(header)
+                dst.write(data)
+            continue
+
+        dst.write(header)
+        _copy_exact(src, dst, length + 4)
+
+
+@contextmanager
+def atomic_output(path):
+    """Yield a file to write path's new contents to; it replaces path only if the block succeeds."""
+    directory = os.path.dirname(path) or '.'
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.png')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        # mkstemp creates the file private to us; keep the target's permissions instead
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def copy_atomic(source_path, path):
+    """Copy source_path to path so readers never see a partly written file."""
+    with open(source_path, 'rb') as src, atomic_output(path) as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def write_png_with_metadata(path, source_path, chunks):
+    """Copy the PNG at source_path to path with metadata chunks spliced in, in a single pass."""
+    with open(source_path, 'rb') as src, atomic_output(path) as dst:
+        copy_with_text_chunks(src, dst, chunks)
+
+
+def _decode_text_chunk(chunk_type, data):
+    keyword, _, rest = data.partition(b'\0')
+    if chunk_type == b'tEXt':
+        value = rest.decode('latin-1')
+    elif chunk_type == b'zTXt':
+        value = zlib.decompress(rest[1:]).decode('latin-1')
+    else:
+        compressed, rest = rest[0], rest[2:]
+        _, _, rest = rest.partition(b'\0')  # language tag
+        _, _, text = rest.partition(b'\0')  # translated keyword
+        value = (zlib.decompress(text) if compressed else text).decode('utf-8')
+    return keyword.decode('latin-1'), value
+
+
+def read_png_info(path):
+    """
+    Return (width, height, text) for the PNG at path, where text maps the
+    keywords of its tEXt/zTXt/iTXt chunks to their values. Image data is
+    skipped over, not read. Raises ValueError if the file isn't a PNG.
+    """
+    width = height = None
+    text = {}
+    with open(path, 'rb') as f:
+        if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            raise ValueError("Not a PNG image")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'IHDR':
+                width, height = struct.unpack('>II', _read_exact(f, 8))
+                f.seek(length - 8 + 4, os.SEEK_CUR)
+            elif chunk_type in TEXT_CHUNK_TYPES:
+                try:
+                    key, value = _decode_text_chunk(chunk_type, _read_exact(f, length))
+                    text[key] = value
+                except (zlib.error, UnicodeDecodeError, IndexError):
+                    pass
+                f.seek(4, os.SEEK_CUR)
+            elif chunk_type == b'IEND':
+                break
+            else:
+                f.seek(length + 4, os.SEEK_CUR)
+    return width, height, text
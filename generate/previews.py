@@ -0,0 +1,52 @@
+"""
+Live render previews.
+
+ComfyUI streams latent preview frames over the websocket while it samples.
+PreviewRelay shrinks them and forwards them to a job's event stream, at a
+limited rate so slow clients aren't flooded.
+"""
+import io
+import sys
+import time
+import base64
+
+from PIL import Image
+
+from config.config_utils import config
+
+PREVIEW_MAX_SIZE = config.get('previews', 'max_size', default=256)
+PREVIEW_QUALITY = config.get('previews', 'quality', default=70)
+PREVIEW_MIN_INTERVAL = config.get('previews', 'min_interval', default=0.5)
+
+
+def encode_preview(image_data, max_size=PREVIEW_MAX_SIZE, quality=PREVIEW_QUALITY):
+    """Downscale a preview frame and return it as a JPEG data URL."""
+    image = Image.open(io.BytesIO(image_data))
+    image.thumbnail((max_size, max_size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+class PreviewRelay:
+    """Callable passed as on_preview; publishes at most one frame per min_interval."""
+
+    def __init__(self, publish, max_size=PREVIEW_MAX_SIZE, min_interval=PREVIEW_MIN_INTERVAL):
+        self.publish = publish
+        self.max_size = max_size
+        self.min_interval = min_interval
+        self._last_sent = 0
+
+    def __call__(self, image_data, image_format):
+        now = time.time()
+        if now - self._last_sent < self.min_interval:
+            return
+        self._last_sent = now
+
+        try:
+            self.publish('preview', {'image': encode_preview(image_data, self.max_size)}, latest_only=True)
+        except Exception as e:
+            print(f"Error encoding {image_format} preview frame: {e}", file=sys.stderr)
@@ -0,0 +1,112 @@
+"""
+Pool of pre-generated auto-mode prompts.
+
+The LLM input for an auto prompt depends only on the character, so a
+background filler can keep a few ready-made prompts per character and
+/generate_new_image can hand one straight to ComfyUI instead of waiting on
+Ollama. Each take schedules a refill.
+
+Pool settings come from the prompt_pool section of app_config.yaml and can
+be overridden per character with a prompt_pool key in characters.yaml.
+A depth of 0 disables the pool for that character.
+"""
+import sys
+import time
+import threading
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from config.config_utils import config
+from generate.generate_prompt import ollama, generate_ollama_prompt
+
+POOL_SETTINGS = ('depth', 'ttl', 'refill_concurrency')
+
+
+class PromptPool:
+    """Per-character queues of ready auto prompts, refilled on a small thread pool."""
+
+    def __init__(self, enabled=None, depth=None, ttl=None, refill_concurrency=None, max_workers=None):
+        self.enabled = config.get('prompt_pool', 'enabled', default=True) if enabled is None else enabled
+        self.defaults = {
+            'depth': config.get('prompt_pool', 'depth', default=3) if depth is None else depth,
+            'ttl': config.get('prompt_pool', 'ttl', default=3600) if ttl is None else ttl,
+            'refill_concurrency': (config.get('prompt_pool', 'refill_concurrency', default=1)
+                                   if refill_concurrency is None else refill_concurrency)
+        }
+        self.max_workers = max_workers or config.get('prompt_pool', 'max_workers', default=2)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='prompt-pool')
+        # Keyed by the LLM input, so editing a character's description retires its old prompts
+        self._pools = {}
+        self._refilling = {}
+        self._lock = threading.Lock()
+
+    def settings(self, character):
+        """Return the pool settings for a character dict, applying its overrides."""
+        settings = dict(self.defaults)
+        overrides = character.get('prompt_pool')
+        if isinstance(overrides, Mapping):
+            settings.update({k: v for k, v in overrides.items() if k in POOL_SETTINGS})
+        return settings
+
+    def take(self, character):
+        """
+        Pop a fresh prompt for a character (a dict with its name filled in)
+        and schedule a refill. Returns None when the pool is empty or disabled.
+        """
+        settings = self.settings(character)
+        if not self.enabled or settings['depth'] <= 0:
+            return None
+
+        key = generate_ollama_prompt(character, "auto")
+        if not key:
+            return None
+
+        prompt = None
+        cutoff = time.time() - settings['ttl']
+        with self._lock:
+            pool = self._pools.get(key)
+            while pool:
+                candidate, created_at = pool.popleft()
+                if created_at >= cutoff:
+                    prompt = candidate
+                    break
+
+        self._schedule_refill(key, character, settings)
+        return prompt
+
+    def size(self, character):
+        with self._lock:
+            return len(self._pools.get(generate_ollama_prompt(character, "auto"), ()))
+
+    def _schedule_refill(self, key, character, settings):
+        with self._lock:
+            pool = self._pools.setdefault(key, deque())
+            in_flight = self._refilling.get(key, 0)
+            wanted = min(settings['depth'] - len(pool) - in_flight, settings['refill_concurrency'] - in_flight)
+            if wanted <= 0:
+                return
+            self._refilling[key] = in_flight + wanted
+
+        for _ in range(wanted):
+            self._executor.submit(self._refill_one, key, character, settings)
+
+    def _refill_one(self, key, character, settings):
+        prompt = None
+        try:
+            prompt = ollama(character, "auto")
+        except Exception as e:
+            print(f"Error refilling prompt pool for {character.get('name')}: {e}", file=sys.stderr)
+        finally:
+            with self._lock:
+                self._refilling[key] -= 1
+                if prompt:
+                    self._pools.setdefault(key, deque()).append((prompt, time.time()))
+
+        # Keep filling until the pool is full; a failed request stops the chain
+        if prompt:
+            self._schedule_refill(key, character, settings)
+
+
+# Global prompt pool instance
+prompt_pool = PromptPool()
@@ -1,21 +1,27 @@
 import json
-import uuid
-import urllib.request
-import websocket
+import logging
+import queue
+import requests
 import sys
 import os
-import yaml
 import time
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from PIL import Image
-from PIL.PngImagePlugin import PngInfo
-import io
 from config.config_utils import config
+from config.character_registry import character_registry
+from generate.comfyui_ws import get_websocket
+from generate.comfyui_client import get_client
+from generate.png_metadata import text_chunk, write_png_with_metadata, copy_atomic
+from generate.workflow_metadata import workflow_chunks
+from gallery.derivatives import derivatives
+from gallery.index import image_index
+from generate.workflows import get_template, apply_workflow_options
+
+logger = logging.getLogger(__name__)
 
 # Configuration Constants
-COMFYUI_BASE_URL = config.get('services', 'comfyui', 'base_url')
-COMFYUI_WS_URL = config.get('services', 'comfyui', 'ws_url')
-CLIENT_ID = str(uuid.uuid4())
 TIMEOUT = config.get('services', 'comfyui', 'timeout', default=300)
 # Fixed path definitions
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -24,71 +30,48 @@ IMAGES_FOLDER = os.path.join(BASE_DIR, 'images')
 STATIC_IMAGES_FOLDER = os.path.join(BASE_DIR, 'static', 'images')
 LATEST_IMAGE_NAME = "latest_image.png"
 PREVIOUS_SEED_FILE = os.path.join(BASE_DIR, 'static', 'previous_seed.txt')
+# Downloads from ComfyUI are streamed here and removed once saved
+TEMP_DIR = os.path.join(BASE_DIR, config.get('paths', 'temp_dir', default='static/temp'))
+DOWNLOAD_WORKERS = config.get('services', 'comfyui', 'download_workers', default=4)
+# characters.yaml output_mode values; 'auto' uses the websocket when the workflow has a SaveImageWebsocket node
+OUTPUT_MODES = ('auto', 'websocket', 'history')
+# ComfyUI's own folders, when it runs on this host; outputs found there are linked instead of downloaded
+LOCAL_OUTPUT_DIRS = {
+    'output': config.get('paths', 'comfyui_output_dir', default=''),
+    'temp': config.get('paths', 'comfyui_temp_dir', default=''),
+}
 
 # Ensure the images directories exist
 os.makedirs(IMAGES_FOLDER, exist_ok=True)
 os.makedirs(STATIC_IMAGES_FOLDER, exist_ok=True)
 os.makedirs(os.path.dirname(PREVIOUS_SEED_FILE), exist_ok=True)
 
-def load_characters(config_path):
-    try:
-        with open(config_path, 'r') as file:
-            return yaml.safe_load(file)
-    except (FileNotFoundError, yaml.YAMLError) as e:
-        print(f"Error loading characters file: {e}", file=sys.stderr)
-        return {}
-
+# Shared by all jobs, so concurrent multi-image jobs can't open unbounded connections
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='comfyui-download')
 
 def get_workflow(character_name, characters):
+    """Return a fresh WorkflowInstance of the character's workflow, or None."""
     workflow_file = characters.get(character_name, {}).get("workflow_file")
     if not workflow_file:
         print(f"Workflow file not specified for character '{character_name}'.", file=sys.stderr)
         return None
 
-    # Check first in temp_workflows directory
-    temp_workflow_path = os.path.join(BASE_DIR, 'temp_workflows', os.path.basename(workflow_file))
-    if os.path.exists(temp_workflow_path):
-        try:
-            with open(temp_workflow_path, "r") as file:
-                workflow = json.load(file)
-                print(f"Loaded temporary workflow for character '{character_name}': {temp_workflow_path}")
-                return workflow
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"Error loading temporary workflow file '{temp_workflow_path}': {e}", file=sys.stderr)
-            # Fall through to try the original workflow file
-
-    # If no temporary workflow exists or failed to load, try the original workflow file
-    workflow_path = os.path.join(BASE_DIR, workflow_file)
     try:
-        with open(workflow_path, "r") as file:
-            workflow = json.load(file)
-            print(f"Loaded original workflow for character '{character_name}': {workflow_path}")
-            return workflow
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"Error loading workflow file '{workflow_path}': {e}", file=sys.stderr)
+        return get_template(workflow_file).instance()
+    except (OSError, ValueError) as e:
+        print(f"Error loading workflow file '{workflow_file}': {e}", file=sys.stderr)
         return None
 
 
-def extract_seed_from_workflow(workflow_data):
-    """Extract the seed value from the workflow data."""
-    try:
-        # Look for the Seed node (node 25) in the workflow
-        if '25' in workflow_data:
-            node_25 = workflow_data['25']
-            if 'inputs' in node_25 and 'seed' in node_25['inputs']:
-                seed = node_25['inputs']['seed']
-                if isinstance(seed, (int, float)) and seed != -1:
-                    print(f"Successfully extracted seed {seed} from workflow")
-                    # Ensure the seed is saved as an integer
-                    return int(seed)
-                else:
-                    print(f"Found invalid seed value: {seed}", file=sys.stderr)
-            else:
-                print("No seed found in node 25 inputs", file=sys.stderr)
-        else:
-            print("Node 25 not found in workflow", file=sys.stderr)
-    except Exception as e:
-        print(f"Error extracting seed from workflow: {e}", file=sys.stderr)
+def extract_seed_from_workflow(workflow):
+    """Extract the seed value from a WorkflowInstance."""
+    seed = workflow.get_input('seed')
+    if isinstance(seed, (int, float)) and seed >= 0:
+        print(f"Successfully extracted seed {seed} from workflow")
+        # Ensure the seed is saved as an integer
+        return int(seed)
+
+    print(f"No valid seed found in workflow (node {workflow.roles.get('seed')}): {seed}", file=sys.stderr)
     return -1
 
 
@@ -111,42 +94,76 @@ def save_seed_to_file(seed):
         print(f"Error saving seed to file {PREVIOUS_SEED_FILE}: {e}", file=sys.stderr)
         return False
 
-def queue_prompt(prompt_text, character_name, characters):
+def queue_prompt(prompt_text, character_name, characters, options=None):
+    """
+    Queue the character's workflow with prompt_text and return
+    (prompt_id, workflow), where workflow is the WorkflowInstance that was
+    sent, or (None, None) on failure.
+    """
     workflow = get_workflow(character_name, characters)
     if not workflow:
         print(f"No valid workflow found for character '{character_name}'.", file=sys.stderr)
-        return None
+        return None, None
 
-    node_id = "6"
-    if node_id not in workflow or "inputs" not in workflow[node_id] or "text" not in workflow[node_id]["inputs"]:
-        print(f"Invalid workflow structure for character '{character_name}'.", file=sys.stderr)
-        return None
+    if not workflow.set_input('text_encoder', prompt_text):
+        print(f"Invalid workflow structure for character '{character_name}': no text encoder node.",
+              file=sys.stderr)
+        return None, None
 
-    workflow[node_id]["inputs"]["text"] = prompt_text
+    if options:
+        apply_workflow_options(workflow, options)
+    workflow.resolve_seed()
     print(f"Queuing prompt '{prompt_text}' for character '{character_name}'.")
 
+    # Queue under the shared websocket's client id so its events reach this process
+    socket = get_websocket()
+    if not socket.wait_connected():
+        print("WebSocket is not connected yet; falling back to polling history.", file=sys.stderr)
+
     try:
-        data = json.dumps({"prompt": workflow, "client_id": CLIENT_ID}).encode('utf-8')
-        req = urllib.request.Request(
-            f"{COMFYUI_BASE_URL}/prompt",
-            data=data,
-            headers={'Content-Type': 'application/json'}
-        )
-
-        with urllib.request.urlopen(req) as response:
-            resp_data = response.read()
-            response_json = json.loads(resp_data)
-            prompt_id = response_json.get("prompt_id")
-            if not prompt_id:
-                print("No prompt_id returned from ComfyUI server.", file=sys.stderr)
-                return None
-            print(f"Prompt ID '{prompt_id}' successfully queued.")
-            return prompt_id
-
-    except (urllib.error.HTTPError, urllib.error.URLError, json.JSONDecodeError) as e:
+        response_json = get_client().queue_prompt(workflow.to_dict(), socket.client_id)
+        prompt_id = response_json.get("prompt_id")
+        if not prompt_id:
+            print("No prompt_id returned from ComfyUI server.", file=sys.stderr)
+            return None, None
+        print(f"Prompt ID '{prompt_id}' successfully queued.")
+        return prompt_id, workflow
+
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Error queuing prompt: {e}", file=sys.stderr)
+        return None, None
+
+
+def websocket_output_node(workflow, character=None):
+    """
+    Return the id of the SaveImageWebsocket node whose images should be
+    collected from the websocket, or None to fetch outputs via history and
+    /view. The workflow decides: ending in a SaveImageWebsocket node selects
+    the websocket. A character's output_mode can override that; 'websocket'
+    raises ValueError if the workflow has no such node.
+    """
+    mode = (character or {}).get('output_mode', 'auto')
+    if mode not in OUTPUT_MODES:
+        logger.warning(f"Unknown output_mode '{mode}', using 'auto'.")
+        mode = 'auto'
+    if mode == 'history':
         return None
 
+    node_id = workflow.roles.get('websocket_output')
+    if node_id is None and mode == 'websocket':
+        raise ValueError("output_mode is 'websocket' but the workflow has no SaveImageWebsocket node")
+    return node_id
+
+
+def character_output_node(character_name, characters):
+    """
+    websocket_output_node for a character's workflow, so it can be checked
+    before anything is queued. Returns None if the workflow can't be loaded;
+    queue_prompt reports that.
+    """
+    workflow = get_workflow(character_name, characters)
+    return websocket_output_node(workflow, characters.get(character_name)) if workflow else None
+
 
 def get_character_directory(character_name):
     directory_name = character_name.replace(' ', '_')
@@ -163,316 +180,291 @@ def generate_image_filename(character_name, index=None):
     return f"{safe_name}_{timestamp}.png"
 
 
-def save_image_with_metadata(image_data, output_path, workflow_data, prompt_id, original_prompt=None):
-    """Save image with properly formatted workflow metadata, matching ComfyUI's exact structure."""
+def reserve_image_path(character_dir, character_name, index=None):
+    """
+    Create an empty file for a new image and return its path. Concurrent
+    jobs can finish within the same second, so a name that is already
+    taken gets a numeric suffix instead of being overwritten.
+    """
+    base, ext = os.path.splitext(generate_image_filename(character_name, index))
+    attempt = 0
+    while True:
+        suffix = f"-{attempt}" if attempt else ""
+        image_path = os.path.join(character_dir, f"{base}{suffix}{ext}")
+        try:
+            os.close(os.open(image_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return image_path
+        except FileExistsError:
+            attempt += 1
+
+
+def generation_info(workflow, prompt_id, character_name=None, user_id=None):
+    """Summary of a generation stored in each image's charactergen chunk, for the image index."""
+    seed = workflow.get_input('seed')
+    checkpoint = workflow.get_input('checkpoint')
+    return {
+        'character': character_name,
+        'user_id': user_id,
+        'prompt_id': prompt_id,
+        'seed': int(seed) if isinstance(seed, (int, float)) and seed >= 0 else None,
+        'checkpoint': checkpoint if isinstance(checkpoint, str) else None,
+        'created_at': datetime.utcnow().isoformat()
+    }
+
+
+def save_image_with_metadata(source_path, output_path, workflow, prompt_id, original_prompt=None,
+                             character_name=None, user_id=None):
+    """
+    Save image with properly formatted workflow metadata, matching ComfyUI's exact structure.
+    The metadata chunks are spliced in while ComfyUI's PNG at source_path is copied, so the
+    pixels are never re-encoded.
+    """
     try:
-        # First save the basic image to ensure we don't lose it
-        with open(output_path, 'wb') as f:
-            f.write(image_data)
-        print(f"Saved basic image: {output_path}")
-
-        # Now open with PIL and add metadata
-        image = Image.open(output_path)
-
         # Print LoRA information for debugging
-        if '21' in workflow_data and 'inputs' in workflow_data['21']:
+        lora_node = workflow.node(workflow.roles.get('lora_loader'))
+        if lora_node and 'inputs' in lora_node:
             print("LoRAs used in generation:")
-            for key, value in workflow_data['21']['inputs'].items():
+            for key, value in lora_node['inputs'].items():
                 if isinstance(value, dict) and 'lora' in value:
                     print(f"  - {value['lora']} (strength: {value.get('strength', 1.0)})")
 
-        # Build list of links from workflow data
-        links = []
-        link_id = 0
-        link_map = {}  # Map from (origin_node_id, origin_slot, target_node_id, target_slot) to link_id
-        nodes_dict = {}  # Map node_id to node dict
-        for node_id_str, node_data in workflow_data.items():
-            if not node_id_str.isdigit():
-                continue
-            node_id = int(node_id_str)
-            nodes_dict[node_id] = node_data
-
-        # First pass: Prepare nodes with inputs and outputs
-        nodes = []
-        for node_id, node_data in nodes_dict.items():
-            # Base node structure
-            node = {
-                "id": node_id,
-                "type": node_data.get("class_type", ""),
-                "pos": {"0": 0, "1": 0},  # Default position
-                "size": {"0": 315, "1": 98},  # Default size
-                "flags": {},
-                "order": node_id,
-                "mode": 0,
-                "inputs": [],
-                "outputs": [],
-                "properties": {"Node name for S&R": node_data.get("class_type", "")},
-                "widgets_values": node_data.get("widgets_values", [])
-            }
-
-            input_names = list(node_data.get("inputs", {}).keys())
-            input_names_to_slot_index = {}
-            for idx, input_name in enumerate(input_names):
-                input_names_to_slot_index[input_name] = idx
-                input_value = node_data["inputs"][input_name]
-                node['inputs'].append({
-                    'name': input_name,
-                    'type': input_name.upper(),
-                    'links': [],
-                    'slot_index': idx
-                })
-
-            # Outputs will be determined based on links
-            node['output_names_to_slot_index'] = {}
-
-            nodes.append(node)
-            node_data['node_struct'] = node  # Save reference for later
-
-        # Second pass: Build links and update nodes
-        for node_id, node_data in nodes_dict.items():
-            node = node_data['node_struct']
-            input_names_to_slot_index = {inp['name']: inp['slot_index'] for inp in node['inputs']}
-
-            for input_name, input_value in node_data.get('inputs', {}).items():
-                if isinstance(input_value, list) and len(input_value) == 2:
-                    source_node_id = int(input_value[0])
-                    source_output_slot_index = int(input_value[1])
-                    target_node_id = node_id
-                    target_input_slot_index = input_names_to_slot_index[input_name]
-
-                    # Create a unique key for the link
-                    link_key = (source_node_id, source_output_slot_index, target_node_id, target_input_slot_index)
-                    if link_key not in link_map:
-                        # Create link
-                        link = [
-                            link_id,
-                            source_node_id,
-                            source_output_slot_index,
-                            target_node_id,
-                            target_input_slot_index,
-                            input_name.upper()
-                        ]
-                        links.append(link)
-                        link_map[link_key] = link_id
-                        link_id += 1
-                    else:
-                        link_id = link_map[link_key]
-
-                    # Update target node's input
-                    node['inputs'][target_input_slot_index]['links'].append(link_id)
-
-                    # Update source node's outputs
-                    source_node_data = nodes_dict[source_node_id]
-                    source_node = source_node_data['node_struct']
-                    output_slot_index = source_output_slot_index
-                    outputs = source_node['outputs']
-
-                    # Ensure the output slot exists
-                    while len(outputs) <= output_slot_index:
-                        outputs.append({
-                            'name': '',  # Optionally set the output name
-                            'type': '',  # Optionally set the output type
-                            'links': [],
-                            'slot_index': len(outputs)
-                        })
-
-                    # Update source node's output
-                    source_node['outputs'][output_slot_index]['links'].append(link_id)
-
-            # Special handling for the Power Lora Loader node
-            if node_data.get("class_type") == "Power Lora Loader (rgthree)":
-                node["properties"]["Show Strengths"] = "Single Strength"
-                node["size"] = {"0": 340.20001220703125, "1": 166}
-
-                widgets_values = [
-                    None,
-                    {"type": "PowerLoraLoaderHeaderWidget"}
-                ]
-
-                # Add active LoRAs
-                inputs = node_data.get("inputs", {})
-                for key in sorted([k for k in inputs.keys() if k.startswith("lora_")]):
-                    lora_data = inputs[key]
-                    if isinstance(lora_data, dict):
-                        widgets_values.append({
-                            "on": lora_data.get("on", True),
-                            "lora": lora_data.get("lora", ""),
-                            "strength": lora_data.get("strength", 1),
-                            "strengthTwo": None
-                        })
-
-                # Add remaining required values
-                widgets_values.extend([None, ""])
-                node["widgets_values"] = widgets_values
-
-        # Remove temporary mappings from nodes
-        for node_data in nodes_dict.values():
-            node_data['node_struct'].pop('output_names_to_slot_index', None)
-
-        # Create complete workflow metadata
-        workflow_metadata = {
-            "last_node_id": max(nodes_dict.keys(), default=0),
-            "last_link_id": len(links),
-            "nodes": nodes,
-            "links": links,
-            "groups": [],
-            "config": {},
-            "extra": {
-                "ds": {
-                    "scale": 0.9849732675808478,
-                    "offset": [687.2656309965016, 400.0081852783683]
-                }
-            },
-            "version": 0.4,
-            "widget_idx_map": {
-                "17": {"sampler_name": 0},
-                "18": {"scheduler": 0},
-                "19": {"noise_seed": 0}
-            },
-            "seed_widgets": {"19": 0}
-        }
-
-        # Save metadata to image
-        png_info = PngInfo()
-
         # Add prompt metadata (as per ComfyUI's format)
-        prompt_text = workflow_data.get('6', {}).get('inputs', {}).get('text', '')
-        png_info.add_text("prompt", prompt_text)
-
-        # Add complete workflow metadata using add_itxt
-        # This ensures that large data is properly stored
-        png_info.add_itxt(
-            "workflow",
-            json.dumps(workflow_metadata),
-            lang="en",
-            tkey="workflow",
-            compressed=True
-        )
-
-        # Save the image with metadata
-        image.save(output_path, 'PNG', pnginfo=png_info)
-        print(f"Added metadata to image: {output_path}")
+        prompt_text = workflow.get_input('text_encoder', default='')
+
+        # The UI graph and its compressed iTXt chunk are shared by every image with the same settings
+        workflow_metadata, workflow_chunk = workflow_chunks.get(workflow)
+        chunks = [
+            text_chunk("prompt", prompt_text),
+            workflow_chunk,
+            text_chunk("charactergen", json.dumps(generation_info(workflow, prompt_id, character_name, user_id)))
+        ]
+
+        # Write the image with metadata in a single pass
+        write_png_with_metadata(output_path, source_path, chunks)
+        print(f"Saved image with metadata: {output_path}")
         print("Saved both prompt and workflow metadata")
-        print(f"Number of nodes in workflow: {len(nodes)}")
-        print(f"Number of links in workflow: {len(links)}")
+        print(f"Number of nodes in workflow: {len(workflow_metadata['nodes'])}")
+        print(f"Number of links in workflow: {len(workflow_metadata['links'])}")
 
         return True
 
     except Exception as e:
         print(f"Error in save_image_with_metadata: {e}", file=sys.stderr)
+        # Keep the image even if its metadata couldn't be added
+        try:
+            copy_atomic(source_path, output_path)
+            print(f"Saved basic image: {output_path}")
+        except OSError as write_error:
+            print(f"Error saving image {output_path}: {write_error}", file=sys.stderr)
         return False
 
 
 
-def get_prompt_from_history(history):
-    """Extract prompt from history data regardless of structure."""
+def get_history(prompt_id):
     try:
-        prompt_data = history.get('prompt', {})
-
-        # If prompt_data is a list (array of nodes)
-        if isinstance(prompt_data, list):
-            for node in prompt_data:
-                if isinstance(node, dict) and node.get('id') == 6:
-                    return node.get('inputs', {}).get('text', '')
+        history = get_client().get_history(prompt_id)
+        if not history:
+            print(f"No history found for prompt_id: {prompt_id}", file=sys.stderr)
+        return history
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Error fetching history: {e}", file=sys.stderr)
+        return None
 
-        # If prompt_data is a dict (map of nodes)
-        elif isinstance(prompt_data, dict):
-            node_6 = prompt_data.get('6', {})
-            if isinstance(node_6, dict):
-                return node_6.get('inputs', {}).get('text', '')
 
-        print(f"Warning: Could not find prompt text in history data structure: {type(prompt_data)}", file=sys.stderr)
+def local_output_path(image_info):
+    """Return the path of an output image in ComfyUI's local folders, or None if it isn't reachable."""
+    base_dir = LOCAL_OUTPUT_DIRS.get(image_info.get('type'))
+    if not base_dir:
         return None
 
-    except Exception as e:
-        print(f"Error extracting prompt from history: {e}", file=sys.stderr)
+    base_dir = os.path.realpath(base_dir)
+    path = os.path.realpath(os.path.join(base_dir, image_info.get('subfolder') or '', image_info['filename']))
+    # The names come from ComfyUI's history; never follow them outside its folder
+    if os.path.commonpath([base_dir, path]) != base_dir or not os.path.isfile(path):
         return None
+    return path
 
 
-def get_history(prompt_id):
-    url = f"{COMFYUI_BASE_URL}/history/{prompt_id}"
+def link_local_output(source_path, prompt_id):
+    """
+    Hard-link a local ComfyUI output into the temp directory, so it survives
+    ComfyUI cleaning up its temp folder. If the two are on different file
+    systems the source is used in place; remove_downloads leaves it alone.
+    """
+    temp_path = os.path.join(TEMP_DIR, f"{prompt_id}-{uuid.uuid4().hex}{os.path.splitext(source_path)[1]}")
     try:
-        with urllib.request.urlopen(url) as response:
-            history_json = json.loads(response.read())
-            history = history_json.get(prompt_id, {})
-            if not history:
-                print(f"No history found for prompt_id: {prompt_id}", file=sys.stderr)
-            return history
-    except (urllib.error.HTTPError, urllib.error.URLError, json.JSONDecodeError) as e:
-        print(f"Error fetching history: {e}", file=sys.stderr)
-        return None
-
-
-def get_image(filename, subfolder, folder_type):
+        os.link(source_path, temp_path)
+        return temp_path
+    except OSError:
+        return source_path
+
+
+def download_image(image_info, prompt_id):
+    """
+    Fetch one output image and return a local path to it, or None.
+    Outputs in ComfyUI's local folders are linked; others are streamed from /view into a temp file.
+    """
+    filename = image_info.get('filename')
+    folder_type = image_info.get('type')
     if not filename or not folder_type:
         print("Incomplete image information.", file=sys.stderr)
         return None
 
-    url = f"{COMFYUI_BASE_URL}/view?filename={filename}&subfolder={subfolder}&type={folder_type}"
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    source_path = local_output_path(image_info)
+    if source_path:
+        return link_local_output(source_path, prompt_id)
 
+    fd, temp_path = tempfile.mkstemp(dir=TEMP_DIR, prefix=f"{prompt_id}-",
+                                     suffix=os.path.splitext(filename)[1] or '.png')
     try:
-        with urllib.request.urlopen(url) as response:
-            return response.read()
-    except (urllib.error.HTTPError, urllib.error.URLError) as e:
-        print(f"Error fetching image: {e}", file=sys.stderr)
+        with os.fdopen(fd, 'wb') as f:
+            get_client().download_image(filename, image_info.get('subfolder'), folder_type, f)
+        return temp_path
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"Error fetching image {filename}: {e}", file=sys.stderr)
+        remove_downloads([(temp_path, filename)])
         return None
 
 
-def get_images_via_websocket(prompt_id, timeout=TIMEOUT):
-    ws_url = f"{COMFYUI_WS_URL}/ws?clientId={CLIENT_ID}"
-    ws = websocket.WebSocket()
-    generated_images = []
+def download_images(prompt_id, history):
+    """
+    Download every output image listed in a prompt's history in parallel.
+    Returns (temp_path, original_filename) pairs in output order.
+    """
+    image_infos = [image_info for node_output in history.get('outputs', {}).values()
+                   for image_info in node_output.get('images', [])]
+    futures = [_download_pool.submit(download_image, image_info, prompt_id) for image_info in image_infos]
+
+    downloaded = []
+    for image_info, future in zip(image_infos, futures):
+        temp_path = future.result()
+        if temp_path:
+            downloaded.append((temp_path, image_info.get('filename')))
+        else:
+            print("No image data found for the image.")
+    return downloaded
+
+
+def save_websocket_image(image_data, image_format, prompt_id, index):
+    """Write an image received from a SaveImageWebsocket node to a temp file; returns (temp_path, filename)."""
+    ext = '.png' if image_format == 'png' else '.jpg'
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=TEMP_DIR, prefix=f"{prompt_id}-", suffix=ext)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(image_data)
+    return temp_path, f"{prompt_id}_{index:05}{ext}"
+
+
+def remove_downloads(images):
+    """Delete the temp files returned by download_images, leaving ComfyUI's own files in place."""
+    temp_dir = os.path.realpath(TEMP_DIR)
+    for temp_path, _ in images:
+        if os.path.dirname(os.path.realpath(temp_path)) != temp_dir:
+            continue
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing temp file {temp_path}: {e}", file=sys.stderr)
 
-    try:
-        ws.connect(ws_url)
-    except websocket.WebSocketException as e:
-        print(f"WebSocket connection failed: {e}", file=sys.stderr)
-        return [], None
 
-    start_time = time.time()
+def prompt_finished(prompt_id):
+    """Check ComfyUI's history for a finished prompt."""
+    history = get_history(prompt_id)
+    return bool(history and history.get('outputs'))
+
+
+def wait_for_prompt(prompt_id, timeout=TIMEOUT, on_progress=None, on_preview=None,
+                    output_node=None, on_output=None):
+    """
+    Wait on the shared websocket until ComfyUI has finished executing prompt_id.
+    on_progress(value, max) receives sampler progress and on_preview(image, format)
+    the latent preview frames ComfyUI sends while rendering. Image frames sent
+    while output_node executes go to on_output(image, format) instead.
+    Returns True when the prompt finished, False on error or timeout.
+    """
+    socket = get_websocket()
+    waiter = socket.watch(prompt_id)
+    epoch = socket.epoch
+    deadline = time.time() + timeout
+
     try:
         while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                print("Image generation timed out.", file=sys.stderr)
+                return False
+
             try:
-                message = ws.recv()
-                if isinstance(message, str):
-                    message_json = json.loads(message)
-                    if message_json.get('type') == 'executing' and \
-                            message_json.get('data', {}).get('prompt_id') == prompt_id:
-                        if message_json['data'].get('node') is None:
-                            break
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON message: {e}", file=sys.stderr)
+                event_type, data = waiter.get(timeout=min(remaining, socket.recv_timeout))
+            except queue.Empty:
+                # Events sent while the socket was down are lost, so ask the history instead
+                if socket.epoch != epoch or not socket.connected:
+                    epoch = socket.epoch
+                    if prompt_finished(prompt_id):
+                        return True
                 continue
 
-            if time.time() - start_time > timeout:
-                print("Image generation timed out.", file=sys.stderr)
-                break
-    except websocket.WebSocketException as e:
-        print(f"WebSocket error: {e}", file=sys.stderr)
+            if event_type == 'progress':
+                if on_progress:
+                    on_progress(data.get('value', 0), data.get('max', 0))
+                continue
+            if event_type == 'preview':
+                if output_node is not None and data.get('node') == output_node:
+                    if on_output:
+                        on_output(data['image'], data['format'])
+                elif on_preview:
+                    on_preview(data['image'], data['format'])
+                continue
+            if event_type == 'executing' and data.get('node') is None:
+                return True
+            if event_type == 'execution_success':
+                return True
+            if event_type in ('execution_error', 'execution_interrupted'):
+                print(f"ComfyUI reported {event_type} for prompt {prompt_id}: "
+                      f"{data.get('exception_message', '')}", file=sys.stderr)
+                return False
     finally:
-        ws.close()
+        socket.unwatch(prompt_id)
+
+
+def get_images_via_websocket(prompt_id, timeout=TIMEOUT, on_progress=None, on_preview=None, output_node=None):
+    """
+    Wait for a prompt and download its output images to temp files.
+    Returns ([(temp_path, original_filename), ...], history); the caller
+    removes the files with remove_downloads once it's done with them.
+
+    With output_node (see websocket_output_node) the images are the frames
+    that node streams over the websocket, and history and /view are skipped;
+    history is then None.
+    """
+    if output_node is not None:
+        images = []
+
+        def on_output(image_data, image_format):
+            try:
+                images.append(save_websocket_image(image_data, image_format, prompt_id, len(images)))
+            except OSError as e:
+                print(f"Error saving websocket image: {e}", file=sys.stderr)
+
+        finished = wait_for_prompt(prompt_id, timeout=timeout, on_progress=on_progress, on_preview=on_preview,
+                                   output_node=output_node, on_output=on_output)
+        if finished and not images:
+            print("No images were received over the websocket.", file=sys.stderr)
+        return images, None
+
+    wait_for_prompt(prompt_id, timeout=timeout, on_progress=on_progress, on_preview=on_preview)
 
     history = get_history(prompt_id)
     if not history:
         print("No history data retrieved.", file=sys.stderr)
         return [], None
 
-    for node_id, node_output in history.get('outputs', {}).items():
-        if 'images' in node_output:
-            for image_info in node_output['images']:
-                image_data = get_image(
-                    image_info.get('filename'),
-                    image_info.get('subfolder'),
-                    image_info.get('type')
-                )
-                if image_data:
-                    generated_images.append((image_data, image_info.get('filename')))
-                else:
-                    print("No image data found for the image.")
-
-    return generated_images, history
-
-def save_user_latest_image(image_data, user_id):
+    return download_images(prompt_id, history), history
+
+def save_user_latest_image(image_path, user_id):
     """Save image to user's specific directory."""
     try:
         # Create user directory if it doesn't exist
@@ -481,25 +473,28 @@ def save_user_latest_image(image_data, user_id):
 
         # Save image to user's directory
         user_image_path = os.path.join(user_image_dir, LATEST_IMAGE_NAME)
-        with open(user_image_path, 'wb') as f:
-            f.write(image_data)
+        copy_atomic(image_path, user_image_path)
         print(f"Saved user's latest image: {user_image_path}")
         return True
     except Exception as e:
         print(f"Error saving user's latest image: {e}", file=sys.stderr)
         return False
 
-def save_images(images, prompt_id, character_name, history):
-    """Save generated images with metadata."""
+def save_images(images, prompt_id, character_name, workflow, user_id=None, save_seed=True, save_latest=True):
+    """
+    Save downloaded images (from get_images_via_websocket) with metadata from
+    the WorkflowInstance that was queued, and add them to the image index.
+    With save_seed the seed becomes the "use last seed" value, and with
+    save_latest the first image becomes user_id's latest image.
+    """
     if not images:
         print("No images to save.", file=sys.stderr)
-        return
+        return []
 
-    workflow_data = history.get('prompt', {})
-    prompt_text = get_prompt_from_history(history)
+    prompt_text = workflow.get_input('text_encoder')
 
-    seed = extract_seed_from_workflow(workflow_data)
-    if seed != -1:
+    seed = extract_seed_from_workflow(workflow)
+    if seed != -1 and save_seed:
         print(f"Found seed: {seed}")
         if save_seed_to_file(seed):
             print(f"Successfully saved seed {seed} to file")
@@ -509,14 +504,14 @@ def save_images(images, prompt_id, character_name, history):
     if prompt_text:
         print(f"Saving images with prompt: {prompt_text}")
 
+    latest_saved = False
     try:
         if images:  # Check if we have any images
-            image_data, _ = images[0]  # Get the first image
-            
+            image_path, _ = images[0]  # Get the first image
+
             # Save to user-specific directory if user_id is available
-            if 'user_id' in os.environ:
-                user_id = int(os.environ['user_id'])
-                save_user_latest_image(image_data, user_id)
+            if user_id is not None and save_latest:
+                latest_saved = save_user_latest_image(image_path, user_id)
 
     except Exception as e:
         print(f"Error saving latest image: {e}", file=sys.stderr)
@@ -525,35 +520,50 @@ def save_images(images, prompt_id, character_name, history):
     character_dir = get_character_directory(character_name)
     print(f"Saving to character directory: {character_dir}")
 
-    for idx, (image_data, original_filename) in enumerate(images):
+    saved_paths = []
+    for idx, (source_path, original_filename) in enumerate(images):
         try:
-            image_filename = generate_image_filename(character_name, idx if len(images) > 1 else None)
-            image_path = os.path.join(character_dir, image_filename)
-            save_image_with_metadata(image_data, image_path, workflow_data, prompt_id, prompt_text)
+            image_path = reserve_image_path(character_dir, character_name, idx if len(images) > 1 else None)
+            save_image_with_metadata(source_path, image_path, workflow, prompt_id, prompt_text,
+                                     character_name=character_name, user_id=user_id)
+            saved_paths.append(image_path)
             print(f"Saved character image with metadata: {image_path}")
+            # Render the browser's thumbnail and preview while the image is still in the page cache
+            derivatives.schedule(os.path.relpath(image_path, IMAGES_FOLDER))
         except Exception as e:
             print(f"Error processing image {idx}: {e}", file=sys.stderr)
 
+    image_index.saved(saved_paths, user_id=user_id, latest=latest_saved)
+    return saved_paths
+
 
-def main(prompt_text, character_name):
-    config_path = os.path.join(BASE_DIR, 'config', 'characters.yaml')
-    characters = load_characters(config_path)
+def main(prompt_text, character_name, user_id=None):
+    characters = character_registry.all()
 
     if character_name not in characters:
         print(f"Character '{character_name}' not found in configuration.", file=sys.stderr)
         return
 
-    prompt_id = queue_prompt(prompt_text, character_name, characters)
+    try:
+        output_node = character_output_node(character_name, characters)
+    except ValueError as e:
+        print(f"{e}. Exiting.", file=sys.stderr)
+        return
+
+    prompt_id, workflow = queue_prompt(prompt_text, character_name, characters)
     if not prompt_id:
         print("Failed to queue prompt. Exiting.", file=sys.stderr)
         return
 
-    images, history = get_images_via_websocket(prompt_id)
+    images, history = get_images_via_websocket(prompt_id, output_node=output_node)
     if not images:
         print("No images were generated.", file=sys.stderr)
         return
 
-    save_images(images, prompt_id, character_name, history)
+    try:
+        save_images(images, prompt_id, character_name, workflow, user_id=user_id)
+    finally:
+        remove_downloads(images)
 
 
 if __name__ == "__main__":
@@ -564,4 +574,4 @@ if __name__ == "__main__":
         prompt = input("Enter a prompt for image generation: ")
         character = input("Enter the character name: ")
 
-    main(prompt, character)
\ No newline at end of file
+    main(prompt, character, int(os.environ['user_id']) if 'user_id' in os.environ else None)
\ No newline at end of file
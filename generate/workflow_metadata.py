@@ -0,0 +1,237 @@
+"""
+ComfyUI UI-format workflow metadata for saved images.
+
+ComfyUI's editor loads a node/link graph from an image's 'workflow' text
+chunk, while jobs only have the API-format workflow. Rebuilding that graph
+and compressing it is the costliest part of saving an image, and it only
+depends on the workflow's structure and LoRA settings, so the finished
+chunk is cached by a hash of exactly that.
+"""
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from config.config_utils import config
+from generate.png_metadata import itxt_chunk
+from generate.workflows import LORA_LOADER_CLASS, SEED_INPUTS
+
+CACHE_SIZE = config.get('metadata', 'workflow_cache_size', default=64)
+
+
+def graph_source(workflow):
+    """
+    Reduce a WorkflowInstance to the parts build_ui_workflow reads: node
+    types, input names, links, widget values and the LoRA loader's inputs.
+    Prompts, seeds and other plain values don't change the graph.
+    Returns (source, seed_node_id, seed_key).
+    """
+    source = {}
+    for node_id, node_data in workflow.to_dict().items():
+        if not isinstance(node_data, dict):
+            continue
+        keep_values = node_data.get("class_type") == LORA_LOADER_CLASS
+        source[node_id] = {
+            "class_type": node_data.get("class_type", ""),
+            "widgets_values": node_data.get("widgets_values", []),
+            "inputs": {
+                name: value if keep_values or (isinstance(value, list) and len(value) == 2) else None
+                for name, value in node_data.get("inputs", {}).items()
+            }
+        }
+
+    seed_node_id = workflow.roles.get('seed')
+    seed_key = next((k for k in SEED_INPUTS if k in source[seed_node_id]['inputs']),
+                    None) if seed_node_id else None
+    return source, seed_node_id, seed_key
+
+
+def build_ui_workflow(workflow_data, seed_node_id=None, seed_key=None):
+    """Rebuild ComfyUI's UI-format graph (nodes, links, widgets) from an API-format workflow."""
+    # Build list of links from workflow data
+    links = []
+    link_id = 0
+    link_map = {}  # Map from (origin_node_id, origin_slot, target_node_id, target_slot) to link_id
+    nodes_dict = {}  # Map node_id to node dict
+    node_structs = {}  # Map node_id to the UI node being built; the workflow itself is left untouched
+    for node_id_str, node_data in workflow_data.items():
+        if not node_id_str.isdigit():
+            continue
+        node_id = int(node_id_str)
+        nodes_dict[node_id] = node_data
+
+    # First pass: Prepare nodes with inputs and outputs
+    nodes = []
+    for node_id, node_data in nodes_dict.items():
+        # Base node structure
+        node = {
+            "id": node_id,
+            "type": node_data.get("class_type", ""),
+            "pos": {"0": 0, "1": 0},  # Default position
+            "size": {"0": 315, "1": 98},  # Default size
+            "flags": {},
+            "order": node_id,
+            "mode": 0,
+            "inputs": [],
+            "outputs": [],
+            "properties": {"Node name for S&R": node_data.get("class_type", "")},
+            "widgets_values": node_data.get("widgets_values", [])
+        }
+
+        input_names = list(node_data.get("inputs", {}).keys())
+        input_names_to_slot_index = {}
+        for idx, input_name in enumerate(input_names):
+            input_names_to_slot_index[input_name] = idx
+            input_value = node_data["inputs"][input_name]
+            node['inputs'].append({
+                'name': input_name,
+                'type': input_name.upper(),
+                'links': [],
+                'slot_index': idx
+            })
+
+        # Outputs will be determined based on links
+        node['output_names_to_slot_index'] = {}
+
+        nodes.append(node)
+        node_structs[node_id] = node
+
+    # Second pass: Build links and update nodes
+    for node_id, node_data in nodes_dict.items():
+        node = node_structs[node_id]
+        input_names_to_slot_index = {inp['name']: inp['slot_index'] for inp in node['inputs']}
+
+        for input_name, input_value in node_data.get('inputs', {}).items():
+            if isinstance(input_value, list) and len(input_value) == 2:
+                source_node_id = int(input_value[0])
+                source_output_slot_index = int(input_value[1])
+                target_node_id = node_id
+                target_input_slot_index = input_names_to_slot_index[input_name]
+
+                # Create a unique key for the link
+                link_key = (source_node_id, source_output_slot_index, target_node_id, target_input_slot_index)
+                if link_key not in link_map:
+                    # Create link
+                    link = [
+                        link_id,
+                        source_node_id,
+                        source_output_slot_index,
+                        target_node_id,
+                        target_input_slot_index,
+                        input_name.upper()
+                    ]
+                    links.append(link)
+                    link_map[link_key] = link_id
+                    link_id += 1
+                else:
+                    link_id = link_map[link_key]
+
+                # Update target node's input
+                node['inputs'][target_input_slot_index]['links'].append(link_id)
+
+                # Update source node's outputs
+                source_node = node_structs[source_node_id]
+                output_slot_index = source_output_slot_index
+                outputs = source_node['outputs']
+
+                # Ensure the output slot exists
+                while len(outputs) <= output_slot_index:
+                    outputs.append({
+                        'name': '',  # Optionally set the output name
+                        'type': '',  # Optionally set the output type
+                        'links': [],
+                        'slot_index': len(outputs)
+                    })
+
+                # Update source node's output
+                source_node['outputs'][output_slot_index]['links'].append(link_id)
+
+        # Special handling for the Power Lora Loader node
+        if node_data.get("class_type") == LORA_LOADER_CLASS:
+            node["properties"]["Show Strengths"] = "Single Strength"
+            node["size"] = {"0": 340.20001220703125, "1": 166}
+
+            widgets_values = [
+                None,
+                {"type": "PowerLoraLoaderHeaderWidget"}
+            ]
+
+            # Add active LoRAs
+            inputs = node_data.get("inputs", {})
+            for key in sorted([k for k in inputs.keys() if k.startswith("lora_")]):
+                lora_data = inputs[key]
+                if isinstance(lora_data, dict):
+                    widgets_values.append({
+                        "on": lora_data.get("on", True),
+                        "lora": lora_data.get("lora", ""),
+                        "strength": lora_data.get("strength", 1),
+                        "strengthTwo": None
+                    })
+
+            # Add remaining required values
+            widgets_values.extend([None, ""])
+            node["widgets_values"] = widgets_values
+
+    # Remove temporary mappings from nodes
+    for node in node_structs.values():
+        node.pop('output_names_to_slot_index', None)
+
+    # Create complete workflow metadata
+    return {
+        "last_node_id": max(nodes_dict.keys(), default=0),
+        "last_link_id": len(links),
+        "nodes": nodes,
+        "links": links,
+        "groups": [],
+        "config": {},
+        "extra": {
+            "ds": {
+                "scale": 0.9849732675808478,
+                "offset": [687.2656309965016, 400.0081852783683]
+            }
+        },
+        "version": 0.4,
+        "widget_idx_map": {
+            "17": {"sampler_name": 0},
+            "18": {"scheduler": 0},
+            **({seed_node_id: {seed_key: 0}} if seed_node_id else {})
+        },
+        "seed_widgets": {seed_node_id: 0} if seed_node_id else {}
+    }
+
+
+class WorkflowChunkCache:
+    """LRU of compressed 'workflow' iTXt chunks keyed by a hash of their graph source."""
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, workflow):
+        """Return (ui_workflow, chunk) for a WorkflowInstance, building them on a miss."""
+        source, seed_node_id, seed_key = graph_source(workflow)
+        key = hashlib.sha256(
+            json.dumps([source, seed_node_id, seed_key], sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        ui_workflow = build_ui_workflow(source, seed_node_id, seed_key)
+        chunk = itxt_chunk("workflow", json.dumps(ui_workflow), compressed=True,
+                           lang="en", translated_key="workflow")
+
+        with self._lock:
+            self._entries[key] = (ui_workflow, chunk)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return ui_workflow, chunk
+
+
+# Global workflow chunk cache instance
+workflow_chunks = WorkflowChunkCache()
@@ -0,0 +1,309 @@
+"""
+ComfyUI workflow templates.
+
+Each workflow file is parsed once and cached by its modification time,
+along with an index of which node plays which role (text encoder,
+checkpoint loader, ...) found from the class_type graph. Jobs get a cheap
+WorkflowInstance that only copies the nodes it actually changes.
+"""
+import os
+import sys
+import json
+import random
+import threading
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREVIOUS_SEED_FILE = os.path.join(BASE_DIR, 'static', 'previous_seed.txt')
+
+LORA_LOADER_CLASS = 'Power Lora Loader (rgthree)'
+# Output node that streams its images over the websocket instead of saving them
+WEBSOCKET_OUTPUT_CLASS = 'SaveImageWebsocket'
+# KSampler-style nodes take 'seed', RandomNoise takes 'noise_seed'
+SEED_INPUTS = ('seed', 'noise_seed')
+# Largest seed the browser can round-trip through a JSON number
+MAX_SEED = 2 ** 53 - 1
+# Advanced Options keys understood by apply_workflow_options
+WORKFLOW_OPTION_KEYS = ('checkpointModel', 'width', 'height', 'guidance', 'seed', 'useLastSeed', 'loras')
+# Types each option must have
+OPTION_TYPES = {
+    'checkpointModel': str,
+    'width': int,
+    'height': int,
+    'guidance': (int, float),
+    'seed': int,
+    'useLastSeed': bool,
+    'loras': list,
+}
+
+# Node classes that fill each role
+NODE_ROLES = {
+    'text_encoder': ('CLIPTextEncode',),
+    'checkpoint': ('CheckpointLoaderSimple', 'CheckpointLoader'),
+    'latent': ('EmptyLatentImage', 'EmptySD3LatentImage'),
+    'guidance': ('FluxGuidance',),
+    'seed': ('RandomNoise', 'KSampler', 'KSamplerAdvanced'),
+    'lora_loader': (LORA_LOADER_CLASS,),
+    'output': ('SaveImage', 'PreviewImage', WEBSOCKET_OUTPUT_CLASS),
+    'websocket_output': (WEBSOCKET_OUTPUT_CLASS,),
+}
+# The inputs a role's value lives in; also used to spot custom nodes not listed above
+ROLE_INPUTS = {
+    'text_encoder': ('text',),
+    'checkpoint': ('ckpt_name',),
+    'latent': ('width', 'height'),
+    'guidance': ('guidance',),
+    'seed': SEED_INPUTS,
+}
+# Inputs that carry positive conditioning towards the sampler
+CONDITIONING_INPUTS = ('positive', 'conditioning')
+
+
+def _sort_key(node_id):
+    return (0, int(node_id), '') if str(node_id).isdigit() else (1, 0, str(node_id))
+
+
+class WorkflowTemplate:
+    """A parsed workflow file and its role index. Treat nodes as read-only."""
+
+    def __init__(self, path, nodes, mtime=None):
+        self.path = path
+        self.nodes = nodes
+        self.mtime = mtime
+        self.roles = self._index_roles()
+
+    @classmethod
+    def load(cls, path):
+        """Parse a workflow file; raises OSError or ValueError."""
+        stat = os.stat(path)
+        with open(path, 'r') as f:
+            nodes = json.load(f)
+        if not isinstance(nodes, dict):
+            raise ValueError(f"Workflow {path} is not in ComfyUI API format")
+        return cls(path, nodes, (stat.st_mtime_ns, stat.st_size))
+
+    def _index_roles(self):
+        roles = {}
+        node_ids = sorted((nid for nid, node in self.nodes.items() if isinstance(node, dict)), key=_sort_key)
+
+        for role, classes in NODE_ROLES.items():
+            matches = [nid for nid in node_ids if self.nodes[nid].get('class_type') in classes]
+            if not matches and role in ROLE_INPUTS:
+                # Unknown node types still count if they carry the role's inputs
+                keys = ROLE_INPUTS[role]
+                needs_all = role == 'latent'
+                matches = [nid for nid in node_ids
+                           if (all if needs_all else any)(k in self.nodes[nid].get('inputs', {}) for k in keys)]
+            if not matches:
+                continue
+            if role == 'text_encoder' and len(matches) > 1:
+                roles[role] = self._positive_encoder(matches)
+            else:
+                roles[role] = matches[0]
+        return roles
+
+    def _positive_encoder(self, encoders):
+        """Pick the text encoder that feeds the sampler's positive conditioning."""
+        positive = set()
+        pending = [value[0] for node in self.nodes.values() if isinstance(node, dict)
+                   for key, value in node.get('inputs', {}).items()
+                   if key in CONDITIONING_INPUTS and isinstance(value, list) and value]
+        seen = set()
+        while pending:
+            node_id = str(pending.pop())
+            if node_id in seen or node_id not in self.nodes:
+                continue
+            seen.add(node_id)
+            if node_id in encoders:
+                positive.add(node_id)
+                continue
+            pending.extend(value[0] for key, value in self.nodes[node_id].get('inputs', {}).items()
+                           if key in CONDITIONING_INPUTS and isinstance(value, list) and value)
+
+        return next((nid for nid in encoders if nid in positive), encoders[0])
+
+    def instance(self):
+        return WorkflowInstance(self)
+
+
+class WorkflowInstance:
+    """One job's view of a template; nodes are copied the first time they are changed."""
+
+    def __init__(self, template):
+        self.template = template
+        self.roles = template.roles
+        self._nodes = dict(template.nodes)
+        self._owned = set()
+
+    def node(self, node_id):
+        return self._nodes.get(node_id)
+
+    def writable(self, node_id):
+        """Return node_id's node, copying it (and its inputs) away from the template first."""
+        if node_id not in self._owned:
+            node = self._nodes[node_id]
+            self._nodes[node_id] = dict(node, inputs=dict(node.get('inputs', {})))
+            self._owned.add(node_id)
+        return self._nodes[node_id]
+
+    def _input_key(self, role, key):
+        node_id = self.roles.get(role)
+        if node_id is None:
+            return None, None
+        if key is None:
+            inputs = self._nodes[node_id].get('inputs', {})
+            key = next((k for k in ROLE_INPUTS.get(role, ()) if k in inputs), None)
+        return node_id, key
+
+    def get_input(self, role, key=None, default=None):
+        """Read an input of the node filling role (its main input unless key is given)."""
+        node_id, key = self._input_key(role, key)
+        if key is None:
+            return default
+        return self._nodes[node_id].get('inputs', {}).get(key, default)
+
+    def set_input(self, role, value, key=None):
+        """Set an input of the node filling role; returns False if the workflow has no such node."""
+        node_id, key = self._input_key(role, key)
+        if key is None:
+            return False
+        self.writable(node_id)['inputs'][key] = value
+        return True
+
+    def resolve_seed(self):
+        """Replace a seed of -1 with a random one and return the seed that will be used."""
+        seed = self.get_input('seed')
+        if isinstance(seed, (int, float)) and seed < 0:
+            seed = random.randint(0, MAX_SEED)
+            self.set_input('seed', seed)
+        return seed
+
+    def to_dict(self):
+        """The workflow in API format, ready to send to /prompt or dump to JSON."""
+        return self._nodes
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(workflow_file):
+    """
+    Return the parsed template for a workflow file (relative to the project
+    root or absolute), re-reading it only when the file has changed.
+    Raises OSError or ValueError if the file can't be loaded.
+    """
+    path = workflow_file if os.path.isabs(workflow_file) else os.path.join(BASE_DIR, workflow_file)
+    stat = os.stat(path)
+    with _templates_lock:
+        template = _templates.get(path)
+    if template is not None and template.mtime == (stat.st_mtime_ns, stat.st_size):
+        return template
+
+    template = WorkflowTemplate.load(path)
+    with _templates_lock:
+        _templates[path] = template
+    return template
+
+
+def read_previous_seed():
+    """Return the seed saved by the last generation, or -1 if there is none."""
+    try:
+        if os.path.exists(PREVIOUS_SEED_FILE):
+            with open(PREVIOUS_SEED_FILE, 'r') as f:
+                saved_seed = f.read().strip()
+                if saved_seed and saved_seed.isdigit():
+                    return int(saved_seed)
+    except Exception as e:
+        print(f"Error reading previous seed: {e}", file=sys.stderr)
+    return -1
+
+
+def clean_workflow_options(options, workflow_file):
+    """
+    Return Advanced Options limited to WORKFLOW_OPTION_KEYS, after a trial
+    apply to the workflow so malformed values fail now rather than inside a
+    job. Raises ValueError if they don't apply or the workflow can't be loaded.
+    """
+    if not isinstance(options, dict):
+        raise ValueError("Options must be an object")
+    options = {key: options[key] for key in WORKFLOW_OPTION_KEYS if key in options}
+    for key, value in options.items():
+        if value is None:
+            continue
+        # bool is an int subclass, so only useLastSeed may be one
+        if not isinstance(value, OPTION_TYPES[key]) or isinstance(value, bool) != (key == 'useLastSeed'):
+            raise ValueError(f"Invalid value for {key}: {value!r}")
+    for lora in options.get('loras') or []:
+        if not isinstance(lora, dict) or not isinstance(lora.get('name', ''), str):
+            raise ValueError(f"Invalid LoRA: {lora!r}")
+    try:
+        apply_workflow_options(get_template(workflow_file).instance(), options)
+    except OSError as e:
+        raise ValueError(f"Cannot load workflow {workflow_file}: {e}")
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid workflow options: {e}")
+    return options
+
+
+def apply_workflow_options(workflow, options):
+    """
+    Apply Advanced Options (checkpoint, size, guidance, seed, extra LoRAs) to
+    a WorkflowInstance. Options that are missing are left at the workflow's
+    defaults, and a checkpointModel of 'default' keeps the workflow's own
+    checkpoint.
+    """
+    if not options:
+        return workflow
+
+    checkpoint = options.get('checkpointModel')
+    if checkpoint and checkpoint != 'default':
+        workflow.set_input('checkpoint', checkpoint)
+
+    for key in ('width', 'height'):
+        if options.get(key):
+            workflow.set_input('latent', options[key], key=key)
+
+    if options.get('guidance') is not None:
+        workflow.set_input('guidance', options['guidance'])
+
+    if options.get('useLastSeed', False):
+        workflow.set_input('seed', read_previous_seed())
+    elif 'seed' in options:
+        workflow.set_input('seed', options['seed'])
+
+    # Handle LoRAs while preserving character-specific ones
+    lora_node_id = workflow.roles.get('lora_loader')
+    if lora_node_id and 'loras' in options:
+        lora_node = workflow.writable(lora_node_id)
+        original_loras = {k: v for k, v in lora_node.get('inputs', {}).items() if k.startswith('lora_')}
+
+        # Store the existing model and clip connections
+        model_connection = lora_node['inputs'].get('model')
+        clip_connection = lora_node['inputs'].get('clip')
+
+        # Initialize the node with its basic structure
+        lora_node['inputs'] = {
+            "PowerLoraLoaderHeaderWidget": {"type": "PowerLoraLoaderHeaderWidget"},
+            "model": model_connection,
+            "clip": clip_connection,
+            "➕ Add Lora": ""
+        }
+
+        # First, add back the original character-specific LoRAs
+        next_lora_index = 1
+        for lora_value in original_loras.values():
+            if isinstance(lora_value, dict) and lora_value.get('lora'):
+                lora_node['inputs'][f'lora_{next_lora_index}'] = lora_value
+                next_lora_index += 1
+
+        # Then add the user-selected LoRAs if they're not already present
+        for lora in options.get('loras') or []:
+            if lora.get('name') and not any(v.get('lora') == lora['name'] for v in lora_node['inputs'].values() if isinstance(v, dict)):
+                lora_node['inputs'][f'lora_{next_lora_index}'] = {
+                    "on": True,
+                    "lora": lora['name'],
+                    "strength": lora.get('strength', 1)
+                }
+                next_lora_index += 1
+
+    return workflow
@@ -1,9 +1,9 @@
-import subprocess
 import os
 import argparse
+import json
 import sys
-import yaml
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Set up logging
 logging.basicConfig(
@@ -16,155 +16,99 @@ project_root = os.path.dirname(os.path.abspath(__file__))
 if project_root not in sys.path:
     sys.path.append(project_root)
 
-def load_characters(config_path):
+from generate import engine
+from generate.generate_prompt import save_prompt_to_file
+from config.config_utils import config
+from config.character_registry import character_registry
+from database.profile import standalone_app
+from gallery.index import image_index
+
+
+def read_batch_file(path, characters):
+    """
+    Read a JSONL batch file of {character, mode, prompt, overrides, count}
+    objects and expand it into one (line, character, mode, prompt, options)
+    entry per image. Every line is validated like an API batch item, and
+    the file held to the same image limit, before anything is queued;
+    raises ValueError naming the first bad line.
+    """
+    entries = []
+    with (sys.stdin if path == '-' else open(path, 'r')) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                item_entries = engine.expand_batch_item(json.loads(line), characters,
+                                                        engine.MAX_BATCH_ITEMS - len(entries))
+            except ValueError as e:
+                raise ValueError(f"Line {line_number}: {e}")
+            entries.extend((line_number,) + entry for entry in item_entries)
+    return entries
+
+
+def run_batch(args, characters):
+    """Render every entry of a batch file, keeping up to --workers prompts queued on ComfyUI."""
     try:
-        with open(config_path, 'r') as file:
-            characters = yaml.safe_load(file)
-            if not characters:
-                logger.warning(f"No characters found in {config_path}")
-            return characters or {}
-    except FileNotFoundError:
-        logger.error(f"Configuration file not found at {config_path}.")
-        return {}
-    except yaml.YAMLError as exc:
-        logger.error(f"Error parsing YAML file: {exc}")
-        return {}
-
-def get_prompt_auto(characters, character_name=None):
-    if not characters:
-        logger.error("No characters available to generate a prompt.")
-        return None
-
-    if not character_name:
-        logger.error("No character name provided.")
-        return None
-
-    if character_name not in characters:
-        logger.error(f"Character '{character_name}' not found in the configuration file.")
-        return None
-
-    generate_prompt_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate", "generate_prompt.py")
-
-    if not os.path.exists(generate_prompt_path):
-        logger.error(f"Generate prompt script not found at: {generate_prompt_path}")
-        return None
+        entries = read_batch_file(args.file, characters)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not read batch file: {e}")
+        sys.exit(1)
 
-    try:
-        env = os.environ.copy()
-        env['PYTHONPATH'] = project_root
-
-        logger.debug(f"Running generate_prompt.py for character: {character_name}")
-        result = subprocess.run(
-            ["python3", generate_prompt_path, character_name, "--mode", "auto"],
-            capture_output=True,
-            text=True,
-            check=True,
-            env=env
-        )
-
-        # Get the last non-empty line as the prompt
-        prompt_lines = [line.strip() for line in result.stdout.split('\n') if line.strip()]
-        if prompt_lines:
-            prompt = prompt_lines[-1]
-            logger.info(f"Generated prompt: {prompt}")
-            return prompt
-        else:
-            logger.error("No prompt generated (empty output)")
-            return None
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error running generate_prompt.py: {e.stderr.strip()}")
-        return None
-
-def get_prompt_enhanced(characters, character_name=None, user_prompt=None):
-    if not characters or not character_name or not user_prompt:
-        logger.error("Missing required information for enhanced prompt generation.")
-        return None
-
-    if character_name not in characters:
-        logger.error(f"Character '{character_name}' not found in the configuration file.")
-        return None
-
-    generate_prompt_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate", "generate_prompt.py")
-
-    if not os.path.exists(generate_prompt_path):
-        logger.error(f"Generate prompt script not found at: {generate_prompt_path}")
-        return None
+    logger.info(f"Running {len(entries)} batch jobs with {args.workers} workers")
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='batch') as executor:
+        futures = {
+            executor.submit(engine.run, character, mode, user_prompt=prompt, characters=characters,
+                            options=options, save_seed=False): (line_number, character, mode)
+            for line_number, character, mode, prompt, options in entries
+        }
+        for future in as_completed(futures):
+            line_number, character, mode = futures[future]
+            result = {'line': line_number, 'character': character, 'mode': mode}
+            try:
+                prompt, saved_paths = future.result()
+                result.update(state='completed', prompt=prompt, images=saved_paths)
+            except Exception as e:
+                failures += 1
+                result.update(state='failed', error=str(e))
+            print(json.dumps(result), flush=True)
+
+    if failures:
+        logger.error(f"{failures} of {len(entries)} batch jobs failed")
+        sys.exit(1)
 
-    try:
-        env = os.environ.copy()
-        env['PYTHONPATH'] = project_root
-
-        logger.debug(f"Running enhanced prompt generation for character: {character_name}")
-        result = subprocess.run(
-            ["python3", generate_prompt_path, character_name, "--mode", "enhanced"],
-            input=user_prompt,
-            capture_output=True,
-            text=True,
-            check=True,
-            env=env
-        )
-
-        prompt_lines = [line.strip() for line in result.stdout.split('\n') if line.strip()]
-        if prompt_lines:
-            prompt = prompt_lines[-1]
-            logger.info(f"Generated enhanced prompt: {prompt}")
-            return prompt
-        else:
-            logger.error("No prompt generated (empty output)")
-            return None
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error running generate_prompt.py: {e.stderr.strip()}")
-        return None
-
-def generate_images(prompt, character_name=None):
-    if not prompt:
-        logger.error("Cannot generate images without a prompt.")
-        return False
-
-    if not character_name:
-        logger.error("Cannot generate images without a character name.")
-        return False
-
-    queue_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate", "queue_and_retrieve_images.py")
-
-    if not os.path.exists(queue_script):
-        logger.error(f"Queue script not found at: {queue_script}")
-        return False
-
-    try:
-        env = os.environ.copy()
-        env['PYTHONPATH'] = project_root
-
-        logger.debug(f"Generating images for character {character_name} with prompt: {prompt}")
-        result = subprocess.run(
-            ["python3", queue_script, prompt, character_name],
-            capture_output=True,
-            text=True,
-            check=True,
-            env=env
-        )
-        logger.info("Image generation completed successfully")
-        return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error generating images: {e.stderr.strip()}")
-        return False
 
 def main():
     parser = argparse.ArgumentParser(description="Generate images based on prompts.")
-    parser.add_argument("mode", choices=["auto", "manual", "enhanced"],
-                      help="Choose 'auto' for random generation, 'manual' for direct prompt, or 'enhanced' for combined generation.")
+    parser.add_argument("mode", choices=["auto", "manual", "enhanced", "batch"],
+                      help="Choose 'auto' for random generation, 'manual' for direct prompt, 'enhanced' for combined generation, or 'batch' to render a JSONL file of jobs.")
     parser.add_argument("--character", type=str, help="Name of the character.")
+    parser.add_argument("--user-id", type=int, default=None,
+                      help="Save the first image as this user's latest image.")
+    parser.add_argument("--file", type=str, default="-",
+                      help="Batch mode: JSONL file of {character, mode, prompt, overrides, count} objects ('-' for stdin).")
+    parser.add_argument("--workers", type=int, default=config.get('generation', 'batch_workers', default=4),
+                      help="Batch mode: number of jobs in flight at once.")
     args = parser.parse_args()
 
+    # Saved images go into the web app's image index straight away
+    image_index.init_app(standalone_app(), scan=False)
+
+    if args.mode == "batch":
+        characters = character_registry.all()
+        if not characters:
+            logger.error("No characters loaded from configuration.")
+            sys.exit(1)
+        run_batch(args, characters)
+        return
+
     if not args.character:
         logger.error("Character name is required.")
         sys.exit(1)
 
-    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'characters.yaml')
-    characters = load_characters(config_path)
-
+    characters = character_registry.all()
     if not characters:
         logger.error("No characters loaded from configuration.")
         sys.exit(1)
@@ -173,25 +117,29 @@ def main():
         logger.error(f"Character '{args.character}' not found in configuration.")
         sys.exit(1)
 
-    if args.mode == "auto":
-        prompt = get_prompt_auto(characters, args.character)
-    elif args.mode == "enhanced":
-        user_prompt = sys.stdin.read().strip()
-        prompt = get_prompt_enhanced(characters, args.character, user_prompt)
-    else:  # manual mode
-        prompt = sys.stdin.read().strip()
-        logger.info(f"Using manual prompt: {prompt}")
-
-    if not prompt:
-        logger.error("No prompt was generated or entered.")
+    user_prompt = sys.stdin.read().strip() if args.mode != "auto" else None
+
+    try:
+        prompt = engine.generate_prompt(characters, args.character, args.mode, user_prompt)
+    except engine.GenerationError as e:
+        logger.error(f"No prompt was generated or entered: {e}")
         sys.exit(1)
 
+    if args.mode != "manual":
+        save_prompt_to_file(prompt)
+
     # Always print the prompt to stdout for capture by the calling process
     print(prompt)
 
-    if not generate_images(prompt, args.character):
-        logger.error("Failed to generate images.")
+    user_id = args.user_id
+    if user_id is None and 'user_id' in os.environ:
+        user_id = int(os.environ['user_id'])
+
+    try:
+        engine.generate_images(prompt, args.character, characters, user_id=user_id)
+    except engine.GenerationError as e:
+        logger.error(f"Failed to generate images: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Card, CardContent } from '@/components/ui/card';
 import { Button } from '@/components/ui/button';
 import { Checkbox } from '@/components/ui/checkbox';
@@ -11,6 +11,10 @@ const ImageBrowser = () => {
   const [selectedImage, setSelectedImage] = useState(null);
   const [selectedItems, setSelectedItems] = useState(new Set());
   const [canDelete, setCanDelete] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loading, setLoading] = useState(false);
+  const [sortOrder, setSortOrder] = useState('name');
+  const loadMoreRef = useRef(null);
 
   useEffect(() => {
     // Fetch initial files
@@ -42,19 +46,39 @@ const ImageBrowser = () => {
     setSelectedItems(new Set());
   };
 
-  const fetchFiles = async (path) => {
+  const fetchFiles = async (path, cursor = null, sort = sortOrder) => {
+    setLoading(true);
     try {
-      const response = await fetch(`/api/files?path=${encodeURIComponent(path)}`);
-      if (!response.ok) {
-        throw new Error('Failed to fetch files');
-      }
+      const params = new URLSearchParams({ path, sort });
+      if (cursor) params.set('cursor', cursor);
+      const response = await fetch(`/api/files?${params}`);
+      if (!response.ok) throw new Error('Failed to fetch files');
       const data = await response.json();
-      setCurrentFiles(data);
+      setCurrentFiles(prev => cursor ? [...prev, ...data.items] : data.items);
+      setNextCursor(data.next_cursor);
     } catch (error) {
       console.error('Error fetching files:', error);
+    } finally {
+      setLoading(false);
     }
   };
 
+  // Load the next page when the sentinel below the grid scrolls into view
+  useEffect(() => {
+    if (!nextCursor || loading || !loadMoreRef.current) return;
+    const observer = new IntersectionObserver(entries => {
+      if (entries[0].isIntersecting) fetchFiles(currentPath, nextCursor);
+    }, { rootMargin: '400px' });
+    observer.observe(loadMoreRef.current);
+    return () => observer.disconnect();
+  }, [nextCursor, loading, currentPath]);
+
+  const changeSort = (sort) => {
+    setSortOrder(sort);
+    fetchFiles(currentPath, null, sort);
+    setSelectedItems(new Set());
+  };
+
   const toggleItemSelection = (itemName) => {
     setSelectedItems(prev => {
       const newSet = new Set(prev);
@@ -116,6 +140,15 @@ const ImageBrowser = () => {
           <span className="text-lg font-medium">
             {currentPath === '/' ? 'Root' : currentPath}
           </span>
+          <select
+            value={sortOrder}
+            onChange={(e) => changeSort(e.target.value)}
+            className="ml-4 px-2 py-1 bg-gray-700 text-white rounded"
+          >
+            <option value="name">Name</option>
+            <option value="date">Newest first</option>
+            <option value="size">Size</option>
+          </select>
         </div>
 
         {canDelete && (
@@ -188,11 +221,12 @@ const ImageBrowser = () => {
                   )}
                   <div
                     className="cursor-pointer"
-                    onClick={() => setSelectedImage(item.url)}
+                    onClick={() => setSelectedImage(item)}
                   >
                     <div className="relative w-full pt-[100%]">
                       <img
-                        src={item.url}
+                        src={item.thumbnail_url || item.url}
+                        loading="lazy"
                         alt={item.name}
                         className="absolute top-0 left-0 w-full h-full object-cover rounded"
                       />
@@ -206,13 +240,17 @@ const ImageBrowser = () => {
         ))}
       </div>
 
+      <div ref={loadMoreRef} className="h-8 mt-4 text-center text-gray-400">
+        {loading && 'Loading...'}
+      </div>
+
       {selectedImage && (
         <div
           className="fixed inset-0 bg-black bg-opacity-75 flex items-center justify-center p-4 z-50"
           onClick={() => setSelectedImage(null)}
         >
           <img
-            src={selectedImage}
+            src={selectedImage.preview_url || selectedImage.url}
             alt="Selected"
             className="max-w-full max-h-[90vh] object-contain"
           />
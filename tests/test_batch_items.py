@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import engine
+from generate.workflows import get_template, apply_workflow_options
+
+CHARACTERS = {'Test': {'workflow_file': 'workflows/generic-workflow.json'}}
+
+
+def seeds(item):
+    return [options['seed'] for _, _, _, options in engine.expand_batch_item(item, CHARACTERS)]
+
+
+def test_copies_without_a_seed_get_random_seeds():
+    assert seeds({'character': 'Test', 'prompt': 'a cat', 'count': 3}) == [-1, -1, -1]
+
+
+def test_copies_without_a_seed_render_distinct_seeds():
+    entries = engine.expand_batch_item({'character': 'Test', 'prompt': 'a cat', 'count': 3}, CHARACTERS)
+    resolved = []
+    for _, _, _, options in entries:
+        workflow = apply_workflow_options(get_template(CHARACTERS['Test']['workflow_file']).instance(), options)
+        resolved.append(workflow.resolve_seed())
+    assert len(set(resolved)) == 3
+
+
+def test_fixed_seed_is_stepped_per_copy():
+    assert seeds({'character': 'Test', 'prompt': 'a cat', 'count': 3, 'overrides': {'seed': 10}}) == [10, 11, 12]
+
+
+def test_explicit_random_seed_is_kept():
+    assert seeds({'character': 'Test', 'count': 2, 'overrides': {'seed': -1}}) == [-1, -1]
+
+
+@pytest.mark.parametrize('item, message', [
+    ({'character': 'Nobody'}, 'not found'),
+    ({'character': 'Test', 'mode': 'enhanced'}, 'requires a prompt'),
+    ({'character': 'Test', 'mode': 'sideways'}, 'invalid mode'),
+    ({'character': 'Test', 'overrides': ['seed']}, 'overrides must be an object'),
+    ({'character': 'Test', 'overrides': {'loras': 5}}, 'Invalid value for loras'),
+    ({'character': 'Test', 'overrides': {'width': 'wide'}}, 'Invalid value for width'),
+    ({'character': 'Test', 'count': 0}, 'positive integer'),
+])
+def test_bad_items_are_rejected(item, message):
+    with pytest.raises(ValueError, match=message):
+        engine.expand_batch_item(item, CHARACTERS)
+
+
+def test_unknown_override_keys_are_dropped():
+    entries = engine.expand_batch_item({'character': 'Test', 'overrides': {'bogus': 1, 'seed': 5}}, CHARACTERS)
+    assert entries[0][3] == {'seed': 5}
+
+
+def test_count_is_checked_against_the_remaining_budget():
+    with pytest.raises(ValueError, match='at most'):
+        engine.expand_batch_item({'character': 'Test', 'count': 100000000}, CHARACTERS, remaining=5)
+    assert len(engine.expand_batch_item({'character': 'Test', 'count': 5}, CHARACTERS, remaining=5)) == 5
+
+
+@pytest.mark.parametrize('save_seed, saved', [(True, [42]), (False, [])])
+def test_batch_images_leave_the_last_seed_alone(monkeypatch, tmp_path, save_seed, saved):
+    from generate import queue_and_retrieve_images as comfyui
+
+    written = []
+    monkeypatch.setattr(comfyui, 'extract_seed_from_workflow', lambda workflow: 42)
+    monkeypatch.setattr(comfyui, 'save_seed_to_file', lambda seed: written.append(seed) or True)
+    monkeypatch.setattr(comfyui, 'get_character_directory', lambda name: str(tmp_path))
+    monkeypatch.setattr(comfyui, 'save_image_with_metadata', lambda *args, **kwargs: None)
+    monkeypatch.setattr(comfyui.derivatives, 'schedule', lambda rel_path: None)
+    monkeypatch.setattr(comfyui.image_index, 'saved', lambda *args, **kwargs: None)
+    workflow = get_template(CHARACTERS['Test']['workflow_file']).instance()
+
+    paths = comfyui.save_images([(str(tmp_path / 'download.png'), 'download.png')], 'prompt-1', 'Test',
+                                workflow, save_seed=save_seed)
+    assert len(paths) == 1
+    assert written == saved
@@ -0,0 +1,81 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.models import db, GeneratedImage
+from database.profile import standalone_app
+from gallery.index import ImageIndex, encode_cursor, decode_cursor
+
+START = datetime(2026, 1, 1)
+# Repeated sizes and dates, so pages must break ties on the path
+IMAGES = [('A/img%02d.png' % n, 100 * (n % 4), START + timedelta(hours=n % 3), n % 2) for n in range(23)]
+
+
+@pytest.fixture
+def index(tmp_path):
+    app = standalone_app(str(tmp_path / 'app.db'))
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(GeneratedImage(path=path, folder='A', size=size, created_at=created_at, seed=seed)
+                           for path, size, created_at, seed in IMAGES)
+        db.session.add(GeneratedImage(path='B/other.png', folder='B'))
+        db.session.commit()
+        yield ImageIndex(root=str(tmp_path))
+
+
+def all_pages(index, limit=5, **listing):
+    paths, cursor = [], None
+    while True:
+        images, cursor = index.page('A', limit=limit, cursor=cursor, **listing)
+        assert len(images) <= limit
+        paths.extend(image.path for image in images)
+        if cursor is None:
+            return paths
+
+
+@pytest.mark.parametrize('sort, key', [
+    ('name', lambda image: image[0]),
+    ('size', lambda image: (image[1], image[0])),
+    ('date', lambda image: (image[2], image[0])),
+])
+@pytest.mark.parametrize('descending', [False, True])
+def test_pages_cover_the_folder_in_order(index, sort, key, descending):
+    expected = [image[0] for image in sorted(IMAGES, key=key, reverse=descending)]
+    assert all_pages(index, sort=sort, descending=descending) == expected
+
+
+def test_filters_apply_across_pages(index):
+    expected = sorted(path for path, _, _, seed in IMAGES if seed == 1)
+    assert all_pages(index, limit=4, seed=1) == expected
+
+
+def test_last_page_has_no_cursor(index):
+    images, cursor = index.page('A', limit=len(IMAGES))
+    assert len(images) == len(IMAGES) and cursor is None
+
+
+@pytest.mark.parametrize('sort', ['name', 'size', 'date'])
+def test_cursor_round_trip(sort):
+    image = GeneratedImage(path='A/x.png', size=42, created_at=START)
+    value, path = decode_cursor(encode_cursor(image, sort), sort)
+    assert path == 'A/x.png'
+    assert value == {'name': 'A/x.png', 'size': 42, 'date': START}[sort]
+
+
+@pytest.mark.parametrize('cursor, sort', [
+    ('not base64!', 'name'),
+    (encode_cursor(GeneratedImage(path='A/x.png', size=1), 'name'), 'size'),
+    (encode_cursor(GeneratedImage(path='A/x.png', size=1), 'size'), 'date'),
+])
+def test_bad_cursors_are_rejected(index, cursor, sort):
+    with pytest.raises(ValueError):
+        index.page('A', sort=sort, cursor=cursor)
+
+
+def test_unknown_sort_is_rejected(index):
+    with pytest.raises(ValueError):
+        index.page('A', sort='colour')
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import jobs
+
+
+@pytest.fixture
+def job(monkeypatch):
+    monkeypatch.setattr(jobs, 'MAX_EVENTS', 5)
+    return jobs.Job(1, 'Test', 'auto')
+
+
+def tokens(job, count, start=0):
+    for n in range(start, start + count):
+        job.publish('token', {'text': str(n)})
+
+
+def test_events_are_read_from_the_cursor(job):
+    tokens(job, 3)
+    events, cursor, finished = job.events_since(0, timeout=0)
+    assert [data['text'] for _, data in events] == ['0', '1', '2']
+    assert cursor == 3 and not finished
+
+    tokens(job, 1, start=3)
+    events, cursor, _ = job.events_since(cursor, timeout=0)
+    assert events == [('token', {'text': '3'})]
+    assert cursor == 4
+
+
+def test_history_is_bounded_and_cursors_stay_absolute(job):
+    tokens(job, 8)
+    assert len(job._events) == 5
+
+    events, cursor, _ = job.events_since(0, timeout=0)
+    assert [data['text'] for _, data in events] == ['3', '4', '5', '6', '7']
+    assert cursor == 8
+
+    events, cursor, _ = job.events_since(6, timeout=0)
+    assert [data['text'] for _, data in events] == ['6', '7']
+    assert cursor == 8
+
+
+def test_latest_only_replaces_the_previous_event(job):
+    job.publish('progress', {'value': 1}, latest_only=True)
+    tokens(job, 1)
+    job.publish('progress', {'value': 2}, latest_only=True)
+
+    events, cursor, _ = job.events_since(0, timeout=0)
+    assert events == [('token', {'text': '0'}), ('progress', {'value': 2})]
+    assert cursor == 3
+
+
+def test_latest_only_after_its_previous_event_was_dropped(job):
+    job.publish('progress', {'value': 1}, latest_only=True)
+    tokens(job, 6)
+    job.publish('progress', {'value': 2}, latest_only=True)
+
+    events, _, _ = job.events_since(0, timeout=0)
+    assert ('progress', {'value': 2}) in events
+    assert len(events) == 5
+
+
+def test_finished_job_returns_without_waiting(job):
+    job.update(state='completed')
+    events, cursor, finished = job.events_since(1, timeout=5)
+    assert events == [] and finished
+    assert cursor == 1
@@ -0,0 +1,76 @@
+import io
+import os
+import sys
+import struct
+
+import pytest
+from PIL import Image, PngImagePlugin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import png_metadata
+from generate.png_metadata import copy_with_text_chunks, text_chunk, itxt_chunk, read_png_info
+
+
+def make_png(text=None):
+    info = PngImagePlugin.PngInfo()
+    for key, value in (text or {}).items():
+        info.add_text(key, value)
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 32), (200, 30, 90)).save(buffer, 'PNG', pnginfo=info)
+    return buffer.getvalue()
+
+
+def chunks(data):
+    """The (type, data) of each chunk in a PNG, in order."""
+    found = []
+    offset = len(png_metadata.PNG_SIGNATURE)
+    while offset < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        found.append((chunk_type, data[offset + 8:offset + 8 + length]))
+        offset += 12 + length
+    return found
+
+
+def splice(source, new_chunks):
+    dst = io.BytesIO()
+    copy_with_text_chunks(io.BytesIO(source), dst, new_chunks)
+    return dst.getvalue()
+
+
+def test_image_data_is_copied_byte_for_byte():
+    source = make_png()
+    result = splice(source, [text_chunk('prompt', 'a cat')])
+
+    idat = [data for chunk_type, data in chunks(result) if chunk_type == b'IDAT']
+    assert idat == [data for chunk_type, data in chunks(source) if chunk_type == b'IDAT']
+    assert [chunk_type for chunk_type, _ in chunks(result)][-2:] == [b'tEXt', b'IEND']
+    with Image.open(io.BytesIO(result)) as image:
+        assert image.getpixel((0, 0)) == (200, 30, 90)
+
+
+def test_same_keyword_is_replaced_and_others_kept(tmp_path):
+    source = make_png({'prompt': 'old', 'workflow': '{}'})
+    path = tmp_path / 'out.png'
+    path.write_bytes(splice(source, [text_chunk('prompt', 'new')]))
+
+    width, height, text = read_png_info(str(path))
+    assert (width, height) == (64, 32)
+    assert text == {'prompt': 'new', 'workflow': '{}'}
+    assert sum(chunk_type == b'tEXt' for chunk_type, _ in chunks(path.read_bytes())) == 2
+
+
+def test_non_latin1_text_uses_itxt(tmp_path):
+    path = tmp_path / 'out.png'
+    path.write_bytes(splice(make_png(), [text_chunk('prompt', 'café ☕'),
+                                         itxt_chunk('charactergen', '{"seed": 1}', compressed=True)]))
+
+    assert read_png_info(str(path))[2] == {'prompt': 'café ☕', 'charactergen': '{"seed": 1}'}
+    with Image.open(path) as image:
+        assert image.text['prompt'] == 'café ☕'
+
+
+@pytest.mark.parametrize('data', [b'not a png', make_png()[:-12]])
+def test_bad_input_is_rejected(data):
+    with pytest.raises(ValueError):
+        splice(data, [text_chunk('prompt', 'x')])
@@ -0,0 +1,104 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import rate_limit
+from auth.rate_limit import LoginRateLimiter
+
+KEY = ('bob', '10.0.0.1')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def limiter(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, '_max_attempts', lambda: 3)
+    monkeypatch.setattr(rate_limit, '_window', lambda: 60)
+    return LoginRateLimiter('memory')
+
+
+def fail(limiter, clock, times, step=1):
+    for _ in range(times):
+        limiter.record(*KEY, success=False)
+        clock.now += step
+
+
+def test_locks_after_max_failures_in_the_window(limiter, clock):
+    fail(limiter, clock, 2)
+    assert not limiter.is_locked(*KEY)
+    fail(limiter, clock, 1)
+    assert limiter.is_locked(*KEY)
+    assert not limiter.is_locked('bob', '10.0.0.2')
+
+
+def test_unlocks_when_the_oldest_failure_leaves_the_window(limiter, clock):
+    fail(limiter, clock, 3, step=10)   # failures at 1000, 1010 and 1020
+    clock.now = 1059
+    assert limiter.is_locked(*KEY)
+    clock.now = 1061
+    assert not limiter.is_locked(*KEY)
+
+
+def test_window_slides_instead_of_resetting(limiter, clock):
+    fail(limiter, clock, 2, step=50)   # 1000 and 1050
+    clock.now = 1070                   # the first has expired
+    fail(limiter, clock, 1)
+    assert not limiter.is_locked(*KEY)
+    fail(limiter, clock, 1)
+    assert limiter.is_locked(*KEY)
+
+
+def test_success_clears_failures(limiter, clock):
+    fail(limiter, clock, 3)
+    limiter.record(*KEY, success=True)
+    assert not limiter.is_locked(*KEY)
+
+
+def test_only_the_newest_failures_are_kept(limiter, clock):
+    fail(limiter, clock, 50)
+    assert len(limiter.backend._failures[KEY]) == 3
+
+
+def test_expired_pairs_are_swept(limiter, clock):
+    fail(limiter, clock, 1)
+    clock.now += 120
+    limiter.record('alice', '10.0.0.3', success=False)
+    assert KEY not in limiter.backend._failures
+
+
+def test_explicit_limits_override_the_config(limiter, clock):
+    fail(limiter, clock, 2)
+    assert limiter.is_locked(*KEY, max_attempts=2, lockout_time=60)
+    assert not limiter.is_locked(*KEY, max_attempts=2, lockout_time=1)
+
+
+def test_attempts_refused_during_a_lockout_are_audited_but_not_counted(limiter, clock, monkeypatch):
+    from auth import utils
+
+    audited = []
+    monkeypatch.setattr(utils, 'login_limiter', limiter)
+    monkeypatch.setattr(utils.audit_log, 'record', lambda *args: audited.append(args))
+
+    fail(limiter, clock, 3, step=10)   # failures at 1000, 1010 and 1020
+    for _ in range(5):
+        utils.log_login_attempt(KEY[0], False, KEY[1], reason=utils.LOCKED)
+    assert audited == [(KEY[0], False, KEY[1], utils.LOCKED)] * 5
+
+    clock.now = 1061
+    assert not limiter.is_locked(*KEY)